@@ -1,255 +1,541 @@
 # backend/app.py
+# Flask serving mode. create_app() returns the app immediately; the heavy imports (langchain, pymongo,
+# redis, numpy) and every client/index are built in init_components(), which startup.Startup runs on a
+# background thread by default and retries with backoff. /healthz = liveness, /readyz = readiness.
 
 # --- Imports ---
+import time
+IMPORT_STARTED = time.perf_counter() # Import-to-ready time is measured from here
 import os
-import sys
 import json # For caching results
-import hashlib # For creating cache keys
-from flask import Flask, jsonify, request, abort
+from flask import Blueprint, Flask, jsonify, request, Response, g, stream_with_context
 from flask_cors import CORS
 from dotenv import load_dotenv
-from pymongo import MongoClient # Use synchronous pymongo
-from bson import ObjectId
-from bson.errors import InvalidId
-import re
-from langchain_openai import ChatOpenAI, OpenAIEmbeddings
-from langchain.prompts import PromptTemplate
-from langchain.schema.runnable import RunnablePassthrough # Keep Passthrough
-# Remove RunnableLambda if only used for async calls previously
-# from langchain.schema.runnable import RunnableLambda
-from langchain.schema.output_parser import StrOutputParser
-from scipy.spatial.distance import cosine as cosine_distance # Keep for re-ranking
-import numpy as np # Keep for re-ranking
-import redis # Import redis
+from metrics import CACHE_EVENTS, ERRORS, METRICS_CONTENT_TYPE, REQUESTS, REQUEST_SECONDS, STAGE_SECONDS, TRACE_HEADER, get_logger, render_metrics, stage, start_trace
+from startup import INDEX_REFRESH_ENABLED, IndexRefresher, Startup
+from rag import EMBEDDING_MODEL, LLM_MODEL, RAG_TEMPLATE, CONTEXT_ERROR_PREFIX, CONTEXT_CANDIDATES, book_title_for, context_cache_digest, count_tokens, format_context
 
 load_dotenv()
+log = get_logger("app")
 
 # --- Configuration ---
 MONGO_URI = os.getenv("MONGO_URI")
 DB_NAME = "books"
 COLLECTION_NAME = "books"
 INDEX_NAME = "vector_index"
-EMBEDDING_MODEL = "text-embedding-ada-002"
-LLM_MODEL = "gpt-3.5-turbo"
 REDIS_HOST = os.getenv("REDIS_HOST", "localhost") # Redis config
 REDIS_PORT = int(os.getenv("REDIS_PORT", 6379))
-CACHE_EXPIRATION_SECONDS = 3600 # Cache results for 1 hour
+CONTEXT_CACHE_TTL_SECONDS = int(os.getenv("CONTEXT_CACHE_TTL_SECONDS", 86400)) # Keys are generation-tagged (generations.py), so entries can live long
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN") # Enables /api/admin/* (sent as X-Admin-Token)
+UNGATED_ENDPOINTS = {"api.hello", "api.metrics", "api.healthz", "api.readyz"} # Served before components are ready
 
 # --- Check Configuration ---
-if not MONGO_URI: sys.exit("Error: MONGO_URI not found in .env file.")
-if not os.getenv("OPENAI_API_KEY"): print("Warning: OPENAI_API_KEY not found...")
+if not os.getenv("OPENAI_API_KEY"): log.warning("OPENAI_API_KEY not found...")
 
-# --- Initialize Components ---
+# --- Components (built by init_components) ---
 rag_chain = None
 mongo_client = None
 mongo_collection = None
 embeddings = None
 llm = None
 redis_client = None
-
-try:
-    # --- Redis Client ---
+retriever = None
+context_cache = None
+semantic_cache = None
+answer_chain = None
+bm25_index = None
+retrieval_mode = "vector"
+retrieval_latency = None
+catalog = None
+generations = None
+index_refresher = None
+
+
+def close_clients():
+    """Closes the Redis pool and MongoClient (a failed init attempt's, or on shutdown)."""
+    global redis_client, mongo_client
+    if redis_client is not None: redis_client.connection_pool.disconnect()
+    if mongo_client is not None: mongo_client.close()
+    redis_client = mongo_client = None
+
+
+def init_components():
+    """Connects to Redis and MongoDB and builds the retriever, BM25 index and LangChain components.
+    Raises on failure; startup retries with backoff. Heavy imports live here so importing app.py stays cheap."""
+    try:
+        build_components()
+    except Exception:
+        close_clients() # Otherwise every retry would leak the failed attempt's Redis pool and MongoClient
+        raise
+
+
+def build_components():
+    global rag_chain, mongo_client, mongo_collection, embeddings, llm, redis_client, retriever, context_cache, semantic_cache, \
+        answer_chain, bm25_index, retrieval_mode, retrieval_latency, catalog, generations, index_refresher
+    import redis
+    from pymongo import MongoClient # Use synchronous pymongo
+    from langchain_openai import ChatOpenAI, OpenAIEmbeddings
+    from langchain.prompts import PromptTemplate
+    from langchain.schema.runnable import RunnablePassthrough
+    from langchain.schema.output_parser import StrOutputParser
+    from retrievers import build_retriever, RETRIEVER_BACKEND
+    from storage import STORAGE_LAYOUT, CHUNK_COLLECTION_NAME
+    from cache import TwoTierCache, make_redis_client
+    from semantic_cache import SemanticCache, SEMANTIC_CACHE_ENABLED
+    from generations import Generations, fingerprint
+    from catalog import Catalog, CATALOG_PROJECTION, CATALOG_QUERY, CATALOG_VERSION_KEY
+    from lexical import RETRIEVAL_MODE, LatencyStats, check_mode, load_index
+    if not MONGO_URI: raise ValueError("MONGO_URI not found in .env file.")
+
+    # --- Redis Client (pooled) + Two-Tier Context Cache ---
+    redis_client = make_redis_client(REDIS_HOST, REDIS_PORT) # Decodes responses to strings
+    context_cache = TwoTierCache(redis_client, ttl=CONTEXT_CACHE_TTL_SECONDS)
     try:
-        redis_client = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, decode_responses=True) # Decode responses to strings
         redis_client.ping() # Check connection
-        print(f"Redis connection successful to {REDIS_HOST}:{REDIS_PORT}.")
-    except redis.exceptions.ConnectionError as redis_err:
-        print(f"Warning: Redis connection failed: {redis_err}. Caching will be disabled.")
-        redis_client = None # Disable caching if connection fails
+        log.info(f"Redis connection successful to {REDIS_HOST}:{REDIS_PORT}.")
+    except redis.exceptions.RedisError as redis_err:
+        # Keep the client: the circuit breaker skips Redis while it is down and retries it periodically
+        log.warning(f"Redis connection failed: {redis_err}. Serving from the in-process cache until it recovers.")
+        context_cache.breaker.trip()
+    generations = Generations(context_cache, EMBEDDING_MODEL, fingerprint(LLM_MODEL, RAG_TEMPLATE))
+    if semantic_cache is None and SEMANTIC_CACHE_ENABLED: semantic_cache = SemanticCache()
+    if retrieval_latency is None: retrieval_latency = LatencyStats()
 
     # --- MongoDB Client (Synchronous) ---
     mongo_client = MongoClient(MONGO_URI)
     db = mongo_client[DB_NAME]
     mongo_collection = db[COLLECTION_NAME]
     mongo_client.admin.command('ping')
-    print("MongoDB connection successful.")
+    log.info("MongoDB connection successful.")
+
+    # --- Catalog Snapshot (refreshed on TTL or when ingestion bumps the corpus generation) ---
+    # A corpus generation change also refreshes the local search indexes in the background (refresh_indexes)
+    index_refresher = IndexRefresher(refresh_indexes)
+    catalog = Catalog(lambda: list(mongo_collection.find(CATALOG_QUERY, CATALOG_PROJECTION)),
+                      lambda: context_cache.shared_call("get", CATALOG_VERSION_KEY),
+                      on_change=index_refresher.request if INDEX_REFRESH_ENABLED else log_stale_indexes)
+
+    # --- Retriever (Atlas $vectorSearch or local HNSW index) ---
+    retriever = build_retriever(RETRIEVER_BACKEND, mongo_collection, INDEX_NAME, layout=STORAGE_LAYOUT, chunk_collection=db[CHUNK_COLLECTION_NAME])
+    log.info(f"Using '{retriever.name}' retriever backend ({STORAGE_LAYOUT} storage layout).")
+
+    # --- BM25 Index (lexical / hybrid retrieval; vector-only when missing) ---
+    retrieval_mode = check_mode(RETRIEVAL_MODE)
+    bm25_index = load_index(retrieval_mode)
+    if bm25_index is None: retrieval_mode = "vector"
+    log.info(f"Retrieval mode: {retrieval_mode}.")
 
     # --- LangChain Components ---
     embeddings = OpenAIEmbeddings(model=EMBEDDING_MODEL)
     llm = ChatOpenAI(model_name=LLM_MODEL, temperature=0.1)
-    rag_template = """You are PagePal, You have to act as you're the book talking to user. You are a helpful assistant discussing the book "{book_title}".
-Strictly base your answer ONLY on the following context extracted from the book.
-Analyze the context provided. If it directly answers the user's question, provide that answer.
-If the context is relevant to the question but doesn't answer it fully, synthesize the information found and state what is available in the text you have access to.
-If the context provided is empty or only contains messages like 'Could not find relevant context...', politely inform the user that you couldn't find specific details on that topic within the text for "{book_title}" and suggest they ask about something else covered in the book.
-use just little of your general knowledge of the book. **Do not** mention the words 'context', 'documents', or 'database' in your final response.
-
-Context:
-{context}
-
-Question: {question}
-Answer:"""
-    rag_prompt = PromptTemplate.from_template(rag_template)
-
-    # --- Synchronous Retrieval Function with Redis Cache ---
-    def retrieve_context(query: str, k: int = 4, filter_criteria: dict = None, rerank_k: int = 5):
-        """
-        Embeds query, performs vector search in MongoDB, re-ranks, caches result in Redis.
-        """
-        # Generate cache key (hash of query + filter)
-        cache_key_input = f"{query}::{json.dumps(filter_criteria, sort_keys=True)}"
-        cache_key = f"context_cache:{hashlib.md5(cache_key_input.encode()).hexdigest()}"
-
-        # Try fetching from cache first
-        if redis_client:
-            try:
-                cached_context = redis_client.get(cache_key)
-                if cached_context:
-                    print(f"Cache HIT for query: '{query}' with filter: {filter_criteria}")
-                    return cached_context # Return cached result directly
-            except redis.exceptions.RedisError as redis_err:
-                 print(f"Warning: Redis GET error: {redis_err}. Proceeding without cache.")
-
-        print(f"Cache MISS for query: '{query}' with filter: {filter_criteria}")
-
-        # --- If cache miss, perform retrieval ---
-        if mongo_collection is None or embeddings is None: raise ValueError("MongoDB or embeddings not initialized.")
-        try:
-            # (Retrieval logic is the same as app_py_mongodb_v9 - Vector Search + Python Re-ranking)
-            query_embedding = embeddings.embed_query(query)
-            num_candidates_mongo = k * 5
-            search_stage = { '$vectorSearch': { 'index': INDEX_NAME, 'path': 'chunks.embedding', 'queryVector': query_embedding, 'numCandidates': num_candidates_mongo * 10, 'limit': num_candidates_mongo } }
-            if filter_criteria: search_stage['$vectorSearch']['filter'] = filter_criteria; print(f"Applying vector search filter: {filter_criteria}")
-            pipeline = [ search_stage, { '$project': { '_id': 0, 'title': 1, 'chunks': 1 } } ]
-            # Use synchronous aggregate call
-            results = list(mongo_collection.aggregate(pipeline))
-            print(f"MongoDB $vectorSearch returned {len(results)} candidate document(s).")
-
-            if not results:
-                context = "Could not find any potentially relevant documents in the specified book(s)."
-            else:
-                candidate_chunks = [];
-                for doc in results:
-                    doc_title = doc.get('title', 'Unknown')
-                    for chunk_data in doc.get('chunks', []):
-                        if 'text' in chunk_data and 'embedding' in chunk_data: candidate_chunks.append({ 'text': chunk_data['text'], 'embedding': chunk_data['embedding'], 'title': doc_title })
-                if not candidate_chunks:
-                    context = "Could not find relevant text chunks in the specified book(s)."
-                else:
-                    print(f"Extracted {len(candidate_chunks)} candidate chunks for re-ranking.")
-                    chunk_similarities = []; query_embedding_np = np.array(query_embedding)
-                    for chunk in candidate_chunks:
-                        chunk_embedding_np = np.array(chunk['embedding']); similarity = 1 - cosine_distance(query_embedding_np, chunk_embedding_np); chunk_similarities.append((similarity, chunk['text'], chunk['title']))
-                    chunk_similarities.sort(key=lambda x: x[0], reverse=True); top_chunks = chunk_similarities[:rerank_k]; print(f"Top {len(top_chunks)} re-ranked chunks selected.")
-                    context_parts = [];
-                    for score, text, title in top_chunks: print(f"  - Score: {score:.4f}, Title: {title}"); context_parts.append(f"Context from '{title}':\n{text}")
-                    context = "\n\n---\n\n".join(context_parts)
-
-            print(f"Retrieved Context Length: {len(context)}")
-            if not context:
-                print("Warning: No context constructed after re-ranking.")
-                context = "Could not find relevant context in the specified book(s) after re-ranking." # Ensure fallback
-            else:
-                print(f"Context Snippet Sent to LLM: {context[:500]}...")
-
-            # Store result in cache if Redis is available
-            if redis_client and context:
-                 try:
-                     redis_client.set(cache_key, context, ex=CACHE_EXPIRATION_SECONDS)
-                     print(f"Stored result in Redis cache (key: {cache_key[:15]}...)")
-                 except redis.exceptions.RedisError as redis_err:
-                      print(f"Warning: Redis SET error: {redis_err}. Failed to cache result.")
-
-            return context
-
-        except Exception as e:
-            print(f"Error during MongoDB retrieval or re-ranking: {e}")
-            if "index not found" in str(e).lower() or "failed to find search index" in str(e).lower():
-                 print(f"CRITICAL Error: Vector Search index '{INDEX_NAME}' not found or misconfigured in Atlas!")
-            return f"Error retrieving context from database: {e}"
-
+    rag_prompt = PromptTemplate.from_template(RAG_TEMPLATE)
 
     # --- RAG Chain (Synchronous) ---
-    # Input: {"query": ..., "filter": ..., "book_title": ...}
+    # answer_chain input: {"context": ..., "question": ..., "book_title": ...}
+    answer_chain = rag_prompt | llm | StrOutputParser()
+    # rag_chain input: {"query": ..., "filter": ..., "book_title": ..., "query_embedding": optional}
     rag_chain = (
         {
             # Pass input dict, retrieve_context extracts query/filter
-            "context": RunnablePassthrough() | (lambda input_dict: retrieve_context(input_dict['query'], filter_criteria=input_dict.get('filter'))),
+            "context": RunnablePassthrough() | (lambda input_dict: retrieve_context(input_dict['query'], filter_criteria=input_dict.get('filter'), query_embedding=input_dict.get('query_embedding'), generation=generation_tags(input_dict.get('filter'))[0])),
             "question": RunnablePassthrough() | (lambda input_dict: input_dict['query']),
             "book_title": RunnablePassthrough() | (lambda input_dict: input_dict.get('book_title', 'the book'))
         }
-        | rag_prompt
-        | llm
-        | StrOutputParser()
+        | answer_chain
     )
-    print("RAG components initialized (Synchronous retrieval with Redis Cache).")
-
-
-except Exception as e:
-    print(f"FATAL: Error initializing components: {e}")
-    rag_chain = None
-
-
-# --- Flask App ---
-app = Flask(__name__)
-CORS(app)
-
-# --- API Endpoints (Keep hello, chat, get_books, get_genres, get_book_details the same logic) ---
-# The 'chat' endpoint uses the synchronous rag_chain
-
-@app.route('/api/hello', methods=['GET'])
+    log.info("RAG components initialized (Synchronous retrieval with Redis Cache).")
+
+
+def refresh_indexes():
+    """Run by index_refresher after ingestion bumped the corpus generation: swaps in indexes that include the new books."""
+    global retriever, bm25_index, retrieval_mode
+    from retrievers import refresh_retriever
+    from storage import STORAGE_LAYOUT, CHUNK_COLLECTION_NAME
+    from lexical import RETRIEVAL_MODE, check_mode, load_index
+    retriever = refresh_retriever(retriever, mongo_collection, STORAGE_LAYOUT, mongo_client[DB_NAME][CHUNK_COLLECTION_NAME])
+    # BM25: re-merge the segments (ingestion writes one per book); also restores RETRIEVAL_MODE if none existed at startup
+    mode = check_mode(RETRIEVAL_MODE)
+    index = load_index(mode)
+    if index is not None: bm25_index, retrieval_mode = index, mode
+
+
+def log_stale_indexes(version):
+    if retriever is not None and retriever.name == "hnsw":
+        log.warning(f"Corpus changed (generation {version}) but INDEX_REFRESH_ENABLED is off: the HNSW index misses "
+                    "the new books until it is rebuilt (python retrievers.py build) and the server restarted.")
+    if bm25_index is not None:
+        log.warning(f"Corpus changed (generation {version}) but INDEX_REFRESH_ENABLED is off: the BM25 index misses "
+                    "the new books until the server restarts.")
+
+
+def warm_up():
+    """Optional (STARTUP_WARMUP): pays the first request's one-off costs before readiness turns true."""
+    count_tokens("") # Load the tiktoken encoding
+    catalog.get() # Load the catalog snapshot
+    generations.tags(None) # Open a pooled Redis connection and read the generation counters
+    mongo_collection.find_one({}, {'_id': 1}) # Open a pooled MongoDB connection
+
+
+startup = Startup(init_components, warm_up, imported_at=IMPORT_STARTED)
+
+
+# --- Synchronous Retrieval Function with Two-Tier Cache ---
+def build_context(query: str, k: int = 4, filter_criteria: dict = None, rerank_k: int = CONTEXT_CANDIDATES, query_embedding=None):
+    """
+    Retrieves with the active retrieval mode and re-ranks. Raises on failure.
+    vector: embeds query (unless already embedded), searches the configured retriever (Atlas or local HNSW) and re-ranks.
+    lexical: BM25 only, no embedding call. hybrid: reciprocal rank fusion of BM25 and re-ranked vector results.
+    auto: lexical when the BM25 match is confident, hybrid otherwise.
+    """
+    from rerank import rerank
+    from lexical import RRF_POOL_FACTOR, rrf_fuse
+    started = time.perf_counter()
+    lexical_hits = None
+    if retrieval_mode != "vector":
+        with stage("lexical_search"): lexical_hits, confidence = bm25_index.search(query, rerank_k * RRF_POOL_FACTOR, filter_criteria)
+        if retrieval_mode == "lexical" or (retrieval_mode == "auto" and bm25_index.is_confident(confidence)):
+            log.debug(f"Lexical retrieval: {len(lexical_hits)} hit(s), confidence {confidence:.3f}; skipping the embedding call.")
+            retrieval_latency.record("lexical", time.perf_counter() - started)
+            return format_context(lexical_hits[:rerank_k])
+
+    if retriever is None or embeddings is None: raise ValueError("Retriever or embeddings not initialized.")
+    if query_embedding is None:
+        with stage("embed_query"): query_embedding = embeddings.embed_query(query)
+    num_candidates_mongo = k * 5
+    candidate_chunks = retriever.search(query_embedding, num_candidates_mongo, filter_criteria) # Times vector_search / extract_candidates
+    log.debug(f"Extracted {len(candidate_chunks)} candidate chunks for re-ranking.")
+    with stage("rerank"):
+        if lexical_hits is None:
+            mode, top_chunks = "vector", rerank(query_embedding, candidate_chunks, rerank_k)
+        else:
+            vector_ranked = rerank(query_embedding, candidate_chunks, rerank_k * RRF_POOL_FACTOR)
+            mode, top_chunks = "hybrid", rrf_fuse([vector_ranked, lexical_hits], rerank_k)
+    log.debug(f"Top {len(top_chunks)} {mode} chunks selected.")
+    retrieval_latency.record(mode, time.perf_counter() - started)
+    return format_context(top_chunks)
+
+def retrieve_context(query: str, k: int = 4, filter_criteria: dict = None, rerank_k: int = CONTEXT_CANDIDATES, query_embedding=None, generation=None):
+    """
+    Returns context from the LRU/Redis cache, or builds it once per key (concurrent misses wait for that result).
+    `generation` is the context tag from generation_tags(); re-ingesting a matching book changes it.
+    """
+    # Generate cache key (hash of query + filter + generation tag)
+    cache_key = context_cache.key(context_cache_digest(query, filter_criteria, retrieval_mode, generation))
+    try:
+        context, source = context_cache.get_or_compute(cache_key, lambda: build_context(query, k, filter_criteria, rerank_k, query_embedding))
+        CACHE_EVENTS.inc(cache="context", result="miss" if source == "computed" else f"hit_{source}")
+        log.debug(f"Cache {'MISS' if source == 'computed' else 'HIT (' + source + ')'} for query: '{query}' with filter: {filter_criteria}")
+        return context
+    except Exception as e:
+        # Errors are never cached; every coalesced waiter sees the same failure
+        log.error(f"Error during MongoDB retrieval or re-ranking: {e}")
+        ERRORS.inc(stage="retrieval")
+        if "index not found" in str(e).lower() or "failed to find search index" in str(e).lower():
+             log.critical(f" Vector Search index '{INDEX_NAME}' not found or misconfigured in Atlas!")
+        return f"{CONTEXT_ERROR_PREFIX} from database: {e}"
+
+
+# --- Flask Blueprint (registered by create_app) ---
+api = Blueprint('api', __name__)
+
+@api.before_app_request
+def begin_request():
+    g.started = time.perf_counter()
+    g.trace_id = start_trace(request.headers.get(TRACE_HEADER))
+    # Readiness gate: in lazy mode this is what initializes the components; otherwise it waits up to INIT_WAIT_SECONDS
+    if request.endpoint in UNGATED_ENDPOINTS or request.method == 'OPTIONS' or startup.ensure_ready(): return None
+    status = startup.status()
+    response = jsonify({"error": "Service is starting up; try again shortly.", **status})
+    response.status_code = 503
+    response.headers['Retry-After'] = str(max(1, round(status["retry_in_seconds"] or 1)))
+    return response
+
+@api.after_app_request
+def finish_request(response):
+    """Request counters/latency per route (streams are timed until the response starts) and the trace id header."""
+    endpoint = request.url_rule.rule if request.url_rule else "unmatched"
+    REQUESTS.inc(endpoint=endpoint, status=response.status_code)
+    if 'started' in g: REQUEST_SECONDS.observe(time.perf_counter() - g.started, endpoint=endpoint)
+    if g.get('trace_id'): response.headers[TRACE_HEADER] = g.trace_id
+    return response
+
+# --- API Endpoints ---
+# Chat goes through the semantic answer cache, then retrieve_context (two-tier context cache) and the LLM;
+# /api/chat/stream sends the same answer as server-sent events.
+
+@api.route('/api/hello', methods=['GET'])
 def hello():
-    # ... (same) ...
     return jsonify({"message": "Hello from the PagePal Python backend!"})
 
-@app.route('/api/chat', methods=['POST'])
+@api.route('/metrics', methods=['GET'])
+def metrics():
+    """Prometheus scrape endpoint: stage latency histograms, cache/error/request counters (see metrics.py)."""
+    return Response(render_metrics(), content_type=METRICS_CONTENT_TYPE)
+
+@api.route('/healthz', methods=['GET'])
+def healthz():
+    """Liveness: the process is serving requests (components may still be initializing)."""
+    return jsonify({"status": "alive", "uptime_seconds": round(time.perf_counter() - IMPORT_STARTED, 1)})
+
+@api.route('/readyz', methods=['GET'])
+def readyz():
+    """Readiness: 200 once clients, retriever and indexes are built (and warmed up), 503 with the last error before that."""
+    ready = startup.ensure_ready(wait=False)
+    return jsonify({"status": "ready" if ready else "starting", **startup.status()}), 200 if ready else 503
+
+def lexical_fast_path(query, book_filter):
+    """True when this query will be answered from BM25 alone, so no query embedding is needed."""
+    if bm25_index is None or retrieval_mode not in ("lexical", "auto"): return False
+    if retrieval_mode == "lexical": return True
+    with stage("lexical_search"): _, confidence = bm25_index.search(query, 1, book_filter)
+    return bm25_index.is_confident(confidence)
+
+def generation_tags(book_filter):
+    """(context_tag, answer_tag) for the books a filter selects; (None, None) when generations are unavailable."""
+    if generations is None: return None, None
+    try: book_ids = catalog.get().matching_ids(book_filter) if catalog else None
+    except Exception as e: log.warning(f"Could not resolve books for filter {book_filter}: {e}"); book_ids = None
+    return generations.tags(book_ids)
+
+def lookup_cached_answer(query, book_filter, answer_tag=None):
+    """Semantic answer cache: exact repeat first (no embedding call), then nearest cached query.
+    Returns (cached_answer or None, query_embedding or None); the embedding is reused for retrieval on a miss."""
+    if not semantic_cache: return None, None
+    cached_answer = semantic_cache.lookup_exact(query, book_filter, answer_tag)
+    if cached_answer is not None:
+        CACHE_EVENTS.inc(cache="semantic", result="hit_exact")
+        log.debug("Semantic cache HIT (exact query).")
+        return cached_answer, None
+    if lexical_fast_path(query, book_filter): # Lexical-only retrieval: don't pay for an embedding
+        CACHE_EVENTS.inc(cache="semantic", result="skipped_lexical")
+        return None, None
+    with stage("embed_query"): query_embedding = embeddings.embed_query(query)
+    hit = semantic_cache.lookup(query_embedding, book_filter, answer_tag)
+    if hit:
+        cached_answer, similarity, matched_query = hit
+        CACHE_EVENTS.inc(cache="semantic", result="hit")
+        log.debug(f"Semantic cache HIT (similarity {similarity:.4f} to '{matched_query}').")
+        return cached_answer, query_embedding
+    CACHE_EVENTS.inc(cache="semantic", result="miss")
+    return None, query_embedding
+
+def cache_answer(query, query_embedding, book_filter, context, answer, answer_tag=None):
+    # Without an embedding (lexical fast path) the answer is still stored for exact repeats
+    if semantic_cache and not context.startswith(CONTEXT_ERROR_PREFIX):
+        semantic_cache.store(query, query_embedding, book_filter, answer, answer_tag)
+
+@api.route('/api/chat', methods=['POST'])
 def chat():
     if not rag_chain: return jsonify({"error": "RAG chain not initialized."}), 500
     data = request.get_json(); query = data.get('query'); book_filter = data.get('book_filter')
     if not query: return jsonify({"error": "Missing 'query' in request body"}), 400
-    # Prepare input dict for the synchronous chain
-    input_dict = {"query": query, "filter": book_filter, "book_title": book_filter.get("title", "this book") if book_filter else "this book"}
+    book_title = book_title_for(book_filter)
     try:
-        print(f"Received query: {query}" + (f" | Filter: {book_filter}" if book_filter else ""))
-        # Invoke the synchronous RAG chain
-        answer = rag_chain.invoke(input_dict)
-        print(f"Generated answer: {answer}")
+        log.info(f"Received query: {query}" + (f" | Filter: {book_filter}" if book_filter else ""))
+        context_tag, answer_tag = generation_tags(book_filter)
+        cached_answer, query_embedding = lookup_cached_answer(query, book_filter, answer_tag)
+        if cached_answer is not None: return jsonify({"answer": cached_answer, "cached": True})
+
+        context = retrieve_context(query, filter_criteria=book_filter, query_embedding=query_embedding, generation=context_tag)
+        with stage("llm"): answer = answer_chain.invoke({"context": context, "question": query, "book_title": book_title})
+        log.debug(f"Generated answer: {answer}")
+        cache_answer(query, query_embedding, book_filter, context, answer, answer_tag)
         return jsonify({"answer": answer})
-    except Exception as e: print(f"Error processing chat request: {e}"); return jsonify({"error": "An error occurred processing your request."}), 500
+    except Exception as e: log.error(f"Error processing chat request: {e}"); ERRORS.inc(stage="chat"); return jsonify({"error": "An error occurred processing your request."}), 500
+
+def sse_event(event, payload):
+    """Formats one Server-Sent Event frame."""
+    return f"event: {event}\ndata: {json.dumps(payload)}\n\n"
+
+@api.route('/api/chat/stream', methods=['POST'])
+def chat_stream():
+    """Streaming /api/chat: 'status' events, then LLM 'token' events, then 'done' (or 'error')."""
+    if not rag_chain: return jsonify({"error": "RAG chain not initialized."}), 500
+    data = request.get_json(); query = data.get('query'); book_filter = data.get('book_filter')
+    if not query: return jsonify({"error": "Missing 'query' in request body"}), 400
+    book_title = book_title_for(book_filter)
 
-# --- Other endpoints remain the same ---
-@app.route('/api/books', methods=['GET'])
+    def generate():
+        try:
+            log.info(f"Received streaming query: {query}" + (f" | Filter: {book_filter}" if book_filter else ""))
+            yield sse_event("status", {"stage": "retrieving"})
+            context_tag, answer_tag = generation_tags(book_filter)
+            cached_answer, query_embedding = lookup_cached_answer(query, book_filter, answer_tag)
+            if cached_answer is not None:
+                yield sse_event("token", {"text": cached_answer})
+                yield sse_event("done", {"cached": True})
+                return
+
+            context = retrieve_context(query, filter_criteria=book_filter, query_embedding=query_embedding, generation=context_tag)
+            yield sse_event("status", {"stage": "generating"})
+            answer_parts = []
+            started = time.perf_counter()
+            for token in answer_chain.stream({"context": context, "question": query, "book_title": book_title}):
+                if not answer_parts: STAGE_SECONDS.observe(time.perf_counter() - started, stage="llm_first_token")
+                answer_parts.append(token)
+                yield sse_event("token", {"text": token})
+            STAGE_SECONDS.observe(time.perf_counter() - started, stage="llm")
+            # Only a stream that ran to completion populates the answer cache
+            cache_answer(query, query_embedding, book_filter, context, "".join(answer_parts), answer_tag)
+            yield sse_event("done", {"cached": False})
+        except Exception as e:
+            log.error(f"Error processing streaming chat request: {e}")
+            ERRORS.inc(stage="chat_stream")
+            yield sse_event("error", {"error": "An error occurred processing your request."})
+
+    return Response(stream_with_context(generate()), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+def batch_retrieve(batch, answer_tag):
+    """Fills batch contexts: cached answers first, then BM25, then one embed_documents call and one chunk fetch."""
+    from lexical import RRF_POOL_FACTOR
+    book_filter = batch.book_filter
+    if semantic_cache:
+        for index in batch.pending():
+            cached_answer = semantic_cache.lookup_exact(batch.questions[index], book_filter, answer_tag)
+            if cached_answer is not None: batch.answer(index, cached_answer, cached=True)
+    if bm25_index is not None and retrieval_mode != "vector":
+        for index in batch.pending():
+            with stage("lexical_search"): hits, confidence = bm25_index.search(batch.questions[index], CONTEXT_CANDIDATES * RRF_POOL_FACTOR, book_filter)
+            batch.add_lexical(index, hits, retrieval_mode == "lexical" or (retrieval_mode == "auto" and bm25_index.is_confident(confidence)))
+
+    vector_indices = batch.needs_vectors()
+    if not vector_indices: return
+    with stage("embed_documents"): vectors = embeddings.embed_documents([batch.questions[index] for index in vector_indices]) # One embedding call for the batch
+    for index, vector in zip(vector_indices, vectors):
+        batch.embeddings[index] = vector
+        hit = semantic_cache.lookup(vector, book_filter, answer_tag) if semantic_cache else None
+        if hit: batch.answer(index, hit[0], cached=True)
+
+    vector_indices = batch.needs_vectors()
+    if not vector_indices: return
+    try:
+        chunks = retriever.fetch_chunks(book_filter) # One fetch of the book's chunks, scored against every question at once
+        log.debug(f"Batch retrieval: {len(chunks)} chunk(s) fetched for {len(vector_indices)} question(s).")
+        with stage("rerank"): batch.rank(vector_indices, chunks)
+    except Exception as e:
+        log.error(f"Error during batch retrieval: {e}")
+        ERRORS.inc(stage="retrieval")
+        for index in vector_indices: batch.fail(index, str(e) if isinstance(e, ValueError) else "An error occurred retrieving context.")
+
+@api.route('/api/chat/batch', methods=['POST'])
+def chat_batch():
+    """Many questions about the same book(s): {"questions": [...], "book_filter": {...}}.
+    Returns {"results": [...]} in input order, each with an "answer" or a per-question "error"."""
+    from chat_batch import ChatBatch, CHAT_BATCH_CONCURRENCY
+    if not rag_chain: return jsonify({"error": "RAG chain not initialized."}), 500
+    try: batch = ChatBatch.from_request(request.get_json(silent=True))
+    except ValueError as e: return jsonify({"error": str(e)}), 400
+    try:
+        log.info(f"Received batch of {len(batch.questions)} question(s) | Filter: {batch.book_filter}")
+        _, answer_tag = generation_tags(batch.book_filter)
+        batch_retrieve(batch, answer_tag)
+        indices, inputs = batch.generation_inputs(book_title_for(batch.book_filter))
+        if inputs:
+            with stage("llm_batch"): outputs = answer_chain.batch(inputs, config={"max_concurrency": CHAT_BATCH_CONCURRENCY}, return_exceptions=True)
+            for index in batch.add_answers(indices, outputs):
+                cache_answer(batch.questions[index], batch.embeddings.get(index), batch.book_filter, batch.contexts[index], batch.results[index]["answer"], answer_tag)
+        return jsonify(batch.response())
+    except Exception as e: log.error(f"Error processing batch chat request: {e}"); ERRORS.inc(stage="chat_batch"); return jsonify({"error": "An error occurred processing your request."}), 500
+
+@api.route('/api/cache/stats', methods=['GET'])
+def cache_stats():
+    stats = {"semantic": semantic_cache.stats() if semantic_cache else None}
+    if context_cache:
+        stats["context"] = {"local_entries": len(context_cache.lru), "redis_breaker": context_cache.breaker.state}
+    if catalog: stats["catalog"] = catalog.stats()
+    return jsonify(stats)
+
+@api.route('/api/retrieval/stats', methods=['GET'])
+def retrieval_stats():
+    """Active retrieval mode and per-mode build_context latency (cache misses only)."""
+    return jsonify({"mode": retrieval_mode, "bm25_chunks": len(bm25_index) if bm25_index is not None else 0,
+                    "latency": retrieval_latency.snapshot(), "index_refresh": index_refresher.stats() if index_refresher else None})
+
+# --- Admin: cache generations (see generations.py) ---
+def admin_denied():
+    """Error response unless ADMIN_TOKEN is configured and sent in X-Admin-Token."""
+    if not ADMIN_TOKEN: return jsonify({"error": "Admin endpoints are disabled (ADMIN_TOKEN not set)."}), 403
+    if request.headers.get('X-Admin-Token') != ADMIN_TOKEN: return jsonify({"error": "Invalid admin token."}), 403
+    return None
+
+@api.route('/api/admin/generations', methods=['GET', 'POST'])
+def admin_generations():
+    """GET: current counters (?book_id= repeatable; defaults to every catalog book).
+    POST {"scope": "book"|"corpus"|"model"|"prompt", "book_id": ...}: bump one, retiring the cache entries it versions."""
+    denied = admin_denied()
+    if denied: return denied
+    if generations is None: return jsonify({"error": "Cache not initialized."}), 500
+    if request.method == 'GET':
+        book_ids = request.args.getlist('book_id') or ([book['_id'] for book in catalog.get().books] if catalog else [])
+        return jsonify(generations.describe(book_ids))
+    data = request.get_json(silent=True) or {}
+    try: generation = generations.bump(data.get('scope'), data.get('book_id'))
+    except ValueError as e: return jsonify({"error": str(e)}), 400
+    if generation is None: return jsonify({"error": "Redis unavailable; generation not bumped."}), 503
+    log.info(f"Admin bumped '{data.get('scope')}' generation" + (f" for book {data['book_id']}" if data.get('book_id') else "") + f" to {generation}.")
+    return jsonify({"scope": data.get('scope'), "book_id": data.get('book_id'), "generation": generation})
+
+# --- Catalog endpoints (served from the in-memory snapshot, see catalog.py) ---
+def catalog_response(payload, etag, next_cursor=None):
+    """JSON response with an ETag (304 when the client's copy is current) and the next-page cursor, if any."""
+    from catalog import etag_matches
+    response = Response(status=304) if etag_matches(request.headers.get('If-None-Match'), etag) else jsonify(payload)
+    response.headers['ETag'] = etag
+    response.headers['Cache-Control'] = 'no-cache' # Revalidate every time; unchanged pages cost a 304
+    if next_cursor: response.headers['X-Next-Cursor'] = next_cursor
+    return response
+
+@api.route('/api/books', methods=['GET'])
 def get_books():
-    # ... (same as app_py_mongodb_v8_fixed_indent) ...
-    if mongo_collection is None: return jsonify({"error": "Database connection not initialized."}), 500
+    """All books, or one genre (case-insensitive). Optional ?limit=&cursor= pagination; the next cursor is in X-Next-Cursor."""
+    from catalog import parse_page_args
+    if catalog is None: return jsonify({"error": "Database connection not initialized."}), 500
     genre = request.args.get('genre')
-    query_filter = {}
-    if genre:
-        try: regex = re.compile(f'^{re.escape(genre)}$', re.IGNORECASE); query_filter['genre'] = regex; print(f"Fetching books for genre (case-insensitive): {genre}")
-        except re.error as re_err: print(f"Error creating regex for genre '{genre}': {re_err}"); query_filter['genre'] = genre; print(f"Regex failed, falling back to exact match for genre: {genre}")
-    else: print("Fetching all books")
+    try: cursor, limit = parse_page_args(request.args.get('cursor'), request.args.get('limit'))
+    except ValueError as e: return jsonify({"error": f"Invalid pagination parameters: {e}"}), 400
     try:
-        books_cursor = mongo_collection.find(query_filter, {'_id': 1, 'title': 1, 'author': 1, 'genre': 1})
-        books_list = []; [books_list.append({**book, '_id': str(book['_id'])}) for book in books_cursor]; print(f"Found {len(books_list)} books."); return jsonify(books_list)
-    except Exception as e: print(f"Error fetching books from MongoDB: {e}"); return jsonify({"error": "An error occurred fetching books."}), 500
+        snapshot = catalog.get()
+        books, next_cursor = snapshot.list_books(genre, cursor, limit)
+        log.debug(f"Serving {len(books)} books" + (f" for genre: {genre}" if genre else "") + (f" (next cursor: {next_cursor})" if next_cursor else ""))
+        return catalog_response(books, snapshot.response_etag('books', genre.lower() if genre else None, cursor, limit), next_cursor)
+    except Exception as e: log.error(f"Error fetching books from MongoDB: {e}"); ERRORS.inc(stage="catalog_books"); return jsonify({"error": "An error occurred fetching books."}), 500
 
-@app.route('/api/genres', methods=['GET'])
+@api.route('/api/genres', methods=['GET'])
 def get_genres():
-    # ... (same as app_py_mongodb_v8_fixed_indent) ...
-     if mongo_collection is None: return jsonify({"error": "Database connection not initialized."}), 500
-     try: print("Fetching distinct genres..."); genres = mongo_collection.distinct("genre", {"genre": {"$ne": None, "$ne": ""}}); print(f"Found genres: {genres}"); return jsonify(sorted(genres))
-     except Exception as e: print(f"Error fetching genres from MongoDB: {e}"); return jsonify({"error": "An error occurred fetching genres."}), 500
+    if catalog is None: return jsonify({"error": "Database connection not initialized."}), 500
+    try:
+        snapshot = catalog.get()
+        return catalog_response(snapshot.genres, snapshot.response_etag('genres'))
+    except Exception as e: log.error(f"Error fetching genres from MongoDB: {e}"); ERRORS.inc(stage="catalog_genres"); return jsonify({"error": "An error occurred fetching genres."}), 500
 
-@app.route('/api/books/<book_id>', methods=['GET'])
+@api.route('/api/books/<book_id>', methods=['GET'])
 def get_book_details(book_id):
-    # ... (same as app_py_mongodb_v8_fixed_indent) ...
-    if mongo_collection is None: return jsonify({"error": "Database connection not initialized."}), 500
-    try: obj_id = ObjectId(book_id)
+    from bson import ObjectId
+    from bson.errors import InvalidId
+    if catalog is None: return jsonify({"error": "Database connection not initialized."}), 500
+    try: ObjectId(book_id)
     except InvalidId: return jsonify({"error": "Invalid book ID format."}), 400
     try:
-        print(f"Fetching details for book ID: {book_id}"); book = mongo_collection.find_one({'_id': obj_id}, {'_id': 1, 'title': 1, 'author': 1, 'genre': 1})
-        if book: book['_id'] = str(book['_id']); print(f"Found book details: {book}"); return jsonify(book)
-        else: return jsonify({"error": "Book not found."}), 404
-    except Exception as e: print(f"Error fetching book details from MongoDB: {e}"); return jsonify({"error": "An error occurred fetching book details."}), 500
+        snapshot = catalog.get()
+        book = snapshot.by_id.get(book_id)
+        if book is None: return jsonify({"error": "Book not found."}), 404
+        return catalog_response(book, snapshot.response_etag('book', book_id))
+    except Exception as e: log.error(f"Error fetching book details from MongoDB: {e}"); ERRORS.inc(stage="catalog_book"); return jsonify({"error": "An error occurred fetching book details."}), 500
+
+# --- App Factory ---
+def create_app(startup_mode=None):
+    """Returns the Flask app straight away; components are built per STARTUP_MODE (see startup.py)."""
+    flask_app = Flask(__name__)
+    CORS(flask_app, expose_headers=['ETag', 'X-Next-Cursor', TRACE_HEADER])
+    flask_app.register_blueprint(api)
+    startup.start(startup_mode)
+    return flask_app
+
+startup.mark_imported()
+app = create_app() # For `flask run` / gunicorn app:app (with --preload, each worker re-initializes after the fork)
 
 # --- Main Execution ---
 if __name__ == '__main__':
-    # Removed the asyncio.run(initialize_mongo()) call
-    # Initialization now happens synchronously at the top level try/except block
     port = int(os.environ.get('PORT', 5000))
-    # Make sure rag_chain was initialized before running
-    if rag_chain is None:
-         print("FATAL: RAG Chain failed to initialize. Cannot start Flask app.")
-         sys.exit(1)
     app.run(debug=True, port=port)
-
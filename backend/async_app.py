@@ -0,0 +1,624 @@
+# backend/async_app.py
+# Async serving mode (FastAPI + uvicorn). Mongo, Redis and OpenAI calls are awaited
+# instead of blocking a worker, so one process can hold hundreds of in-flight chats.
+# Query embeddings from concurrent requests are micro-batched into one embed_documents call.
+#
+# Run:  uvicorn async_app:app --port 5000   (or: uvicorn --factory async_app:create_app)
+# Same endpoints and JSON as app.py; the Flask app stays the default for existing deployments.
+# Like app.py, the app starts serving at once: components are built by startup.AsyncStartup
+# (STARTUP_MODE) and /readyz turns 200 when they are ready.
+
+# --- Imports ---
+import time
+IMPORT_STARTED = time.perf_counter() # Import-to-ready time is measured from here
+import os
+import json
+import asyncio
+import inspect
+from contextlib import asynccontextmanager
+from fastapi import APIRouter, FastAPI, Request
+from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from dotenv import load_dotenv
+from metrics import CACHE_EVENTS, ERRORS, METRICS_CONTENT_TYPE, REQUESTS, REQUEST_SECONDS, STAGE_SECONDS, TRACE_HEADER, get_logger, render_metrics, stage, start_trace
+from startup import INDEX_REFRESH_ENABLED, AsyncStartup, IndexRefresher
+from rag import EMBEDDING_MODEL, LLM_MODEL, RAG_TEMPLATE, CONTEXT_ERROR_PREFIX, CONTEXT_CANDIDATES, book_title_for, context_cache_digest, count_tokens, format_context
+
+load_dotenv()
+log = get_logger("async_app")
+
+# --- Configuration ---
+MONGO_URI = os.getenv("MONGO_URI")
+DB_NAME = "books"
+COLLECTION_NAME = "books"
+INDEX_NAME = "vector_index"
+REDIS_HOST = os.getenv("REDIS_HOST", "localhost")
+REDIS_PORT = int(os.getenv("REDIS_PORT", 6379))
+CONTEXT_CACHE_TTL_SECONDS = int(os.getenv("CONTEXT_CACHE_TTL_SECONDS", 86400)) # Keys are generation-tagged (generations.py)
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN") # Enables /api/admin/* (sent as X-Admin-Token)
+EMBED_BATCH_MAX_SIZE = int(os.getenv("EMBED_BATCH_MAX_SIZE", 64)) # Flush as soon as this many queries are waiting
+EMBED_BATCH_MAX_WAIT_MS = float(os.getenv("EMBED_BATCH_MAX_WAIT_MS", 5)) # ...or this long after the first one arrived
+UNGATED_PATHS = {"/api/hello", "/metrics", "/healthz", "/readyz"} # Served before components are ready
+
+
+# --- Async Mongo Helpers ---
+def make_async_mongo_client(uri):
+    """PyMongo's native async client (>= 4.9), falling back to Motor."""
+    try:
+        from pymongo import AsyncMongoClient
+    except ImportError:
+        from motor.motor_asyncio import AsyncIOMotorClient as AsyncMongoClient
+    return AsyncMongoClient(uri)
+
+
+async def aggregate_to_list(collection, pipeline):
+    cursor = collection.aggregate(pipeline)
+    if inspect.isawaitable(cursor): cursor = await cursor # PyMongo async returns the cursor from a coroutine
+    return await cursor.to_list(length=None)
+
+
+async def find_to_list(collection, query, projection):
+    return await collection.find(query, projection).to_list(length=None)
+
+
+# --- Query Embedding Micro-Batcher ---
+class QueryEmbeddingBatcher:
+    """Collects embed_query calls arriving within max_wait_ms into one embed_documents request."""
+
+    def __init__(self, embeddings, max_batch_size=EMBED_BATCH_MAX_SIZE, max_wait_ms=EMBED_BATCH_MAX_WAIT_MS):
+        self.embeddings = embeddings
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self._pending = [] # (text, future)
+        self._timer = None
+        self._tasks = set() # In-flight flushes: the loop only holds tasks weakly
+        self.batches = 0
+        self.queries = 0
+
+    async def embed(self, text):
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((text, future))
+        if len(self._pending) >= self.max_batch_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.max_wait, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if not batch: return
+        task = asyncio.get_running_loop().create_task(self._run(batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, batch):
+        texts = list(dict.fromkeys(text for text, _ in batch)) # Identical queries share one input
+        self.batches += 1; self.queries += len(batch)
+        try:
+            vectors = dict(zip(texts, await self.embeddings.aembed_documents(texts)))
+            for text, future in batch:
+                if not future.done(): future.set_result(vectors[text])
+        except Exception as e:
+            for _, future in batch:
+                if not future.done(): future.set_exception(e)
+
+    def stats(self):
+        return {"batches": self.batches, "queries": self.queries, "avg_batch_size": self.queries / self.batches if self.batches else 0.0}
+
+
+# --- Components (built by init_components) ---
+mongo_client = None
+mongo_collection = None
+redis_client = None
+retriever = None
+embeddings = None
+batcher = None
+answer_chain = None
+context_cache = None
+semantic_cache = None
+bm25_index = None
+retrieval_mode = "vector"
+retrieval_latency = None
+catalog = None
+generations = None
+index_refresher = None
+
+
+async def close_clients():
+    global redis_client, mongo_client
+    if redis_client is not None: await redis_client.aclose(close_connection_pool=True) # The pool was passed in, so aclose() alone keeps it
+    if mongo_client is not None:
+        closed = mongo_client.close()
+        if inspect.isawaitable(closed): await closed
+    redis_client = mongo_client = None
+
+
+async def init_components():
+    """Async counterpart of app.init_components. Raises on failure; startup retries with backoff."""
+    try:
+        await build_components()
+    except Exception:
+        await close_clients() # Otherwise every retry would leak the failed attempt's Redis pool and MongoClient
+        raise
+
+
+async def build_components():
+    global mongo_client, mongo_collection, redis_client, retriever, embeddings, batcher, answer_chain, context_cache, semantic_cache, \
+        bm25_index, retrieval_mode, retrieval_latency, catalog, generations, index_refresher
+    from langchain_openai import ChatOpenAI, OpenAIEmbeddings
+    from langchain.prompts import PromptTemplate
+    from langchain.schema.output_parser import StrOutputParser
+    from retrievers import build_retriever, RETRIEVER_BACKEND
+    from storage import STORAGE_LAYOUT, CHUNK_COLLECTION_NAME
+    from cache import AsyncTwoTierCache, make_async_redis_client
+    from semantic_cache import SemanticCache, SEMANTIC_CACHE_ENABLED
+    from generations import AsyncGenerations, fingerprint
+    from catalog import AsyncCatalog, CATALOG_PROJECTION, CATALOG_QUERY, CATALOG_VERSION_KEY
+    from lexical import RETRIEVAL_MODE, LatencyStats, check_mode, load_index
+    if not MONGO_URI: raise ValueError("MONGO_URI not found in .env file.")
+    redis_client = make_async_redis_client(REDIS_HOST, REDIS_PORT)
+    context_cache = AsyncTwoTierCache(redis_client, ttl=CONTEXT_CACHE_TTL_SECONDS)
+    try:
+        await redis_client.ping()
+        log.info(f"Redis connection successful to {REDIS_HOST}:{REDIS_PORT}.")
+    except Exception as redis_err:
+        log.warning(f"Redis connection failed: {redis_err}. Serving from the in-process cache until it recovers.")
+        context_cache.breaker.trip()
+    generations = AsyncGenerations(context_cache, EMBEDDING_MODEL, fingerprint(LLM_MODEL, RAG_TEMPLATE))
+    if semantic_cache is None and SEMANTIC_CACHE_ENABLED: semantic_cache = SemanticCache()
+    if retrieval_latency is None: retrieval_latency = LatencyStats()
+
+    mongo_client = make_async_mongo_client(MONGO_URI)
+    db = mongo_client[DB_NAME]
+    mongo_collection = db[COLLECTION_NAME]
+    await mongo_client.admin.command('ping')
+    log.info("MongoDB (async) connection successful.")
+    index_refresher = IndexRefresher(refresh_indexes) # Refreshes the local search indexes when the corpus generation changes
+    catalog = AsyncCatalog(lambda: find_to_list(mongo_collection, CATALOG_QUERY, CATALOG_PROJECTION),
+                           lambda: context_cache.shared_call("get", CATALOG_VERSION_KEY),
+                           on_change=index_refresher.request if INDEX_REFRESH_ENABLED else log_stale_indexes)
+
+    # Atlas retriever only builds pipelines here; the aggregate itself is awaited in build_context
+    retriever = build_retriever(RETRIEVER_BACKEND, mongo_collection, INDEX_NAME, layout=STORAGE_LAYOUT, chunk_collection=db[CHUNK_COLLECTION_NAME])
+    log.info(f"Using '{retriever.name}' retriever backend ({STORAGE_LAYOUT} storage layout).")
+    retrieval_mode = check_mode(RETRIEVAL_MODE)
+    bm25_index = await asyncio.to_thread(load_index, retrieval_mode)
+    if bm25_index is None: retrieval_mode = "vector"
+    log.info(f"Retrieval mode: {retrieval_mode}.")
+
+    embeddings = OpenAIEmbeddings(model=EMBEDDING_MODEL)
+    batcher = QueryEmbeddingBatcher(embeddings)
+    llm = ChatOpenAI(model_name=LLM_MODEL, temperature=0.1)
+    answer_chain = PromptTemplate.from_template(RAG_TEMPLATE) | llm | StrOutputParser()
+    log.info("RAG components initialized (async, micro-batched query embeddings).")
+
+
+def refresh_indexes():
+    """Sync counterpart of app.refresh_indexes, run on index_refresher's thread: the HNSW update reads
+    MongoDB through a short-lived synchronous client rather than the event loop's async one."""
+    global retriever, bm25_index, retrieval_mode
+    from pymongo import MongoClient
+    from retrievers import refresh_retriever
+    from storage import STORAGE_LAYOUT, CHUNK_COLLECTION_NAME
+    from lexical import RETRIEVAL_MODE, check_mode, load_index
+    if retriever.name == "hnsw":
+        client = MongoClient(MONGO_URI)
+        try:
+            db = client[DB_NAME]
+            retriever = refresh_retriever(retriever, db[COLLECTION_NAME], STORAGE_LAYOUT, db[CHUNK_COLLECTION_NAME])
+        finally:
+            client.close()
+    mode = check_mode(RETRIEVAL_MODE)
+    index = load_index(mode) # Re-merges the BM25 segments ingestion wrote since the last load
+    if index is not None: bm25_index, retrieval_mode = index, mode
+
+
+def log_stale_indexes(version):
+    if retriever is not None and retriever.name == "hnsw":
+        log.warning(f"Corpus changed (generation {version}) but INDEX_REFRESH_ENABLED is off: the HNSW index misses "
+                    "the new books until it is rebuilt (python retrievers.py build) and the server restarted.")
+    if bm25_index is not None:
+        log.warning(f"Corpus changed (generation {version}) but INDEX_REFRESH_ENABLED is off: the BM25 index misses "
+                    "the new books until the server restarts.")
+
+
+async def warm_up():
+    """Optional (STARTUP_WARMUP): pays the first request's one-off costs before readiness turns true."""
+    await asyncio.to_thread(count_tokens, "") # Load the tiktoken encoding
+    await catalog.get() # Load the catalog snapshot
+    await generations.tags(None) # Open a pooled Redis connection and read the generation counters
+    await mongo_collection.find_one({}, {'_id': 1}) # Open a pooled MongoDB connection
+
+
+startup = AsyncStartup(init_components, warm_up, imported_at=IMPORT_STARTED)
+
+
+@asynccontextmanager
+async def lifespan(app):
+    await startup.start(app.state.startup_mode) # "eager" finishes one attempt before serving
+    yield
+    await startup.stop()
+    await close_clients()
+
+
+# --- Retrieval ---
+async def build_context(query, k=4, filter_criteria=None, rerank_k=CONTEXT_CANDIDATES, query_embedding=None):
+    """Async counterpart of app.build_context (same vector / lexical / hybrid / auto modes)."""
+    from retrievers import AtlasVectorRetriever
+    from rerank import rerank
+    from lexical import RRF_POOL_FACTOR, rrf_fuse
+    started = time.perf_counter()
+    lexical_hits = None
+    if retrieval_mode != "vector":
+        with stage("lexical_search"): lexical_hits, confidence = await asyncio.to_thread(bm25_index.search, query, rerank_k * RRF_POOL_FACTOR, filter_criteria)
+        if retrieval_mode == "lexical" or (retrieval_mode == "auto" and bm25_index.is_confident(confidence)):
+            retrieval_latency.record("lexical", time.perf_counter() - started)
+            return await asyncio.to_thread(format_context, lexical_hits[:rerank_k])
+    if query_embedding is None:
+        with stage("embed_query"): query_embedding = await batcher.embed(query) # Includes the micro-batch wait
+    limit = k * 5
+    if isinstance(retriever, AtlasVectorRetriever):
+        with stage("vector_search"): results = await aggregate_to_list(retriever.collection, retriever.build_pipeline(query_embedding, limit, filter_criteria))
+        log.debug(f"MongoDB $vectorSearch returned {len(results)} result(s).")
+        with stage("extract_candidates"): candidate_chunks = retriever.extract_candidates(results)
+    else:
+        candidate_chunks = await asyncio.to_thread(retriever.search, query_embedding, limit, filter_criteria)
+    # Decoding + scoring thousands of embeddings is CPU work; keep it off the event loop
+    with stage("rerank"):
+        if lexical_hits is None:
+            mode, top_chunks = "vector", await asyncio.to_thread(rerank, query_embedding, candidate_chunks, rerank_k)
+        else:
+            vector_ranked = await asyncio.to_thread(rerank, query_embedding, candidate_chunks, rerank_k * RRF_POOL_FACTOR)
+            mode, top_chunks = "hybrid", rrf_fuse([vector_ranked, lexical_hits], rerank_k)
+    retrieval_latency.record(mode, time.perf_counter() - started)
+    return await asyncio.to_thread(format_context, top_chunks) # tiktoken counting is CPU work too
+
+
+async def retrieve_context(query, k=4, filter_criteria=None, rerank_k=CONTEXT_CANDIDATES, query_embedding=None, generation=None):
+    cache_key = context_cache.key(context_cache_digest(query, filter_criteria, retrieval_mode, generation))
+    try:
+        context, source = await context_cache.get_or_compute(cache_key, lambda: build_context(query, k, filter_criteria, rerank_k, query_embedding))
+        CACHE_EVENTS.inc(cache="context", result="miss" if source == "computed" else f"hit_{source}")
+        log.debug(f"Cache {'MISS' if source == 'computed' else 'HIT (' + source + ')'} for query: '{query}' with filter: {filter_criteria}")
+        return context
+    except Exception as e:
+        log.error(f"Error during MongoDB retrieval or re-ranking: {e}")
+        ERRORS.inc(stage="retrieval")
+        return f"{CONTEXT_ERROR_PREFIX} from database: {e}"
+
+
+async def lexical_fast_path(query, book_filter):
+    """True when this query will be answered from BM25 alone, so no query embedding is needed."""
+    if bm25_index is None or retrieval_mode not in ("lexical", "auto"): return False
+    if retrieval_mode == "lexical": return True
+    with stage("lexical_search"): _, confidence = await asyncio.to_thread(bm25_index.search, query, 1, book_filter)
+    return bm25_index.is_confident(confidence)
+
+
+async def generation_tags(book_filter):
+    """Async counterpart of app.generation_tags: (context_tag, answer_tag), or (None, None)."""
+    if generations is None: return None, None
+    try: book_ids = (await catalog.get()).matching_ids(book_filter) if catalog else None
+    except Exception as e: log.warning(f"Could not resolve books for filter {book_filter}: {e}"); book_ids = None
+    return await generations.tags(book_ids)
+
+
+async def lookup_cached_answer(query, book_filter, answer_tag=None):
+    """Async counterpart of app.lookup_cached_answer: (cached_answer or None, query_embedding or None)."""
+    if not semantic_cache: return None, None
+    cached_answer = semantic_cache.lookup_exact(query, book_filter, answer_tag)
+    if cached_answer is not None:
+        CACHE_EVENTS.inc(cache="semantic", result="hit_exact")
+        return cached_answer, None
+    if await lexical_fast_path(query, book_filter):
+        CACHE_EVENTS.inc(cache="semantic", result="skipped_lexical")
+        return None, None
+    with stage("embed_query"): query_embedding = await batcher.embed(query)
+    hit = semantic_cache.lookup(query_embedding, book_filter, answer_tag)
+    CACHE_EVENTS.inc(cache="semantic", result="hit" if hit else "miss")
+    if hit: return hit[0], query_embedding
+    return None, query_embedding
+
+
+def cache_answer(query, query_embedding, book_filter, context, answer, answer_tag=None):
+    # Without an embedding (lexical fast path) the answer is still stored for exact repeats
+    if semantic_cache and not context.startswith(CONTEXT_ERROR_PREFIX):
+        semantic_cache.store(query, query_embedding, book_filter, answer, answer_tag)
+
+
+def sse_event(event, payload):
+    return f"event: {event}\ndata: {json.dumps(payload)}\n\n"
+
+
+# --- FastAPI Router (included by create_app) ---
+router = APIRouter()
+
+
+async def observe_request(request: Request, call_next):
+    """Trace id (set before the handler runs, so its log lines carry it), the readiness gate, and request counters/latency per route."""
+    trace_id = start_trace(request.headers.get(TRACE_HEADER))
+    started = time.perf_counter()
+    # Readiness gate: in lazy mode this is what initializes the components; otherwise it waits up to INIT_WAIT_SECONDS
+    if request.url.path in UNGATED_PATHS or request.method == 'OPTIONS' or await startup.ensure_ready():
+        response = await call_next(request)
+    else:
+        status = startup.status()
+        response = JSONResponse({"error": "Service is starting up; try again shortly.", **status}, status_code=503,
+                                headers={'Retry-After': str(max(1, round(status["retry_in_seconds"] or 1)))})
+    route = request.scope.get("route")
+    endpoint = route.path if route is not None else "unmatched"
+    REQUESTS.inc(endpoint=endpoint, status=response.status_code)
+    REQUEST_SECONDS.observe(time.perf_counter() - started, endpoint=endpoint)
+    if trace_id: response.headers[TRACE_HEADER] = trace_id
+    return response
+
+
+def error(message, status):
+    return JSONResponse({"error": message}, status_code=status)
+
+
+@router.get('/api/hello')
+async def hello():
+    return {"message": "Hello from the PagePal Python backend!"}
+
+
+@router.get('/metrics')
+async def metrics():
+    return Response(render_metrics(), media_type=METRICS_CONTENT_TYPE)
+
+
+@router.get('/healthz')
+async def healthz():
+    """Liveness: the process is serving requests (components may still be initializing)."""
+    return {"status": "alive", "uptime_seconds": round(time.perf_counter() - IMPORT_STARTED, 1)}
+
+
+@router.get('/readyz')
+async def readyz():
+    """Readiness: 200 once clients, retriever and indexes are built (and warmed up), 503 with the last error before that."""
+    ready = await startup.ensure_ready(wait=False)
+    return JSONResponse({"status": "ready" if ready else "starting", **startup.status()}, status_code=200 if ready else 503)
+
+
+@router.post('/api/chat')
+async def chat(request: Request):
+    if answer_chain is None: return error("RAG chain not initialized.", 500)
+    data = await request.json(); query = data.get('query'); book_filter = data.get('book_filter')
+    if not query: return error("Missing 'query' in request body", 400)
+    try:
+        context_tag, answer_tag = await generation_tags(book_filter)
+        cached_answer, query_embedding = await lookup_cached_answer(query, book_filter, answer_tag)
+        if cached_answer is not None: return {"answer": cached_answer, "cached": True}
+        context = await retrieve_context(query, filter_criteria=book_filter, query_embedding=query_embedding, generation=context_tag)
+        with stage("llm"): answer = await answer_chain.ainvoke({"context": context, "question": query, "book_title": book_title_for(book_filter)})
+        cache_answer(query, query_embedding, book_filter, context, answer, answer_tag)
+        return {"answer": answer}
+    except Exception as e:
+        log.error(f"Error processing chat request: {e}")
+        ERRORS.inc(stage="chat")
+        return error("An error occurred processing your request.", 500)
+
+
+@router.post('/api/chat/stream')
+async def chat_stream(request: Request):
+    if answer_chain is None: return error("RAG chain not initialized.", 500)
+    data = await request.json(); query = data.get('query'); book_filter = data.get('book_filter')
+    if not query: return error("Missing 'query' in request body", 400)
+
+    async def generate():
+        try:
+            yield sse_event("status", {"stage": "retrieving"})
+            context_tag, answer_tag = await generation_tags(book_filter)
+            cached_answer, query_embedding = await lookup_cached_answer(query, book_filter, answer_tag)
+            if cached_answer is not None:
+                yield sse_event("token", {"text": cached_answer})
+                yield sse_event("done", {"cached": True})
+                return
+            context = await retrieve_context(query, filter_criteria=book_filter, query_embedding=query_embedding, generation=context_tag)
+            yield sse_event("status", {"stage": "generating"})
+            answer_parts = []
+            started = time.perf_counter()
+            async for token in answer_chain.astream({"context": context, "question": query, "book_title": book_title_for(book_filter)}):
+                if not answer_parts: STAGE_SECONDS.observe(time.perf_counter() - started, stage="llm_first_token")
+                answer_parts.append(token)
+                yield sse_event("token", {"text": token})
+            STAGE_SECONDS.observe(time.perf_counter() - started, stage="llm")
+            cache_answer(query, query_embedding, book_filter, context, "".join(answer_parts), answer_tag)
+            yield sse_event("done", {"cached": False})
+        except Exception as e:
+            log.error(f"Error processing streaming chat request: {e}")
+            ERRORS.inc(stage="chat_stream")
+            yield sse_event("error", {"error": "An error occurred processing your request."})
+
+    return StreamingResponse(generate(), media_type="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+async def fetch_batch_chunks(book_filter):
+    """One fetch of every chunk the filter selects (awaited find for Atlas, a thread for HNSW)."""
+    from retrievers import AtlasVectorRetriever
+    if isinstance(retriever, AtlasVectorRetriever):
+        with stage("fetch_chunks"): results = await find_to_list(retriever.collection, retriever.find_query(book_filter), retriever.projection())
+        with stage("extract_candidates"): return retriever.extract_candidates(results)
+    return await asyncio.to_thread(retriever.fetch_chunks, book_filter)
+
+
+async def batch_retrieve(batch, answer_tag):
+    """Async counterpart of app.batch_retrieve."""
+    from lexical import RRF_POOL_FACTOR
+    book_filter = batch.book_filter
+    if semantic_cache:
+        for index in batch.pending():
+            cached_answer = semantic_cache.lookup_exact(batch.questions[index], book_filter, answer_tag)
+            if cached_answer is not None: batch.answer(index, cached_answer, cached=True)
+    if bm25_index is not None and retrieval_mode != "vector":
+        for index in batch.pending():
+            with stage("lexical_search"): hits, confidence = await asyncio.to_thread(bm25_index.search, batch.questions[index], CONTEXT_CANDIDATES * RRF_POOL_FACTOR, book_filter)
+            batch.add_lexical(index, hits, retrieval_mode == "lexical" or (retrieval_mode == "auto" and bm25_index.is_confident(confidence)))
+
+    vector_indices = batch.needs_vectors()
+    if not vector_indices: return
+    with stage("embed_documents"): vectors = await embeddings.aembed_documents([batch.questions[index] for index in vector_indices])
+    for index, vector in zip(vector_indices, vectors):
+        batch.embeddings[index] = vector
+        hit = semantic_cache.lookup(vector, book_filter, answer_tag) if semantic_cache else None
+        if hit: batch.answer(index, hit[0], cached=True)
+
+    vector_indices = batch.needs_vectors()
+    if not vector_indices: return
+    try:
+        chunks = await fetch_batch_chunks(book_filter)
+        log.debug(f"Batch retrieval: {len(chunks)} chunk(s) fetched for {len(vector_indices)} question(s).")
+        with stage("rerank"): await asyncio.to_thread(batch.rank, vector_indices, chunks)
+    except Exception as e:
+        log.error(f"Error during batch retrieval: {e}")
+        ERRORS.inc(stage="retrieval")
+        for index in vector_indices: batch.fail(index, str(e) if isinstance(e, ValueError) else "An error occurred retrieving context.")
+
+
+@router.post('/api/chat/batch')
+async def chat_batch(request: Request):
+    """Async counterpart of app.chat_batch: results in input order with per-question errors."""
+    from chat_batch import ChatBatch, CHAT_BATCH_CONCURRENCY
+    if answer_chain is None: return error("RAG chain not initialized.", 500)
+    try: batch = ChatBatch.from_request(await request.json())
+    except ValueError as e: return error(str(e), 400)
+    try:
+        _, answer_tag = await generation_tags(batch.book_filter)
+        await batch_retrieve(batch, answer_tag)
+        indices, inputs = batch.generation_inputs(book_title_for(batch.book_filter))
+        if inputs:
+            with stage("llm_batch"): outputs = await answer_chain.abatch(inputs, config={"max_concurrency": CHAT_BATCH_CONCURRENCY}, return_exceptions=True)
+            for index in batch.add_answers(indices, outputs):
+                cache_answer(batch.questions[index], batch.embeddings.get(index), batch.book_filter, batch.contexts[index], batch.results[index]["answer"], answer_tag)
+        return batch.response()
+    except Exception as e:
+        log.error(f"Error processing batch chat request: {e}")
+        ERRORS.inc(stage="chat_batch")
+        return error("An error occurred processing your request.", 500)
+
+
+@router.get('/api/cache/stats')
+async def cache_stats():
+    stats = {"semantic": semantic_cache.stats() if semantic_cache else None, "embedding_batcher": batcher.stats() if batcher else None}
+    if context_cache:
+        stats["context"] = {"local_entries": len(context_cache.lru), "redis_breaker": context_cache.breaker.state}
+    if catalog: stats["catalog"] = catalog.stats()
+    return stats
+
+
+@router.get('/api/retrieval/stats')
+async def retrieval_stats():
+    return {"mode": retrieval_mode, "bm25_chunks": len(bm25_index) if bm25_index is not None else 0,
+            "latency": retrieval_latency.snapshot(), "index_refresh": index_refresher.stats() if index_refresher else None}
+
+
+def admin_denied(request):
+    """Error response unless ADMIN_TOKEN is configured and sent in X-Admin-Token."""
+    if not ADMIN_TOKEN: return error("Admin endpoints are disabled (ADMIN_TOKEN not set).", 403)
+    if request.headers.get('x-admin-token') != ADMIN_TOKEN: return error("Invalid admin token.", 403)
+    return None
+
+
+@router.get('/api/admin/generations')
+async def get_generations(request: Request):
+    """Current cache generations (?book_id= repeatable; defaults to every catalog book)."""
+    denied = admin_denied(request)
+    if denied: return denied
+    if generations is None: return error("Cache not initialized.", 500)
+    book_ids = request.query_params.getlist('book_id') or ([book['_id'] for book in (await catalog.get()).books] if catalog else [])
+    return await generations.describe(book_ids)
+
+
+@router.post('/api/admin/generations')
+async def bump_generation(request: Request):
+    """{"scope": "book"|"corpus"|"model"|"prompt", "book_id": ...}: bump one, retiring the cache entries it versions."""
+    denied = admin_denied(request)
+    if denied: return denied
+    if generations is None: return error("Cache not initialized.", 500)
+    try: data = await request.json()
+    except ValueError: data = {}
+    if not isinstance(data, dict): data = {}
+    try: generation = await generations.bump(data.get('scope'), data.get('book_id'))
+    except ValueError as e: return error(str(e), 400)
+    if generation is None: return error("Redis unavailable; generation not bumped.", 503)
+    log.info(f"Admin bumped '{data.get('scope')}' generation" + (f" for book {data['book_id']}" if data.get('book_id') else "") + f" to {generation}.")
+    return {"scope": data.get('scope'), "book_id": data.get('book_id'), "generation": generation}
+
+
+def catalog_response(request, payload, etag, next_cursor=None):
+    """JSON response with an ETag (304 when the client's copy is current) and the next-page cursor, if any."""
+    from catalog import etag_matches
+    headers = {'ETag': etag, 'Cache-Control': 'no-cache'}
+    if next_cursor: headers['X-Next-Cursor'] = next_cursor
+    if etag_matches(request.headers.get('if-none-match'), etag): return Response(status_code=304, headers=headers)
+    return JSONResponse(payload, headers=headers)
+
+
+@router.get('/api/books')
+async def get_books(request: Request, genre: str = None, cursor: str = None, limit: str = None):
+    from catalog import parse_page_args
+    if catalog is None: return error("Database connection not initialized.", 500)
+    try: cursor, limit = parse_page_args(cursor, limit)
+    except ValueError as e: return error(f"Invalid pagination parameters: {e}", 400)
+    try:
+        snapshot = await catalog.get()
+        books, next_cursor = snapshot.list_books(genre, cursor, limit)
+        return catalog_response(request, books, snapshot.response_etag('books', genre.lower() if genre else None, cursor, limit), next_cursor)
+    except Exception as e:
+        log.error(f"Error fetching books from MongoDB: {e}")
+        ERRORS.inc(stage="catalog_books")
+        return error("An error occurred fetching books.", 500)
+
+
+@router.get('/api/genres')
+async def get_genres(request: Request):
+    if catalog is None: return error("Database connection not initialized.", 500)
+    try:
+        snapshot = await catalog.get()
+        return catalog_response(request, snapshot.genres, snapshot.response_etag('genres'))
+    except Exception as e:
+        log.error(f"Error fetching genres from MongoDB: {e}")
+        ERRORS.inc(stage="catalog_genres")
+        return error("An error occurred fetching genres.", 500)
+
+
+@router.get('/api/books/{book_id}')
+async def get_book_details(request: Request, book_id: str):
+    from bson import ObjectId
+    from bson.errors import InvalidId
+    if catalog is None: return error("Database connection not initialized.", 500)
+    try: ObjectId(book_id)
+    except InvalidId: return error("Invalid book ID format.", 400)
+    try:
+        snapshot = await catalog.get()
+        book = snapshot.by_id.get(book_id)
+        if book is None: return error("Book not found.", 404)
+        return catalog_response(request, book, snapshot.response_etag('book', book_id))
+    except Exception as e:
+        log.error(f"Error fetching book details from MongoDB: {e}")
+        ERRORS.inc(stage="catalog_book")
+        return error("An error occurred fetching book details.", 500)
+
+
+# --- App Factory ---
+def create_app(startup_mode=None):
+    """Returns the FastAPI app; its lifespan starts component initialization per STARTUP_MODE (see startup.py)."""
+    fastapi_app = FastAPI(lifespan=lifespan)
+    fastapi_app.state.startup_mode = startup_mode
+    fastapi_app.include_router(router)
+    fastapi_app.middleware("http")(observe_request)
+    # Added last so it wraps the gate too: 503s during startup still carry CORS headers
+    fastapi_app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_methods=["*"], allow_headers=["*"], expose_headers=["ETag", "X-Next-Cursor", TRACE_HEADER])
+    return fastapi_app
+
+startup.mark_imported()
+app = create_app() # For `uvicorn async_app:app`
+
+
+# --- Main Execution ---
+if __name__ == '__main__':
+    import uvicorn
+    uvicorn.run("async_app:app", host="127.0.0.1", port=int(os.environ.get('PORT', 5000)))
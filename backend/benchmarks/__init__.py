@@ -0,0 +1,10 @@
+# backend/benchmarks/
+# Offline benchmarks for the hot paths (retrieve_context, re-ranking, the cache layer,
+# chunk_and_embed and store_in_mongo). No OpenAI or Atlas calls are made: embeddings are
+# deterministic fakes, MongoDB is mongomock (or a local mongod) and Redis is fakeredis.
+#
+# Run from backend/:  python -m benchmarks.run --out bench.json
+# Compare two runs:   python -m benchmarks.run compare old.json new.json
+#
+# End-to-end load test of app.py against a local OpenAI-compatible stand-in (fake_openai.py):
+#   python -m benchmarks.loadtest --mongo-uri mongodb://localhost:27017/ --seed --out load.json
@@ -0,0 +1,111 @@
+# backend/benchmarks/corpus.py
+# Benchmark corpora:
+#   - the sample books in data/ (book1.txt, b2.pdf), loaded and chunked exactly like ingestion
+#     and embedded with FakeEmbeddings
+#   - synthetic corpora of any size (10k-1M chunks): books drawn from topic clusters, so vectors,
+#     filters and BM25 terms have realistic structure. Vectors live in one float32 matrix;
+#     1M chunks at 1536 dimensions need ~6 GB, so pass a smaller --dim for the largest sizes.
+import os
+import hashlib
+import numpy as np
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data")
+SAMPLE_BOOKS = ("book1.txt", "b2.pdf")
+SYNTHETIC_GENRES = ("Self-Help", "Devotional", "Sci-Fi", "Biography")
+SYNTHETIC_TOPICS = 64
+SYNTHETIC_SENTENCES = 32 # Per topic
+SYNTHETIC_CHUNKS_PER_BOOK = 500
+QUERY_COUNT = 200
+
+
+class Corpus:
+    """Chunk dicts ({"text", "embedding", "title", "genre", "book_id", "ordinal"}) and matching queries."""
+
+    def __init__(self, name, chunks, queries, query_vectors, dim, docs=None, path=None):
+        self.name = name
+        self.chunks = chunks
+        self.queries = queries
+        self.query_vectors = query_vectors
+        self.dim = dim
+        self.docs = docs # LangChain documents (sample books only), for chunk_and_embed
+        self.path = path
+
+    def __len__(self):
+        return len(self.chunks)
+
+    def book_filter(self):
+        """Filter selecting the first book (what the chat UI sends)."""
+        return {"title": self.chunks[0]["title"]}
+
+    def book_chunks(self, title):
+        return [chunk for chunk in self.chunks if chunk["title"] == title]
+
+
+def book_id_for(name):
+    """Stable ObjectId-shaped id, so runs are comparable and id filters still parse."""
+    return hashlib.md5(name.encode()).hexdigest()[:24]
+
+
+def query_texts(texts, count, rng, words=12):
+    """Questions made of a chunk's leading words: they share vocabulary with the corpus like real questions do."""
+    picks = rng.integers(len(texts), size=count)
+    return [" ".join(texts[i].split()[:words]) for i in picks]
+
+
+# --- Sample Books ---
+def sample_book(file_name, embeddings, seed=0):
+    """Loads and splits data/<file_name> with process_book and embeds it with `embeddings`."""
+    from process_book import load_book, split_documents
+    path = os.path.join(DATA_DIR, file_name)
+    docs, _ = load_book(path)
+    texts = split_documents(docs)
+    vectors = embeddings.embed_documents(texts)
+    title, book_id = os.path.splitext(file_name)[0], book_id_for(file_name)
+    chunks = [{"text": text, "embedding": np.asarray(vector, dtype=np.float32), "title": title, "genre": "Unknown", "book_id": book_id, "ordinal": ordinal}
+              for ordinal, (text, vector) in enumerate(zip(texts, vectors))]
+    queries = query_texts(texts, QUERY_COUNT, np.random.default_rng(seed))
+    return Corpus(title, chunks, queries, embeddings.embed_documents(queries), embeddings.dim, docs=docs, path=path)
+
+
+def sample_books(embeddings):
+    return [sample_book(file_name, embeddings) for file_name in SAMPLE_BOOKS]
+
+
+# --- Synthetic Corpora ---
+def _unit_rows(matrix):
+    matrix /= np.linalg.norm(matrix, axis=1, keepdims=True) + 1e-12
+    return matrix
+
+
+def synthetic(n_chunks, dim, seed=0, noise=0.35, batch=50000):
+    """n_chunks chunks in SYNTHETIC_CHUNKS_PER_BOOK-chunk books; each book mostly discusses one topic."""
+    rng = np.random.default_rng(seed)
+    centroids = _unit_rows(rng.standard_normal((SYNTHETIC_TOPICS, dim)).astype(np.float32))
+    common = [f"word{i}" for i in range(200)]
+    sentences = []
+    for topic in range(SYNTHETIC_TOPICS):
+        vocabulary = [f"topic{topic}term{i}" for i in range(100)]
+        sentences.append([" ".join(rng.choice(vocabulary, 6).tolist() + rng.choice(common, 6).tolist()) + "." for _ in range(SYNTHETIC_SENTENCES)])
+
+    n_books = max(1, -(-n_chunks // SYNTHETIC_CHUNKS_PER_BOOK))
+    book_topics = rng.integers(SYNTHETIC_TOPICS, size=n_books)
+    books = np.arange(n_chunks) // SYNTHETIC_CHUNKS_PER_BOOK
+    topics = np.where(rng.random(n_chunks) < 0.8, book_topics[books], rng.integers(SYNTHETIC_TOPICS, size=n_chunks))
+
+    vectors = np.empty((n_chunks, dim), dtype=np.float32)
+    for start in range(0, n_chunks, batch): # Bounded temporaries even at 1M chunks
+        part = topics[start:start + batch]
+        vectors[start:start + batch] = _unit_rows(centroids[part] + noise * rng.standard_normal((len(part), dim)).astype(np.float32))
+
+    picks = rng.integers(SYNTHETIC_SENTENCES, size=(n_chunks, 8))
+    chunks = []
+    for i in range(n_chunks):
+        book = int(books[i])
+        chunks.append({"text": " ".join(sentences[topics[i]][j] for j in picks[i]), "embedding": vectors[i],
+                       "title": f"Synthetic Book {book}", "genre": SYNTHETIC_GENRES[book % len(SYNTHETIC_GENRES)],
+                       "book_id": book_id_for(f"synthetic-{book}"), "ordinal": i - book * SYNTHETIC_CHUNKS_PER_BOOK})
+
+    query_topics = rng.integers(SYNTHETIC_TOPICS, size=QUERY_COUNT)
+    queries = [sentences[topic][rng.integers(SYNTHETIC_SENTENCES)] for topic in query_topics]
+    query_vectors = _unit_rows(centroids[query_topics] + noise * rng.standard_normal((QUERY_COUNT, dim)).astype(np.float32))
+    return Corpus(f"synthetic-{n_chunks}", chunks, queries, list(query_vectors), dim)
@@ -0,0 +1,190 @@
+# backend/benchmarks/fake_openai.py
+# Local OpenAI-compatible stand-in for load tests: POST /v1/embeddings and POST /v1/chat/completions
+# (plain and streamed), with configurable latency. Embeddings come from standins.FakeEmbeddings, so
+# books seeded with FakeEmbeddings and queries embedded through this server share one vector space.
+# ChatOpenAI / OpenAIEmbeddings use it when OPENAI_BASE_URL (and OPENAI_API_BASE) point at <url>/v1.
+#
+# Standalone:  python -m benchmarks.fake_openai --port 8089 --embed-ms 40 --first-token-ms 300 --token-ms 15
+import sys
+import json
+import time
+import base64
+import argparse
+import threading
+import numpy as np
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from benchmarks.standins import FakeEmbeddings
+
+# --- Configuration ---
+DEFAULT_DIM = 1536
+ANSWER_WORDS = ("The", "book", "explains", "this", "through", "its", "characters", "and", "their", "choices,", "which", "shape", "the", "story.")
+
+
+def _token_decoder(model):
+    """langchain's OpenAIEmbeddings sends tiktoken ids rather than text; decode them back when tiktoken is available."""
+    try:
+        import tiktoken
+        try: encoding = tiktoken.encoding_for_model(model)
+        except KeyError: encoding = tiktoken.get_encoding("cl100k_base")
+        return encoding.decode
+    except Exception: # Not installed, or the encoding can't be downloaded: embed the ids as words
+        return lambda ids: " ".join(map(str, ids))
+
+
+class FakeOpenAI:
+    """Response generation and latency model, shared by every request handler thread."""
+
+    def __init__(self, dim=DEFAULT_DIM, embed_ms=0.0, embed_per_input_ms=0.0, first_token_ms=0.0, token_ms=0.0, answer_tokens=60):
+        self.embeddings = FakeEmbeddings(dim=dim)
+        self.embed_latency = embed_ms / 1000
+        self.embed_per_input = embed_per_input_ms / 1000
+        self.first_token_latency = first_token_ms / 1000
+        self.token_latency = token_ms / 1000
+        self.answer_tokens = answer_tokens
+        self.decoders = {}
+        self.lock = threading.Lock()
+        self.counts = {"embeddings": 0, "embedded_inputs": 0, "completions": 0, "streams": 0}
+
+    def count(self, **increments):
+        with self.lock:
+            for name, value in increments.items(): self.counts[name] += value
+
+    def texts(self, payload):
+        """The request's inputs as strings (a string, a list of strings, token ids or lists of token ids)."""
+        inputs = payload.get("input")
+        if isinstance(inputs, str) or (inputs and isinstance(inputs[0], int)): inputs = [inputs]
+        model = payload.get("model", "")
+        decode = self.decoders.get(model)
+        if decode is None: decode = self.decoders[model] = _token_decoder(model)
+        return [text if isinstance(text, str) else decode(text) for text in inputs]
+
+    def embed(self, payload):
+        texts = self.texts(payload)
+        time.sleep(self.embed_latency + self.embed_per_input * len(texts))
+        self.count(embeddings=1, embedded_inputs=len(texts))
+        data = []
+        for index, vector in enumerate(self.embeddings.embed_documents(texts)):
+            if payload.get("encoding_format") == "base64": # The openai client asks for base64 float32 by default
+                vector = base64.b64encode(np.asarray(vector, dtype=np.float32).tobytes()).decode()
+            data.append({"object": "embedding", "index": index, "embedding": vector})
+        tokens = sum(len(text.split()) for text in texts)
+        return {"object": "list", "data": data, "model": payload.get("model"), "usage": {"prompt_tokens": tokens, "total_tokens": tokens}}
+
+    def answer_words(self):
+        return [ANSWER_WORDS[i % len(ANSWER_WORDS)] for i in range(self.answer_tokens)]
+
+    def complete(self, payload):
+        time.sleep(self.first_token_latency + self.token_latency * self.answer_tokens)
+        self.count(completions=1)
+        prompt_tokens = sum(len(str(message.get("content", "")).split()) for message in payload.get("messages", []))
+        return {"id": "chatcmpl-fake", "object": "chat.completion", "created": int(time.time()), "model": payload.get("model"),
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": " ".join(self.answer_words())}, "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": self.answer_tokens, "total_tokens": prompt_tokens + self.answer_tokens}}
+
+    def stream(self, payload):
+        """chat.completion.chunk SSE frames: role, one word per chunk (token_ms apart), finish, [DONE]."""
+        self.count(streams=1)
+        chunk = {"id": "chatcmpl-fake", "object": "chat.completion.chunk", "created": int(time.time()), "model": payload.get("model")}
+        frame = lambda delta, finish=None: f"data: {json.dumps({**chunk, 'choices': [{'index': 0, 'delta': delta, 'finish_reason': finish}]})}\n\n"
+        time.sleep(self.first_token_latency)
+        yield frame({"role": "assistant", "content": ""})
+        for i, word in enumerate(self.answer_words()):
+            if i: time.sleep(self.token_latency)
+            yield frame({"content": word if i == 0 else " " + word})
+        yield frame({}, "stop")
+        yield "data: [DONE]\n\n"
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1" # Keep-alive, like the real API
+    fake = None # Set per server by FakeOpenAIServer
+
+    def log_message(self, *args): pass # One line per request would drown the load test output
+
+    def send_json(self, status, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path.rstrip("/").endswith("/models"): return self.send_json(200, {"object": "list", "data": []})
+        self.send_json(404, {"error": {"message": f"Unknown path {self.path}", "type": "invalid_request_error"}})
+
+    def do_POST(self):
+        try: payload = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        except ValueError: return self.send_json(400, {"error": {"message": "Invalid JSON body.", "type": "invalid_request_error"}})
+        path = self.path.split("?")[0].rstrip("/")
+        if path.endswith("/embeddings"): return self.send_json(200, self.fake.embed(payload))
+        if not path.endswith("/chat/completions"):
+            return self.send_json(404, {"error": {"message": f"Unknown path {self.path}", "type": "invalid_request_error"}})
+        if not payload.get("stream"): return self.send_json(200, self.fake.complete(payload))
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Connection", "close") # No Content-Length: the end of the stream is the end of the connection
+        self.end_headers()
+        self.close_connection = True
+        for frame in self.fake.stream(payload):
+            self.wfile.write(frame.encode())
+            self.wfile.flush()
+
+
+class FakeOpenAIServer:
+    """Runs FakeOpenAI on a background thread. `url` is the base URL to give the OpenAI clients."""
+
+    def __init__(self, host="127.0.0.1", port=0, **options):
+        self.fake = FakeOpenAI(**options)
+        handler = type("FakeOpenAIHandler", (Handler,), {"fake": self.fake})
+        self.server = ThreadingHTTPServer((host, port), handler)
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, name="fake-openai", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def add_latency_arguments(parser):
+    """The latency model's command-line options (shared with benchmarks.loadtest)."""
+    parser.add_argument("--dim", type=int, default=DEFAULT_DIM, help="Embedding dimensions")
+    parser.add_argument("--embed-ms", type=float, default=40.0, help="Latency per embeddings request")
+    parser.add_argument("--embed-per-input-ms", type=float, default=0.5, help="Extra embeddings latency per input text")
+    parser.add_argument("--first-token-ms", type=float, default=300.0, help="Completion latency before the first token")
+    parser.add_argument("--token-ms", type=float, default=15.0, help="Completion latency per further token")
+    parser.add_argument("--answer-tokens", type=int, default=60, help="Tokens per completion")
+
+
+def latency_options(args):
+    return {"dim": args.dim, "embed_ms": args.embed_ms, "embed_per_input_ms": args.embed_per_input_ms,
+            "first_token_ms": args.first_token_ms, "token_ms": args.token_ms, "answer_tokens": args.answer_tokens}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.fake_openai", description="Local OpenAI-compatible stand-in server.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8089)
+    add_latency_arguments(parser)
+    args = parser.parse_args(argv)
+    server = FakeOpenAIServer(args.host, args.port, **latency_options(args))
+    print(f"Fake OpenAI API on {server.url} (set OPENAI_BASE_URL and OPENAI_API_BASE to this). Ctrl+C to stop.", file=sys.stderr)
+    try: server.server.serve_forever()
+    except KeyboardInterrupt: pass
+    finally: server.server.server_close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,129 @@
+# backend/benchmarks/harness.py
+# Timing, memory and reporting for the benchmark suites.
+# Each result is one JSON object: latency percentiles over `repeat` timed calls, throughput,
+# and the peak memory traced (tracemalloc, which numpy reports into) during one extra call.
+# Timed calls run without tracemalloc, so tracing overhead never shows up in the latencies.
+import os
+import sys
+import json
+import time
+import platform
+import resource
+import tracemalloc
+import subprocess
+import numpy as np
+
+# --- Configuration ---
+REGRESSION_THRESHOLD = 0.10 # compare: relative worsening that counts as a regression
+COMPARED_FIELDS = (("p50_ms", 1), ("p95_ms", 1), ("p99_ms", 1), ("seconds", 1), ("throughput_per_s", -1), ("peak_mem_mb", 1), ("error_rate", 1)) # (field, +1 = lower is better)
+
+
+def progress(message):
+    print(message, file=sys.stderr, flush=True)
+
+
+class Recorder:
+    """Collects results for one run."""
+
+    def __init__(self, trace_memory=True):
+        self.trace_memory = trace_memory
+        self.results = []
+
+    def measure(self, name, fn, repeat, warmup=1, ops=1, **params):
+        """Times fn(i) for i in range(repeat) after `warmup` untimed calls. `ops` = operations per call (for throughput)."""
+        for i in range(warmup): fn(i)
+        latencies = np.empty(repeat)
+        started = time.perf_counter()
+        for i in range(repeat):
+            call_started = time.perf_counter()
+            fn(warmup + i)
+            latencies[i] = time.perf_counter() - call_started
+        elapsed = time.perf_counter() - started
+        result = {"name": name, "params": params, "repeat": repeat,
+                  "p50_ms": round(float(np.percentile(latencies, 50)) * 1000, 4), "p95_ms": round(float(np.percentile(latencies, 95)) * 1000, 4),
+                  "mean_ms": round(float(latencies.mean()) * 1000, 4), "max_ms": round(float(latencies.max()) * 1000, 4),
+                  "throughput_per_s": round(ops * repeat / elapsed, 2) if elapsed else None,
+                  "peak_mem_mb": self.peak_memory(fn, warmup + repeat) if self.trace_memory else None}
+        self.results.append(result)
+        progress(f"  {name} {params}: p50 {result['p50_ms']:.3f} ms, p95 {result['p95_ms']:.3f} ms, "
+                 f"{result['throughput_per_s']}/s, peak {result['peak_mem_mb']} MB")
+        return result
+
+    def once(self, name, fn, **params):
+        """Runs fn() a single time (index builds and other steps too slow to repeat) and returns its result.
+        Memory is traced during the timed call itself, so the latency includes tracemalloc overhead."""
+        if self.trace_memory: tracemalloc.start()
+        try:
+            started = time.perf_counter()
+            value = fn()
+            elapsed = time.perf_counter() - started
+            peak = round(tracemalloc.get_traced_memory()[1] / 2**20, 3) if self.trace_memory else None
+        finally:
+            if self.trace_memory: tracemalloc.stop()
+        self.results.append({"name": name, "params": params, "repeat": 1, "seconds": round(elapsed, 4), "peak_mem_mb": peak, "traced": self.trace_memory})
+        progress(f"  {name} {params}: {elapsed:.3f} s, peak {peak} MB")
+        return value
+
+    @staticmethod
+    def peak_memory(fn, i):
+        """MB allocated at the peak of one fn(i) call, above what was live before it."""
+        tracemalloc.start()
+        try:
+            baseline = tracemalloc.get_traced_memory()[0]
+            fn(i)
+            return round((tracemalloc.get_traced_memory()[1] - baseline) / 2**20, 3)
+        finally:
+            tracemalloc.stop()
+
+    def report(self, **meta):
+        return {"meta": {**environment(), **meta, "max_rss_mb": max_rss_mb()}, "results": self.results}
+
+
+# --- Environment ---
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, timeout=5,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def max_rss_mb():
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1) # KB on Linux
+
+
+def environment():
+    return {"timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"), "git_revision": git_revision(),
+            "python": platform.python_version(), "numpy": np.__version__, "platform": platform.platform(), "cpus": os.cpu_count()}
+
+
+# --- Comparison ---
+def result_key(result):
+    return result["name"], json.dumps(result["params"], sort_keys=True)
+
+
+def compare(baseline, current, threshold=REGRESSION_THRESHOLD):
+    """Rows of (name, params, field, old, new, change, regressed) for results present in both runs.
+    The change is relative, or absolute when the baseline is 0."""
+    old_results = {result_key(result): result for result in baseline["results"]}
+    rows = []
+    for result in current["results"]:
+        old = old_results.get(result_key(result))
+        if old is None: continue
+        for field, direction in COMPARED_FIELDS:
+            before, after = old.get(field), result.get(field)
+            if before is None or after is None: continue
+            # No relative change from zero (e.g. a clean error_rate): an absolute move past the threshold counts instead
+            change = (after - before) / before if before else after - before
+            rows.append((result["name"], result["params"], field, before, after, change, direction * change > threshold))
+    return rows
+
+
+def print_comparison(rows, threshold=REGRESSION_THRESHOLD):
+    print(f"{'benchmark':<34} {'params':<44} {'metric':<17} {'old':>11} {'new':>11} {'change':>8}")
+    for name, params, field, before, after, change, regressed in rows:
+        flag = "  REGRESSION" if regressed else ""
+        print(f"{name:<34} {json.dumps(params, sort_keys=True)[:44]:<44} {field:<17} {before:>11.4g} {after:>11.4g} {change:>+8.1%}{flag}")
+    regressions = sum(1 for row in rows if row[-1])
+    print(f"{regressions} regression(s) beyond {threshold:.0%} across {len(rows)} compared metrics.")
+    return regressions
@@ -0,0 +1,322 @@
+# backend/benchmarks/loadtest.py
+# End-to-end load test for the Flask app (app.py): starts benchmarks.fake_openai with the configured
+# latency model, launches the app pointed at it (OPENAI_BASE_URL), then drives /api/chat,
+# /api/chat/stream and the catalog endpoints from N closed-loop client workers per level
+# (--concurrency 1,4,16,...). Reports throughput, p50/p95/p99 latency, error rate, time to first
+# token and answer-cache hit rate per request kind and level.
+#
+# From backend/, against a scratch mongod (--seed writes the sample books into its "books" database):
+#   python -m benchmarks.loadtest --mongo-uri mongodb://localhost:27017/ --seed --concurrency 1,4,16,32 --out load.json
+#   python -m benchmarks.loadtest ... --server-command "gunicorn -w 4 -k gthread --threads 8 -b {host}:{port} app:app"
+#   python -m benchmarks.loadtest --url http://host:5000 ...   -> drive a deployment already pointed at a fake server
+# Reports share benchmarks.run's format:  python -m benchmarks.run compare old.json new.json
+import os
+import sys
+import json
+import time
+import shlex
+import random
+import socket
+import argparse
+import threading
+import contextlib
+import subprocess
+import numpy as np
+from benchmarks import standins
+
+WORK_DIR = standins.isolate() # Seeding writes BM25 segments / the HNSW index here; the app is pointed at the same place
+
+from benchmarks.harness import environment, progress
+from benchmarks.fake_openai import FakeOpenAIServer, add_latency_arguments, latency_options
+
+# --- Configuration ---
+LOADTEST_MONGO_URI = os.getenv("LOADTEST_MONGO_URI", "mongodb://localhost:27017/")
+REQUEST_KINDS = ("chat", "chat_stream", "books", "genres", "book")
+DEFAULT_MIX = "chat=5,chat_stream=2,books=1,genres=1,book=1"
+DEFAULT_CONCURRENCY = "1,4,16,32"
+DEFAULT_SERVER_COMMAND = "{python} -m flask --app app run --host {host} --port {port} --with-threads --no-reload --no-debugger"
+READY_TIMEOUT_SECONDS = 180
+HOT_QUERIES = 20 # Per book; --repeat-ratio of chat requests reuse these, the rest are fresh questions
+GENERIC_QUESTIONS = ("What is the main theme of the book?", "Who is the main character?", "How does the story end?",
+                     "What lessons does the author want readers to learn?", "Summarize the first chapter.",
+                     "What conflict drives the plot?", "How does the setting shape the story?", "What is the author's writing style like?")
+
+
+# --- Setup ---
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def parse_mix(text):
+    """"chat=5,books=1" -> ([kinds], [weights])."""
+    kinds, weights = [], []
+    for part in text.split(","):
+        kind, _, weight = part.partition("=")
+        kind = kind.strip()
+        if kind not in REQUEST_KINDS: raise SystemExit(f"Unknown request kind '{kind}' in --mix; choose from {REQUEST_KINDS}.")
+        kinds.append(kind); weights.append(float(weight or 1))
+    return kinds, weights
+
+
+def seed(mongo_uri, dim):
+    """Stores the sample books (FakeEmbeddings vectors, matching what the fake server returns for questions)
+    with process_book.store_in_mongo. Returns the corpora, for question sampling."""
+    from pymongo import MongoClient
+    import process_book
+    from benchmarks.corpus import SYNTHETIC_GENRES, sample_books
+    client = MongoClient(mongo_uri)
+    try:
+        corpora = sample_books(standins.FakeEmbeddings(dim=dim))
+        for i, corpus in enumerate(corpora):
+            metadata = {"title": corpus.name, "author": "Load Test", "genre": SYNTHETIC_GENRES[i % len(SYNTHETIC_GENRES)]}
+            vectors = [chunk["embedding"].tolist() for chunk in corpus.chunks]
+            process_book.store_in_mongo(metadata, [chunk["text"] for chunk in corpus.chunks], vectors, corpus.path, client=client)
+    finally:
+        client.close()
+    return corpora
+
+
+def build_hnsw_index(mongo_uri):
+    """The local HNSW index the app loads with RETRIEVER_BACKEND=hnsw (written to HNSW_INDEX_DIR in WORK_DIR)."""
+    from pymongo import MongoClient
+    from retrievers import HNSWRetriever
+    from storage import STORAGE_LAYOUT, CHUNK_COLLECTION_NAME
+    client = MongoClient(mongo_uri)
+    try: HNSWRetriever().build_from_mongo(client["books"]["books"], chunk_collection=client["books"][CHUNK_COLLECTION_NAME], layout=STORAGE_LAYOUT).save()
+    finally: client.close()
+
+
+def launch_app(args, fake_url, host, port):
+    """Starts the app with its OpenAI clients pointed at the fake server. Output goes to WORK_DIR/app.log."""
+    env = {**os.environ, "OPENAI_BASE_URL": fake_url, "OPENAI_API_BASE": fake_url, "MONGO_URI": args.mongo_uri,
+           "RETRIEVER_BACKEND": args.retriever, "EMBEDDING_DIMENSIONS": str(args.dim), "STARTUP_MODE": "background"}
+    env.setdefault("OPENAI_API_KEY", "loadtest-no-network")
+    command = shlex.split(args.server_command.format(python=shlex.quote(sys.executable), host=host, port=port))
+    log_path = os.path.join(WORK_DIR, "app.log")
+    progress(f"Starting app: {' '.join(command)} (log: {log_path})")
+    backend_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    with open(log_path, "wb") as log_file:
+        return subprocess.Popen(command, cwd=backend_dir, env=env, stdout=log_file, stderr=subprocess.STDOUT), log_path
+
+
+def wait_ready(session, base_url, process=None, log_path=None, timeout=READY_TIMEOUT_SECONDS):
+    """Polls /readyz until the app reports ready. Exits with the app's log tail if it dies or never gets there."""
+    import requests
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process is not None and process.poll() is not None: break
+        try:
+            if session.get(f"{base_url}/readyz", timeout=5).status_code == 200: return
+        except requests.RequestException: pass
+        time.sleep(0.5)
+    tail = ""
+    if log_path:
+        with open(log_path, encoding="utf-8", errors="replace") as f: tail = "".join(f.readlines()[-30:])
+    if process is not None and process.poll() is not None: raise SystemExit(f"App exited with code {process.returncode} before becoming ready.\n{tail}")
+    raise SystemExit(f"App at {base_url} did not become ready within {timeout}s.\n{tail}")
+
+
+# --- Workload ---
+class Workload:
+    """Picks the next request: a kind by --mix weight, and for chats a book plus a hot (repeated) or fresh question."""
+
+    def __init__(self, kinds, weights, books, corpora, repeat_ratio, seed=0):
+        self.kinds, self.weights = kinds, weights
+        self.books = books # Catalog entries from /api/books
+        self.repeat_ratio = repeat_ratio
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock() # random.Random is shared by every worker
+        self.fresh = 0
+        texts = {corpus.name: [chunk["text"] for chunk in corpus.chunks] for corpus in corpora or []}
+        self.texts = {book["title"]: texts[book["title"]] for book in books if book.get("title") in texts}
+        self.hot = {book["title"]: self.fresh_questions(book["title"], HOT_QUERIES) for book in books}
+
+    def fresh_questions(self, title, count):
+        """Seeded books: a 12-word window from a random chunk (shares vocabulary, rarely repeats). Otherwise a numbered generic question."""
+        questions = []
+        for _ in range(count):
+            texts = self.texts.get(title)
+            if texts:
+                words = self.rng.choice(texts).split()
+                start = self.rng.randrange(max(1, len(words) - 12))
+                questions.append(" ".join(words[start:start + 12]))
+            else:
+                self.fresh += 1
+                questions.append(f"{self.rng.choice(GENERIC_QUESTIONS)} ({self.fresh})")
+        return questions
+
+    def next(self):
+        """(kind, book, question) for the next request; question is None for catalog requests."""
+        with self.lock:
+            kind = self.rng.choices(self.kinds, self.weights)[0]
+            book = self.rng.choice(self.books)
+            if kind not in ("chat", "chat_stream"): return kind, book, None
+            if self.rng.random() < self.repeat_ratio: return kind, book, self.rng.choice(self.hot[book["title"]])
+            return kind, book, self.fresh_questions(book["title"], 1)[0]
+
+
+def send(session, base_url, kind, book, question, timeout):
+    """Issues one request. Returns (ok, cached, time_to_first_token or None)."""
+    if kind == "books": response = session.get(f"{base_url}/api/books", timeout=timeout)
+    elif kind == "genres": response = session.get(f"{base_url}/api/genres", timeout=timeout)
+    elif kind == "book": response = session.get(f"{base_url}/api/books/{book['_id']}", timeout=timeout)
+    elif kind == "chat":
+        response = session.post(f"{base_url}/api/chat", json={"query": question, "book_filter": {"title": book["title"]}}, timeout=timeout)
+        ok = response.status_code == 200 and "answer" in response.json()
+        return ok, ok and bool(response.json().get("cached")), None
+    else:
+        return send_stream(session, base_url, book, question, timeout)
+    return response.status_code == 200, False, None
+
+
+def send_stream(session, base_url, book, question, timeout):
+    started = time.perf_counter()
+    first_token, event = None, None
+    with session.post(f"{base_url}/api/chat/stream", json={"query": question, "book_filter": {"title": book["title"]}}, timeout=timeout, stream=True) as response:
+        if response.status_code != 200: return False, False, None
+        for line in response.iter_lines(decode_unicode=True):
+            if line.startswith("event: "):
+                event = line[7:]
+                if event == "token" and first_token is None: first_token = time.perf_counter() - started
+                if event == "error": return False, False, first_token
+            elif line.startswith("data: ") and event == "done":
+                return True, bool(json.loads(line[6:]).get("cached")), first_token
+    return False, False, first_token # Stream ended without a "done" event
+
+
+def run_level(base_url, workload, concurrency, duration, warmup, timeout):
+    """concurrency closed-loop workers for warmup + duration seconds; only requests started after the warmup are recorded."""
+    import requests
+    samples = [] # (kind, latency, ok, cached, time_to_first_token)
+    samples_lock = threading.Lock()
+    started = time.monotonic()
+    record_from, deadline = started + warmup, started + warmup + duration
+
+    def worker():
+        with requests.Session() as session:
+            while True:
+                request_started = time.monotonic()
+                if request_started >= deadline: return
+                kind, book, question = workload.next()
+                call_started = time.perf_counter()
+                try: ok, cached, first_token = send(session, base_url, kind, book, question, timeout)
+                except (requests.RequestException, ValueError): ok, cached, first_token = False, False, None
+                latency = time.perf_counter() - call_started
+                if request_started >= record_from:
+                    with samples_lock: samples.append((kind, latency, ok, cached, first_token))
+
+    workers = [threading.Thread(target=worker, name=f"load-{i}", daemon=True) for i in range(concurrency)]
+    for thread in workers: thread.start()
+    for thread in workers: thread.join()
+    elapsed = time.monotonic() - record_from # Includes the tail of requests still in flight at the deadline
+    return summarize(samples, concurrency, elapsed)
+
+
+def percentile_ms(values, q):
+    return round(float(np.percentile(values, q)) * 1000, 3) if len(values) else None
+
+
+def summarize(samples, concurrency, elapsed):
+    """One result per request kind plus "all", in the benchmarks.run result format."""
+    results = []
+    for kind in sorted({sample[0] for sample in samples}) + ["all"]:
+        rows = [sample for sample in samples if kind == "all" or sample[0] == kind]
+        latencies = np.array([row[1] for row in rows])
+        errors = sum(1 for row in rows if not row[2])
+        result = {"name": f"load_{kind}", "params": {"concurrency": concurrency}, "requests": len(rows), "errors": errors,
+                  "error_rate": round(errors / len(rows), 4) if rows else None,
+                  "throughput_per_s": round((len(rows) - errors) / elapsed, 2) if elapsed > 0 else None,
+                  "p50_ms": percentile_ms(latencies, 50), "p95_ms": percentile_ms(latencies, 95), "p99_ms": percentile_ms(latencies, 99),
+                  "mean_ms": round(float(latencies.mean()) * 1000, 3) if len(rows) else None, "max_ms": round(float(latencies.max()) * 1000, 3) if len(rows) else None}
+        chats = [row for row in rows if row[0] in ("chat", "chat_stream") and row[2]]
+        if chats: result["cache_hit_rate"] = round(sum(1 for row in chats if row[3]) / len(chats), 4)
+        first_tokens = [row[4] for row in rows if row[4] is not None]
+        if first_tokens: result.update(ttft_p50_ms=percentile_ms(first_tokens, 50), ttft_p95_ms=percentile_ms(first_tokens, 95))
+        results.append(result)
+    return results
+
+
+def print_results(results):
+    print(f"{'kind':<18} {'workers':>7} {'requests':>9} {'errors':>7} {'req/s':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'ttft p95':>9} {'cache hit':>9}", file=sys.stderr)
+    for result in results:
+        show = lambda value, spec: format(value, spec) if value is not None else format("-", spec.split(".")[0])
+        print(f"{result['name'][5:]:<18} {result['params']['concurrency']:>7} {result['requests']:>9} {result['errors']:>7} "
+              f"{show(result['throughput_per_s'], '>9.2f')} {show(result['p50_ms'], '>9.1f')} {show(result['p95_ms'], '>9.1f')} "
+              f"{show(result['p99_ms'], '>9.1f')} {show(result.get('ttft_p95_ms'), '>9.1f')} {show(result.get('cache_hit_rate'), '>9.1%')}", file=sys.stderr)
+
+
+# --- Runner ---
+def run(args):
+    import requests
+    kinds, weights = parse_mix(args.mix)
+    levels = [int(level) for level in args.concurrency.split(",") if level]
+    fake = FakeOpenAIServer(port=args.fake_port, **latency_options(args)).start()
+    progress(f"Fake OpenAI API on {fake.url}")
+    process = None
+    try:
+        corpora = None
+        if args.url:
+            base_url = args.url.rstrip("/")
+            progress(f"Driving {base_url}; it must already use OPENAI_BASE_URL={fake.url} (or its own stand-in).")
+        else:
+            with contextlib.redirect_stdout(sys.stderr): # Ingestion and index builds print progress
+                if args.seed: corpora = seed(args.mongo_uri, args.dim)
+                if args.retriever == "hnsw": build_hnsw_index(args.mongo_uri)
+            host, port = "127.0.0.1", args.port or free_port()
+            base_url = f"http://{host}:{port}"
+            process, log_path = launch_app(args, fake.url, host, port)
+        with requests.Session() as session:
+            wait_ready(session, base_url, process, None if args.url else log_path)
+            books = session.get(f"{base_url}/api/books", timeout=args.timeout).json()
+        if not books: raise SystemExit("The catalog is empty: pass --seed (or point --mongo-uri at a database with books).")
+        workload = Workload(kinds, weights, books, corpora, args.repeat_ratio)
+
+        results = []
+        for concurrency in levels:
+            progress(f"== {concurrency} worker(s): {args.warmup:g}s warmup + {args.duration:g}s ==")
+            level_results = run_level(base_url, workload, concurrency, args.duration, args.warmup, args.timeout)
+            print_results(level_results)
+            results.extend(level_results)
+    finally:
+        if process is not None:
+            process.terminate()
+            try: process.wait(timeout=10)
+            except subprocess.TimeoutExpired: process.kill()
+        fake.stop()
+    return {"meta": {**environment(), "target": args.url or args.server_command, "mix": args.mix, "repeat_ratio": args.repeat_ratio,
+                     "duration_s": args.duration, "warmup_s": args.warmup, "seeded": bool(args.seed), "retriever": args.retriever,
+                     "fake_openai": {**latency_options(args), **fake.fake.counts}},
+            "results": results}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.loadtest", description="Load test /api/chat and the catalog endpoints against a fake OpenAI API.")
+    parser.add_argument("--url", default=None, help="Drive this running deployment instead of launching the app")
+    parser.add_argument("--mongo-uri", default=LOADTEST_MONGO_URI, help="MongoDB for the launched app (use a scratch instance with --seed)")
+    parser.add_argument("--seed", action="store_true", help="Store the sample books in data/ before launching the app (replaces earlier copies)")
+    parser.add_argument("--retriever", choices=("hnsw", "atlas"), default="hnsw", help="hnsw builds a local index from --mongo-uri; atlas needs Atlas Vector Search")
+    parser.add_argument("--server-command", default=DEFAULT_SERVER_COMMAND, help="App command; {python}, {host} and {port} are filled in")
+    parser.add_argument("--port", type=int, default=None, help="App port (default: a free one)")
+    parser.add_argument("--fake-port", type=int, default=0, help="Fake OpenAI API port (default: a free one)")
+    parser.add_argument("--concurrency", default=DEFAULT_CONCURRENCY, help="Comma-separated client worker counts, one level each")
+    parser.add_argument("--duration", type=float, default=30.0, help="Recorded seconds per level")
+    parser.add_argument("--warmup", type=float, default=5.0, help="Unrecorded seconds before each level")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help=f"Request kind weights, kinds: {', '.join(REQUEST_KINDS)}")
+    parser.add_argument("--repeat-ratio", type=float, default=0.5, help="Share of chat requests that repeat a hot question (exercises the caches)")
+    parser.add_argument("--timeout", type=float, default=60.0, help="Per-request timeout in seconds")
+    parser.add_argument("--out", default=None, help="Write the JSON report here (default: stdout)")
+    add_latency_arguments(parser)
+    args = parser.parse_args(argv)
+    report = run(args)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f: json.dump(report, f, indent=2)
+        progress(f"Wrote {len(report['results'])} results to {args.out}")
+    else:
+        print(json.dumps(report, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
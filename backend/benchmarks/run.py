@@ -0,0 +1,233 @@
+# backend/benchmarks/run.py
+# Offline benchmark runner. From backend/:
+#   python -m benchmarks.run                                   -> every suite, JSON on stdout
+#   python -m benchmarks.run --suites retrieve --sizes 10000,100000,1000000 --dim 256 --out bench.json
+#   python -m benchmarks.run compare old.json new.json         -> per-metric deltas, exit 1 on regressions
+# Suites: rerank, cache, retrieve (app.retrieve_context over a local HNSW index), ingest (chunk_and_embed,
+# store_in_mongo and the Atlas retriever's fetch_chunks). Progress goes to stderr, results to --out or stdout.
+import os
+import sys
+import json
+import argparse
+import functools
+import contextlib
+import numpy as np
+from benchmarks import standins
+
+WORK_DIR = standins.isolate() # Before any backend import: they read BM25_INDEX_DIR, STARTUP_MODE, ... at import time
+
+from benchmarks.harness import REGRESSION_THRESHOLD, Recorder, compare, print_comparison, progress
+from benchmarks.corpus import sample_books, synthetic
+from storage import EMBEDDING_DIMENSIONS
+from rag import CONTEXT_CANDIDATES, CONTEXT_ERROR_PREFIX
+
+# --- Configuration ---
+SUITES = ("rerank", "cache", "retrieve", "ingest")
+DEFAULT_SIZES = (10000, 100000) # Synthetic corpus sizes; 1000000 is supported but needs ~dim * 4 GB of RAM
+RERANK_CANDIDATES = (20, 200, 2000, 20000) # k * 5 candidates up to a whole-book fetch (FETCH_CHUNKS_MAX)
+RERANK_LIST_MAX = 2000 # float64 lists are only realistic for small candidate sets
+INGEST_SYNTHETIC_MAX = int(os.getenv("BENCH_INGEST_MAX_CHUNKS", 10000)) # Largest synthetic book sent through store_in_mongo (mongod only)
+CONTEXT_VALUE = "x" * 6000 # About one CONTEXT_TOKEN_BUDGET worth of context
+
+
+def scaled(repeat, n, base=200, floor=5):
+    """Fewer repetitions for larger inputs, so every benchmark takes roughly the same wall time."""
+    return max(floor, min(repeat, repeat * base // max(n, 1)))
+
+
+def check_context(context):
+    if context.startswith(CONTEXT_ERROR_PREFIX): raise RuntimeError(f"retrieve_context failed during the benchmark: {context}")
+    return context
+
+
+# --- Suites ---
+def bench_rerank(recorder, args, embeddings):
+    from rerank import rerank, rerank_batch
+    from embedding_codec import encode_embedding
+    rng = np.random.default_rng(1)
+    queries = rng.standard_normal((64, args.dim)).astype(np.float32)
+    for n in RERANK_CANDIDATES:
+        vectors = rng.standard_normal((n, args.dim)).astype(np.float32)
+        for codec in ("float64", "float32", "int8"):
+            if codec == "float64" and n > RERANK_LIST_MAX: continue
+            candidates = [{"text": f"chunk {i}", "embedding": encode_embedding(vector, codec), "title": "Bench", "book_id": "bench", "ordinal": i}
+                          for i, vector in enumerate(vectors)]
+            recorder.measure("rerank", lambda i: rerank(queries[i % len(queries)], candidates, CONTEXT_CANDIDATES, use_mmr=False),
+                             scaled(args.repeat, n), candidates=n, codec=codec, dim=args.dim)
+            if codec == "float32":
+                recorder.measure("rerank_mmr", lambda i: rerank(queries[i % len(queries)], candidates, CONTEXT_CANDIDATES, use_mmr=True),
+                                 scaled(args.repeat, n), candidates=n, codec=codec, dim=args.dim)
+                recorder.measure("rerank_batch", lambda i: rerank_batch(queries[:16], candidates, CONTEXT_CANDIDATES, use_mmr=False),
+                                 scaled(args.repeat, n * 16), ops=16, candidates=n, queries=16, codec=codec, dim=args.dim)
+
+
+def bench_cache(recorder, args, embeddings):
+    from cache import LRUCache, TwoTierCache
+    from semantic_cache import SemanticCache, SEMANTIC_CACHE_MAX_ENTRIES
+    from generations import Generations, book_generation_key
+    cache = TwoTierCache(standins.redis_client(), ttl=3600)
+    keys = [cache.key(f"bench-{i}") for i in range(1000)]
+    for key in keys: cache.set(key, CONTEXT_VALUE)
+    redis_only = TwoTierCache(cache.redis, ttl=3600, lru=LRUCache(maxsize=0)) # Every read goes to Redis
+    recorder.measure("cache_get", lambda i: cache.get(keys[i % len(keys)]), args.repeat, tier="local")
+    recorder.measure("cache_get", lambda i: redis_only.get(keys[i % len(keys)]), args.repeat, tier="redis")
+    recorder.measure("cache_get", lambda i: redis_only.get(cache.key(f"absent-{i}")), args.repeat, tier="miss")
+    recorder.measure("cache_set", lambda i: cache.set(cache.key(f"set-{i}"), CONTEXT_VALUE), args.repeat)
+    recorder.measure("cache_get_or_compute", lambda i: cache.get_or_compute(cache.key(f"compute-{i}"), lambda: CONTEXT_VALUE), args.repeat, outcome="computed")
+
+    generations = Generations(cache, "bench-model", "bench-prompt")
+    book_ids = [f"book-{i}" for i in range(4)]
+    recorder.measure("generation_tags", lambda i: generations.tags(book_ids), args.repeat, memoized=True)
+    uncached = Generations(cache, "bench-model", "bench-prompt", check_interval=0)
+    recorder.measure("generation_tags", lambda i: uncached.tags(book_ids), args.repeat, memoized=False)
+    cache.shared_call("incr", book_generation_key(book_ids[0]))
+
+    semantic = SemanticCache()
+    book_filter = {"title": "Bench"}
+    questions = [f"what does chapter {i} say about topic {i % 97} and theme {i % 13}" for i in range(SEMANTIC_CACHE_MAX_ENTRIES)]
+    vectors = embeddings.embed_documents(questions)
+    for question, vector in zip(questions, vectors): semantic.store(question, vector, book_filter, "answer")
+    misses = np.random.default_rng(2).standard_normal((64, args.dim)).astype(np.float32)
+    recorder.measure("semantic_lookup", lambda i: semantic.lookup(vectors[i % len(vectors)], book_filter), args.repeat, entries=len(questions), outcome="hit")
+    recorder.measure("semantic_lookup", lambda i: semantic.lookup(misses[i % len(misses)], book_filter), args.repeat, entries=len(questions), outcome="miss")
+    recorder.measure("semantic_lookup_exact", lambda i: semantic.lookup_exact(questions[i % len(questions)], book_filter), args.repeat, entries=len(questions))
+
+
+def bench_retrieve(recorder, args, embeddings, corpora):
+    import app
+    from cache import LRUCache, TwoTierCache
+    from lexical import BM25Index, LatencyStats, SegmentWriter
+    from retrievers import HNSWRetriever
+    app.embeddings = embeddings
+    app.retrieval_latency = LatencyStats()
+    for corpus in corpora:
+        progress(f"retrieve: {corpus.name} ({len(corpus)} chunks)")
+        app.retriever = recorder.once("hnsw_build", lambda: HNSWRetriever(index_dir=os.path.join(WORK_DIR, "hnsw_index")).build(iter(corpus.chunks), corpus.dim),
+                                      corpus=corpus.name, chunks=len(corpus), dim=corpus.dim)
+        modes = ["vector"]
+        if corpus.docs is not None: # BM25 over the sample books: lexical and hybrid retrieval too
+            modes += ["lexical", "hybrid"]
+            bm25_dir = os.path.join(WORK_DIR, f"bm25-{corpus.name}")
+            segment = SegmentWriter(corpus.chunks[0]["book_id"], corpus.chunks[0]["title"], corpus.chunks[0]["genre"], index_dir=bm25_dir)
+            for chunk in corpus.chunks: segment.add(chunk["ordinal"], chunk["text"])
+            segment.commit()
+            bm25_index = BM25Index(bm25_dir).load()
+        queries, vectors = corpus.queries, corpus.query_vectors
+        for mode in modes:
+            app.retrieval_mode, app.bm25_index = mode, (bm25_index if mode != "vector" else None)
+            app.context_cache = TwoTierCache(standins.redis_client(), ttl=3600)
+            for book_filter in (None, corpus.book_filter()):
+                params = {"corpus": corpus.name, "chunks": len(corpus), "mode": mode, "filtered": book_filter is not None}
+                retrieve = lambda i, generation, embedded=True: check_context(app.retrieve_context(
+                    queries[i % len(queries)], filter_criteria=book_filter, query_embedding=vectors[i % len(vectors)] if embedded else None, generation=generation))
+                recorder.measure("retrieve_context", lambda i: retrieve(i, f"miss-{i}"), args.repeat, cache="miss", **params)
+                if mode == "vector" and corpus.docs is not None:
+                    recorder.measure("retrieve_context", lambda i: retrieve(i, f"embed-{i}", embedded=False), args.repeat, cache="miss_with_embedding", **params)
+                for i in range(len(queries)): retrieve(i, "hit")
+                recorder.measure("retrieve_context", lambda i: retrieve(i, "hit"), args.repeat, cache="hit_local", **params)
+                local_cache = app.context_cache
+                app.context_cache = TwoTierCache(local_cache.redis, ttl=3600, lru=LRUCache(maxsize=0))
+                recorder.measure("retrieve_context", lambda i: retrieve(i, "hit"), args.repeat, cache="hit_redis", **params)
+                app.context_cache = local_cache
+
+
+def bench_ingest(recorder, args, embeddings, books, corpora):
+    import process_book
+    import generations
+    from retrievers import AtlasVectorRetriever
+    from embedding_store import EMBEDDING_STORE_COLLECTION
+    generations._ingest_redis = standins.redis_client() # bump_book_generation must not dial the configured Redis
+    process_book.OpenAIEmbeddings = functools.partial(standins.FakeEmbeddings, dim=args.dim)
+    client = standins.mongo_client()
+    db = client[process_book.DB_NAME]
+    store = db[EMBEDDING_STORE_COLLECTION]
+    for book in books:
+        params = {"corpus": book.name, "chunks": len(book)}
+        recorder.measure("chunk_and_embed", lambda i: (store.drop(), process_book.chunk_and_embed(book.docs, client=client)), args.ingest_repeat, store="cold", **params)
+        recorder.measure("chunk_and_embed", lambda i: process_book.chunk_and_embed(book.docs, client=client), args.ingest_repeat, store="warm", **params)
+
+    default_codec = process_book.EMBEDDING_CODEC
+    targets = list(books)
+    if standins.BENCH_MONGO_URI: # mongomock checks unique indexes per document, so a large book costs minutes there
+        targets += [corpus for corpus in corpora if len(corpus) <= INGEST_SYNTHETIC_MAX][:1]
+    try:
+        for corpus in targets:
+            chunks = corpus.book_chunks(corpus.chunks[0]["title"]) if corpus.docs is not None else corpus.chunks # Synthetic: all chunks as one large book
+            texts, vectors = [chunk["text"] for chunk in chunks], [chunk["embedding"].tolist() for chunk in chunks]
+            layouts = ("embedded", "chunks") if corpus.docs is not None else ("chunks",) # A synthetic book this large would exceed 16 MB embedded
+            for layout in layouts:
+                for codec in ("float64", "float32", "int8"):
+                    process_book.EMBEDDING_CODEC = codec
+                    for name in (process_book.COLLECTION_NAME, process_book.CHUNK_COLLECTION_NAME): db[name].delete_many({}) # Every pass starts from the same store size (keeping the indexes BookWriter creates once per client)
+                    params = {"corpus": corpus.name, "chunks": len(chunks), "layout": layout, "codec": codec}
+                    title = f"{corpus.name} {layout} {codec}"
+                    store_book = lambda i, title: process_book.store_in_mongo({"title": title, "author": "Bench", "genre": "Sci-Fi"}, texts, vectors,
+                                                                              corpus.path or corpus.name, layout=layout, client=client, file_hash=f"{title} {i}")
+                    recorder.measure("store_in_mongo", lambda i: store_book(i, f"{title} {i}"), args.ingest_repeat, outcome="insert", **params)
+                    recorder.measure("store_in_mongo", lambda i: store_book(0, title), args.ingest_repeat, outcome="replace", **params)
+                    target = db[process_book.CHUNK_COLLECTION_NAME] if layout == "chunks" else db[process_book.COLLECTION_NAME]
+                    retriever = AtlasVectorRetriever(target, "vector_index", layout)
+                    recorder.measure("atlas_fetch_chunks", lambda i: retriever.fetch_chunks({"title": title}), args.ingest_repeat, **params)
+    finally:
+        process_book.EMBEDDING_CODEC = default_codec
+    client.close()
+
+
+# --- Runner ---
+def run(args):
+    embeddings = standins.FakeEmbeddings(dim=args.dim)
+    recorder = Recorder(trace_memory=not args.no_memory)
+    suites = args.suites.split(",")
+    unknown = set(suites) - set(SUITES)
+    if unknown: raise SystemExit(f"Unknown suite(s) {sorted(unknown)}; choose from {SUITES}.")
+    sizes = [int(size) for size in args.sizes.split(",") if size]
+    with contextlib.redirect_stdout(sys.stderr): # Ingestion code prints progress; keep stdout for the JSON
+        books = sample_books(embeddings) if {"retrieve", "ingest"} & set(suites) else []
+        corpora = []
+        if {"retrieve", "ingest"} & set(suites):
+            for size in sizes: corpora.append(recorder.once("synthetic_corpus", lambda: synthetic(size, args.dim), chunks=size, dim=args.dim))
+        for suite in suites:
+            progress(f"== {suite} ==")
+            if suite == "rerank": bench_rerank(recorder, args, embeddings)
+            elif suite == "cache": bench_cache(recorder, args, embeddings)
+            elif suite == "retrieve": bench_retrieve(recorder, args, embeddings, books + corpora)
+            else: bench_ingest(recorder, args, embeddings, books, corpora)
+    import rag
+    rag.count_tokens("") # format_context timings differ a lot between tiktoken and the length estimate
+    return recorder.report(suites=suites, sizes=sizes, dim=args.dim, repeat=args.repeat, ingest_repeat=args.ingest_repeat,
+                           token_counter="tiktoken" if rag._encoder else "estimate", **standins.describe())
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if argv[:1] == ["compare"]:
+        parser = argparse.ArgumentParser(prog="python -m benchmarks.run compare", description="Compare two benchmark JSON reports.")
+        parser.add_argument("command")
+        parser.add_argument("baseline")
+        parser.add_argument("current")
+        parser.add_argument("--threshold", type=float, default=REGRESSION_THRESHOLD, help="Relative worsening that counts as a regression")
+        args = parser.parse_args(argv)
+        with open(args.baseline, encoding="utf-8") as f: baseline = json.load(f)
+        with open(args.current, encoding="utf-8") as f: current = json.load(f)
+        return 1 if print_comparison(compare(baseline, current, args.threshold), args.threshold) else 0
+
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.run", description="Offline benchmarks for the PagePal hot paths.")
+    parser.add_argument("--suites", default=",".join(SUITES), help=f"Comma-separated subset of {SUITES}")
+    parser.add_argument("--sizes", default=",".join(map(str, DEFAULT_SIZES)), help="Synthetic corpus sizes in chunks (10000-1000000)")
+    parser.add_argument("--dim", type=int, default=EMBEDDING_DIMENSIONS, help="Embedding dimensions (use fewer for 1M-chunk corpora)")
+    parser.add_argument("--repeat", type=int, default=200, help="Timed calls per hot-path benchmark")
+    parser.add_argument("--ingest-repeat", type=int, default=3, help="Timed calls per ingestion benchmark")
+    parser.add_argument("--no-memory", action="store_true", help="Skip the tracemalloc peak-memory pass")
+    parser.add_argument("--out", default=None, help="Write the JSON report here (default: stdout)")
+    args = parser.parse_args(argv)
+    report = run(args)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f: json.dump(report, f, indent=2)
+        progress(f"Wrote {len(report['results'])} results to {args.out}")
+    else:
+        print(json.dumps(report, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
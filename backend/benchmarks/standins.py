@@ -0,0 +1,116 @@
+# backend/benchmarks/standins.py
+# Local stand-ins for the paid/remote services the hot paths call:
+#   - FakeEmbeddings: deterministic drop-in for OpenAIEmbeddings (same methods, no network)
+#   - mongo_client(): mongomock, or a real local mongod when BENCH_MONGO_URI is set
+#   - redis_client(): fakeredis, or a real local Redis when BENCH_REDIS_URL is set
+# isolate() must run before any backend module is imported, because they read their config at import.
+import os
+import re
+import time
+import asyncio
+import hashlib
+import tempfile
+import numpy as np
+
+# --- Configuration ---
+BENCH_MONGO_URI = os.getenv("BENCH_MONGO_URI") # e.g. mongodb://localhost:27017/ (default: mongomock)
+BENCH_REDIS_URL = os.getenv("BENCH_REDIS_URL") # e.g. redis://localhost:6379/15 (default: fakeredis)
+FAKE_EMBEDDING_BUCKETS = 4096 # Hashed vocabulary size of FakeEmbeddings
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+
+
+def isolate(work_dir=None):
+    """Points every on-disk index and the startup mode at a scratch directory. Returns that directory."""
+    work_dir = work_dir or tempfile.mkdtemp(prefix="pagepal-bench-")
+    os.environ["BM25_INDEX_DIR"] = os.path.join(work_dir, "bm25_index")
+    os.environ["HNSW_INDEX_DIR"] = os.path.join(work_dir, "hnsw_index")
+    os.environ["STARTUP_MODE"] = "lazy" # Importing app.py must not try to connect anywhere
+    os.environ.setdefault("OPENAI_API_KEY", "bench-no-network") # process_book checks it is set; FakeEmbeddings never uses it
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    return work_dir
+
+
+# --- Embeddings ---
+_tables = {} # dim -> (FAKE_EMBEDDING_BUCKETS x dim) float32 table, shared by every FakeEmbeddings
+
+def _table(dim):
+    table = _tables.get(dim)
+    if table is None:
+        table = _tables[dim] = np.random.default_rng(dim).standard_normal((FAKE_EMBEDDING_BUCKETS, dim)).astype(np.float32)
+    return table
+
+
+def _bucket(token):
+    return int.from_bytes(hashlib.blake2b(token.encode(), digest_size=4).digest(), "little") % FAKE_EMBEDDING_BUCKETS
+
+
+class FakeEmbeddings:
+    """Deterministic stand-in for OpenAIEmbeddings.
+
+    A text's vector is the normalized sum of hashed per-token random vectors, so texts that share
+    words get similar vectors and re-ranking / the semantic cache behave plausibly.
+    `latency_ms` adds a fixed per-call delay to emulate the API round trip (default: none).
+    """
+
+    def __init__(self, dim=1536, latency_ms=0.0, **_):
+        self.dim = dim
+        self.latency = latency_ms / 1000
+        self.calls = 0
+        self.texts = 0
+        self._buckets = {} # token -> bucket
+
+    def _embed(self, text):
+        tokens = TOKEN_PATTERN.findall(text.lower()) or [text]
+        ids = []
+        for token in tokens:
+            bucket = self._buckets.get(token)
+            if bucket is None: bucket = self._buckets[token] = _bucket(token)
+            ids.append(bucket)
+        vector = np.bincount(ids, minlength=FAKE_EMBEDDING_BUCKETS).astype(np.float32) @ _table(self.dim)
+        return (vector / (np.linalg.norm(vector) or 1.0)).tolist()
+
+    def embed_documents(self, texts):
+        self.calls += 1; self.texts += len(texts)
+        if self.latency: time.sleep(self.latency)
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+    async def aembed_documents(self, texts):
+        if self.latency: await asyncio.sleep(self.latency)
+        self.calls += 1; self.texts += len(texts)
+        return [self._embed(text) for text in texts]
+
+    async def aembed_query(self, text):
+        return (await self.aembed_documents([text]))[0]
+
+
+# --- MongoDB / Redis ---
+def mongo_client():
+    """mongomock (in-process) unless BENCH_MONGO_URI points at a local mongod.
+    mongomock 4.3 needs pymongo < 4.9 (newer UpdateOne passes a `sort` its bulk builder rejects)."""
+    if BENCH_MONGO_URI:
+        from pymongo import MongoClient
+        return MongoClient(BENCH_MONGO_URI)
+    try:
+        import mongomock
+    except ImportError:
+        raise SystemExit("Benchmarks need mongomock (pip install mongomock) or BENCH_MONGO_URI=mongodb://localhost:27017/")
+    return mongomock.MongoClient()
+
+
+def redis_client():
+    """fakeredis (in-process, decode_responses like make_redis_client) unless BENCH_REDIS_URL is set."""
+    if BENCH_REDIS_URL:
+        import redis
+        return redis.Redis.from_url(BENCH_REDIS_URL, decode_responses=True)
+    try:
+        import fakeredis
+    except ImportError:
+        raise SystemExit("Benchmarks need fakeredis (pip install fakeredis) or BENCH_REDIS_URL=redis://localhost:6379/15")
+    return fakeredis.FakeRedis(decode_responses=True)
+
+
+def describe():
+    return {"mongo": "mongod" if BENCH_MONGO_URI else "mongomock", "redis": "redis" if BENCH_REDIS_URL else "fakeredis"}
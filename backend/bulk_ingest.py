@@ -0,0 +1,357 @@
+# backend/bulk_ingest.py
+# Parallel, resumable ingestion for whole catalogs of books.
+#   - loading + splitting runs in a process pool (CPU-bound PDF parsing); chunks are spilled to a
+#     JSONL file in the checkpoint directory rather than sent back as one list
+#   - embedding streams the spilled chunks as concurrent batches under a shared rate limiter with
+#     retry/backoff, and each batch is stored (BookWriter) as soon as it is embedded
+#   - each finished embedding batch is checkpointed to disk, each finished book is recorded,
+#     so an interrupted run resumes without re-embedding anything already done
+#
+# Usage: python bulk_ingest.py <directory | manifest.txt | manifest.jsonl> [options]
+#   A .txt manifest lists one path per line; a .jsonl manifest has {"path": ..., "title"?, "author"?, "genre"?}
+#   per line (metadata given there skips the LLM extraction step; otherwise see metadata_extractor.py).
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+import numpy as np
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# --- Configuration ---
+SUPPORTED_EXTENSIONS = (".txt", ".pdf")
+CHECKPOINT_DIR = os.getenv("INGEST_CHECKPOINT_DIR", ".ingest_checkpoint")
+EMBED_BATCH_SIZE = int(os.getenv("INGEST_EMBED_BATCH_SIZE", 256)) # Chunks per embed_documents request
+EMBED_CONCURRENCY = int(os.getenv("INGEST_EMBED_CONCURRENCY", 4)) # Embedding requests in flight
+BOOK_CONCURRENCY = int(os.getenv("INGEST_BOOK_CONCURRENCY", 4)) # Books embedded/stored at once; at most this + --workers are loaded or loading
+REQUESTS_PER_MINUTE = float(os.getenv("OPENAI_REQUESTS_PER_MINUTE", 3000))
+TOKENS_PER_MINUTE = float(os.getenv("OPENAI_TOKENS_PER_MINUTE", 1000000))
+MAX_RETRIES = int(os.getenv("INGEST_MAX_RETRIES", 6))
+CHARS_PER_TOKEN = 4 # Rough estimate used for the token budget
+
+
+# --- Inputs ---
+def discover_inputs(source):
+    """Returns [{"path": ..., optional metadata}] from a directory or a .txt/.jsonl manifest."""
+    if os.path.isdir(source):
+        entries = []
+        for root, _, files in os.walk(source):
+            for name in sorted(files):
+                if os.path.splitext(name)[1].lower() in SUPPORTED_EXTENSIONS:
+                    entries.append({"path": os.path.join(root, name)})
+        return entries
+    base = os.path.dirname(os.path.abspath(source))
+    entries = []
+    with open(source, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"): continue
+            entry = json.loads(line) if source.endswith(".jsonl") else {"path": line}
+            if not os.path.isabs(entry["path"]): entry["path"] = os.path.join(base, entry["path"])
+            entries.append(entry)
+    return entries
+
+
+# --- Load + Split (runs in worker processes) ---
+def load_and_split(path, spill_path):
+    """Worker-process entry point: writes one book's chunk texts to spill_path (one JSON string per line)
+    and returns (preview_text, chunk_count). Neither side ever holds the whole chunk list."""
+    from process_book import iter_pages, read_preview, iter_chunks
+    preview_text, segments = read_preview(iter_pages(path)) # Never joins the whole book into one string
+    count, tmp_path = 0, spill_path + ".tmp"
+    try:
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for text in iter_chunks(segments):
+                f.write(json.dumps(text) + "\n"); count += 1
+        os.replace(tmp_path, spill_path)
+    except BaseException:
+        if os.path.exists(tmp_path): os.remove(tmp_path)
+        raise
+    return preview_text, count
+
+
+def iter_spilled(spill_path):
+    """Reads back the chunk texts load_and_split spilled, one at a time."""
+    with open(spill_path, encoding="utf-8") as f:
+        for line in f: yield json.loads(line)
+
+
+# --- Rate Limiting + Retries ---
+class RateLimiter:
+    """Thread-safe token bucket over both requests/minute and tokens/minute."""
+
+    def __init__(self, requests_per_minute=REQUESTS_PER_MINUTE, tokens_per_minute=TOKENS_PER_MINUTE):
+        self.capacity = (requests_per_minute, tokens_per_minute)
+        self.rates = (requests_per_minute / 60.0, tokens_per_minute / 60.0)
+        self.available = list(self.capacity)
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens):
+        tokens = min(tokens, self.capacity[1])
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                elapsed, self.updated = now - self.updated, now
+                self.available = [min(cap, avail + rate * elapsed) for cap, avail, rate in zip(self.capacity, self.available, self.rates)]
+                if self.available[0] >= 1 and self.available[1] >= tokens:
+                    self.available[0] -= 1; self.available[1] -= tokens
+                    return
+                wait = max((1 - self.available[0]) / self.rates[0], (tokens - self.available[1]) / self.rates[1])
+            time.sleep(max(wait, 0.01))
+
+
+def _retryable_errors():
+    try:
+        import openai
+        return (openai.RateLimitError, openai.APIConnectionError, openai.APITimeoutError, openai.InternalServerError)
+    except (ImportError, AttributeError):
+        return (ConnectionError, TimeoutError)
+
+
+def with_retries(fn, max_retries=MAX_RETRIES, base_delay=1.0, max_delay=60.0):
+    """Calls fn(), retrying transient OpenAI errors with exponential backoff and full jitter."""
+    retryable = _retryable_errors()
+    for attempt in range(max_retries + 1):
+        try:
+            return fn()
+        except retryable as e:
+            if attempt == max_retries: raise
+            delay = random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+            print(f"  ↻ Transient error ({type(e).__name__}); retry {attempt + 1}/{max_retries} in {delay:.1f}s")
+            time.sleep(delay)
+
+
+# --- Checkpoint ---
+class Checkpoint:
+    """Completed books in books.jsonl; per-book embedding batches as .npy files until the book is stored;
+    spilled chunk texts of loaded books (spill/<sha256>.jsonl) until the book is stored or has failed."""
+
+    def __init__(self, directory=CHECKPOINT_DIR):
+        self.directory = directory
+        os.makedirs(os.path.join(directory, "batches"), exist_ok=True)
+        os.makedirs(os.path.join(directory, "spill"), exist_ok=True)
+        self.books_path = os.path.join(directory, "books.jsonl")
+        self.completed = {}
+        if os.path.exists(self.books_path):
+            with open(self.books_path, encoding="utf-8") as f:
+                for line in f:
+                    if line.strip():
+                        record = json.loads(line)
+                        self.completed[record["sha256"]] = record
+        self._lock = threading.Lock()
+
+    def is_done(self, sha256):
+        return sha256 in self.completed
+
+    def mark_done(self, record):
+        with self._lock:
+            self.completed[record["sha256"]] = record
+            with open(self.books_path, "a", encoding="utf-8") as f: f.write(json.dumps(record) + "\n")
+        batch_dir = self._batch_dir(record["sha256"])
+        if os.path.isdir(batch_dir):
+            for name in os.listdir(batch_dir): os.remove(os.path.join(batch_dir, name))
+            os.rmdir(batch_dir)
+
+    def spill_path(self, sha256):
+        return os.path.join(self.directory, "spill", f"{sha256}.jsonl")
+
+    def remove_spill(self, sha256):
+        try: os.remove(self.spill_path(sha256))
+        except FileNotFoundError: pass
+
+    def _batch_dir(self, sha256):
+        return os.path.join(self.directory, "batches", sha256)
+
+    def load_batch(self, sha256, index):
+        path = os.path.join(self._batch_dir(sha256), f"{index:06d}.npy")
+        return np.load(path) if os.path.exists(path) else None
+
+    def save_batch(self, sha256, index, vectors):
+        batch_dir = self._batch_dir(sha256)
+        os.makedirs(batch_dir, exist_ok=True)
+        tmp_path = os.path.join(batch_dir, f"{index:06d}.tmp.npy")
+        np.save(tmp_path, np.asarray(vectors, dtype=np.float32))
+        os.replace(tmp_path, os.path.join(batch_dir, f"{index:06d}.npy")) # Atomic: never a half-written batch
+
+
+# --- Bulk Ingestor ---
+class BulkIngestor:
+    def __init__(self, checkpoint, embed_batch_size=EMBED_BATCH_SIZE, embed_concurrency=EMBED_CONCURRENCY, layout=None):
+        from langchain_openai import OpenAIEmbeddings
+        from pymongo import MongoClient
+        from process_book import EMBEDDING_MODEL, MONGO_URI, OPENAI_API_KEY, embedding_store_for, metadata_extractor_for
+        if not OPENAI_API_KEY: raise ValueError("OPENAI_API_KEY not found in environment variables.")
+        self.checkpoint = checkpoint
+        self.embed_batch_size = embed_batch_size
+        self.embed_concurrency = embed_concurrency
+        self.layout = layout
+        self.embeddings = OpenAIEmbeddings(model=EMBEDDING_MODEL, api_key=OPENAI_API_KEY, max_retries=0) # Retries handled here
+        self.limiter = RateLimiter()
+        self.embed_pool = ThreadPoolExecutor(max_workers=embed_concurrency, thread_name_prefix="embed")
+        self.mongo_client = MongoClient(MONGO_URI) # One pooled client shared by every book
+        self.store = embedding_store_for(self.mongo_client) # Chunks seen in any earlier run are never re-embedded
+        self.metadata_extractor = metadata_extractor_for(self.mongo_client, self._extract_with_llm)
+        self.stats = {"embedding_requests": 0, "batches_resumed": 0, "chunks": 0, "chunks_embedded": 0}
+        self._stats_lock = threading.Lock()
+
+    def _count(self, key, amount=1):
+        with self._stats_lock: self.stats[key] += amount
+
+    def _embed_remote(self, texts):
+        self.limiter.acquire(sum(len(t) for t in texts) // CHARS_PER_TOKEN + 1)
+        vectors = with_retries(lambda: self.embeddings.embed_documents(texts))
+        self._count("embedding_requests"); self._count("chunks_embedded", len(texts))
+        return vectors
+
+    def _embed_batch(self, sha256, index, texts):
+        cached = self.checkpoint.load_batch(sha256, index)
+        if cached is not None and len(cached) == len(texts):
+            self._count("batches_resumed")
+            return cached
+        vectors = self.store.embed_documents(texts, self._embed_remote) if self.store else self._embed_remote(texts)
+        self.checkpoint.save_batch(sha256, index, vectors)
+        return np.asarray(vectors, dtype=np.float32)
+
+    def embed_batches(self, sha256, texts):
+        """Yields (batch_texts, vectors) in order for a stream of chunk texts. Up to embed_concurrency batches
+        are embedding ahead of the one being yielded; finished batches come from the checkpoint."""
+        from process_book import iter_windows
+        pending = deque()
+        for index, batch in enumerate(iter_windows(texts, self.embed_batch_size)):
+            pending.append((batch, self.embed_pool.submit(self._embed_batch, sha256, index, batch)))
+            if len(pending) > self.embed_concurrency:
+                batch, future = pending.popleft()
+                yield batch, future.result()
+        while pending:
+            batch, future = pending.popleft()
+            yield batch, future.result()
+
+    def _extract_with_llm(self, preview_text, model):
+        from process_book import extract_metadata
+        self.limiter.acquire(len(preview_text) // CHARS_PER_TOKEN + 500)
+        return with_retries(lambda: extract_metadata(preview_text, model))
+
+    def metadata_for(self, entry, sha256, preview_text):
+        """Returns (metadata, resolution); manifest fields win over every extraction tier."""
+        return self.metadata_extractor.extract(entry["path"], preview_text, sha256, known=entry)
+
+    def ingest_loaded(self, entry, sha256, preview_text):
+        """Embeds and stores a book load_and_split has spilled, batch by batch, then records it as done."""
+        from process_book import BookWriter
+        started = time.perf_counter()
+        try:
+            metadata, resolution = self.metadata_for(entry, sha256, preview_text)
+            writer = BookWriter(metadata, entry["path"], layout=self.layout, client=self.mongo_client, file_hash=sha256)
+            try:
+                writer.begin()
+                for texts, vectors in self.embed_batches(sha256, iter_spilled(self.checkpoint.spill_path(sha256))):
+                    writer.write(texts, list(vectors))
+                    self._count("chunks", len(texts))
+                chunk_count = writer.chunk_count
+                mongo_id = writer.finish()
+            finally:
+                writer.close()
+        finally:
+            self.checkpoint.remove_spill(sha256) # Embedded batches stay checkpointed; a retry re-splits the book
+        record = {"sha256": sha256, "path": entry["path"], "title": metadata.get("title"), "mongo_id": str(mongo_id),
+                  "metadata_tier": resolution["tier"], "metadata_sources": resolution["sources"],
+                  "chunks": chunk_count, "seconds": round(time.perf_counter() - started, 2)}
+        self.checkpoint.mark_done(record)
+        return record
+
+    def close(self):
+        self.embed_pool.shutdown(wait=True)
+        self.mongo_client.close()
+
+
+def run(source, workers=None, book_concurrency=BOOK_CONCURRENCY, checkpoint_dir=CHECKPOINT_DIR, layout=None,
+        embed_batch_size=EMBED_BATCH_SIZE, embed_concurrency=EMBED_CONCURRENCY):
+    from process_book import file_sha256
+    started = time.perf_counter()
+    checkpoint = Checkpoint(checkpoint_dir)
+    entries = discover_inputs(source)
+    pending, queued_hashes, skipped = [], set(), 0
+    for entry in entries:
+        entry["sha256"] = file_sha256(entry["path"])
+        if checkpoint.is_done(entry["sha256"]) or entry["sha256"] in queued_hashes: skipped += 1 # Copies share one spill file
+        else: pending.append(entry); queued_hashes.add(entry["sha256"])
+    print(f"📚 {len(entries)} book(s) found: {skipped} already ingested, {len(pending)} to process.")
+
+    report = {"done": [], "failed": [], "skipped": skipped}
+    if not pending: return report
+    ingestor = BulkIngestor(checkpoint, embed_batch_size, embed_concurrency, layout)
+    workers = workers or os.cpu_count() or 1
+    in_flight_limit = book_concurrency + workers # Books loading, loaded and waiting, or being embedded/stored
+    queued = iter(pending)
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as load_pool, ThreadPoolExecutor(max_workers=book_concurrency, thread_name_prefix="book") as book_pool:
+            loads, books = {}, {}
+
+            def submit_loads():
+                # Loaded books are held (spilled) until a book thread takes them, so only load as many as can be in flight
+                while len(loads) + len(books) < in_flight_limit:
+                    entry = next(queued, None)
+                    if entry is None: return
+                    loads[load_pool.submit(load_and_split, entry["path"], checkpoint.spill_path(entry["sha256"]))] = entry
+
+            submit_loads()
+            while loads or books:
+                done, _ = wait([*loads, *books], return_when=FIRST_COMPLETED)
+                for future in done:
+                    if future in loads:
+                        entry = loads.pop(future)
+                        try:
+                            preview_text, _ = future.result()
+                        except Exception as e:
+                            print(f"❌ Failed to load {entry['path']}: {e}")
+                            report["failed"].append({"path": entry["path"], "stage": "load", "error": str(e)})
+                            continue
+                        books[book_pool.submit(ingestor.ingest_loaded, entry, entry["sha256"], preview_text)] = entry
+                        continue
+                    entry = books.pop(future)
+                    try:
+                        record = future.result()
+                        report["done"].append(record)
+                        print(f"✅ {record['title']} ({record['chunks']} chunks, metadata: {record['metadata_tier']}, {record['seconds']}s)")
+                    except Exception as e:
+                        print(f"❌ Failed to ingest {entry['path']}: {e}")
+                        report["failed"].append({"path": entry["path"], "stage": "ingest", "error": str(e)})
+                submit_loads()
+    finally:
+        ingestor.close()
+
+    report.update(ingestor.stats)
+    report["metadata_tiers"] = ingestor.metadata_extractor.stats()
+    report["seconds"] = round(time.perf_counter() - started, 2)
+    with open(os.path.join(checkpoint_dir, "last_report.json"), "w", encoding="utf-8") as f: json.dump(report, f, indent=2)
+    print(f"🎉 Ingested {len(report['done'])}, failed {len(report['failed'])}, skipped {skipped} in {report['seconds']}s "
+          f"({report['embedding_requests']} embedding requests for {report['chunks_embedded']}/{report['chunks']} chunks, "
+          f"{report['batches_resumed']} batches resumed from checkpoint).")
+    print(f"🏷 Metadata resolved by tier: {report['metadata_tiers']}")
+    return report
+
+
+# --- Run from CLI ---
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Bulk-ingest a directory or manifest of books.")
+    parser.add_argument("source", help="Directory of .txt/.pdf files, or a .txt/.jsonl manifest")
+    parser.add_argument("--workers", type=int, default=None, help="Load/split processes (default: CPU count)")
+    parser.add_argument("--books", type=int, default=BOOK_CONCURRENCY, help="Books embedded/stored concurrently")
+    parser.add_argument("--embed-batch-size", type=int, default=EMBED_BATCH_SIZE)
+    parser.add_argument("--embed-concurrency", type=int, default=EMBED_CONCURRENCY)
+    parser.add_argument("--checkpoint-dir", default=CHECKPOINT_DIR)
+    parser.add_argument("--layout", choices=("embedded", "chunks"), default=None, help="Storage layout (default: STORAGE_LAYOUT)")
+    args = parser.parse_args()
+    if not os.path.exists(args.source):
+        print(f"Error: {args.source} not found")
+        sys.exit(1)
+    result = run(args.source, workers=args.workers, book_concurrency=args.books, checkpoint_dir=args.checkpoint_dir,
+                 layout=args.layout, embed_batch_size=args.embed_batch_size, embed_concurrency=args.embed_concurrency)
+    sys.exit(1 if result["failed"] else 0)
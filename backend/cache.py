@@ -0,0 +1,297 @@
+# backend/cache.py
+# Two-tier context cache used by retrieve_context:
+#   tier 1: small in-process LRU (no network)
+#   tier 2: shared Redis (pooled connections, guarded by a circuit breaker)
+# plus per-key single-flight so N concurrent misses for the same key do the work once.
+import os
+import time
+import asyncio
+import threading
+from collections import OrderedDict
+import redis
+from dotenv import load_dotenv
+from metrics import ERRORS, get_logger, stage
+
+load_dotenv()
+log = get_logger("cache")
+
+# --- Configuration ---
+LOCAL_CACHE_SIZE = int(os.getenv("LOCAL_CACHE_SIZE", 1024)) # Entries kept in the in-process LRU
+LOCAL_CACHE_TTL_SECONDS = int(os.getenv("LOCAL_CACHE_TTL_SECONDS", 300)) # Short, so other workers' Redis writes win quickly
+REDIS_MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONNECTIONS", 50))
+REDIS_SOCKET_TIMEOUT = float(os.getenv("REDIS_SOCKET_TIMEOUT", 0.25)) # Seconds; a slow Redis must not stall chats
+REDIS_BREAKER_FAILURES = int(os.getenv("REDIS_BREAKER_FAILURES", 5)) # Consecutive errors before the breaker opens
+REDIS_BREAKER_RESET_SECONDS = float(os.getenv("REDIS_BREAKER_RESET_SECONDS", 30)) # How long it stays open
+
+
+# --- Redis Connection Pool ---
+def make_redis_client(host, port, max_connections=REDIS_MAX_CONNECTIONS, socket_timeout=REDIS_SOCKET_TIMEOUT):
+    """Redis client backed by a bounded, shared connection pool with short timeouts."""
+    pool = redis.BlockingConnectionPool(host=host, port=port, max_connections=max_connections,
+                                        socket_timeout=socket_timeout, socket_connect_timeout=socket_timeout,
+                                        timeout=socket_timeout, decode_responses=True)
+    return redis.Redis(connection_pool=pool)
+
+
+# --- In-Process LRU ---
+class LRUCache:
+    """Thread-safe LRU with a per-entry TTL."""
+
+    def __init__(self, maxsize=LOCAL_CACHE_SIZE, ttl=LOCAL_CACHE_TTL_SECONDS):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict() # key -> (expires_at, value)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None: return None
+            if entry[0] < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, value, ttl=None):
+        if self.maxsize <= 0: return
+        with self._lock:
+            self._data[key] = (time.monotonic() + (ttl or self.ttl), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize: self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock: self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock: self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+# --- Single-Flight ---
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Coalesces concurrent calls for the same key: one caller runs fn, the rest wait for its result."""
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn):
+        """Returns (result, shared) where shared is True if another caller computed it."""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader: call = self._calls[key] = _Call()
+        if not leader:
+            call.done.wait()
+            if call.error is not None: raise call.error
+            return call.result, True
+        try:
+            call.result = fn()
+            return call.result, False
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock: self._calls.pop(key, None)
+            call.done.set()
+
+
+# --- Circuit Breaker ---
+class CircuitBreaker:
+    """Opens after `failure_threshold` consecutive failures; lets one trial call through after `reset_timeout`."""
+
+    def __init__(self, failure_threshold=REDIS_BREAKER_FAILURES, reset_timeout=REDIS_BREAKER_RESET_SECONDS):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None: return "closed"
+        return "half-open" if time.monotonic() - self.opened_at >= self.reset_timeout else "open"
+
+    def allow(self):
+        with self._lock:
+            if self.opened_at is None: return True
+            if time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.opened_at = time.monotonic() # Admit one trial call; others stay blocked until it reports
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def trip(self):
+        """Opens the breaker immediately (e.g. Redis unreachable at startup)."""
+        with self._lock:
+            self.failures = self.failure_threshold
+            self.opened_at = time.monotonic()
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.failure_threshold:
+                if self.opened_at is None: log.warning(f"Redis circuit breaker OPEN for {self.reset_timeout}s after {self.failures} failures.")
+                self.opened_at = time.monotonic()
+
+
+# --- Two-Tier Cache ---
+class TwoTierCache:
+    """LRU in front of Redis. Redis errors trip the breaker and degrade to LRU-only instead of failing."""
+
+    def __init__(self, redis_client=None, ttl=3600, lru=None, breaker=None, namespace="context_cache"):
+        self.redis = redis_client
+        self.ttl = ttl
+        self.lru = lru if lru is not None else LRUCache()
+        self.breaker = breaker if breaker is not None else CircuitBreaker()
+        self.namespace = namespace
+        self.flights = SingleFlight()
+
+    def _redis_call(self, op, *args, **kwargs):
+        if self.redis is None or not self.breaker.allow(): return None
+        try:
+            with stage(f"redis_{op}"): result = getattr(self.redis, op)(*args, **kwargs)
+            self.breaker.record_success()
+            return result
+        except redis.exceptions.RedisError as redis_err:
+            log.warning(f"Redis {op.upper()} error: {redis_err}. Proceeding without shared cache.")
+            ERRORS.inc(stage=f"redis_{op}")
+            self.breaker.record_failure()
+            return None
+
+    def key(self, digest):
+        return f"{self.namespace}:{digest}"
+
+    def shared_call(self, op, *args, **kwargs):
+        """Redis-only command through the breaker (no LRU), for small shared values such as generation counters.
+        Returns None when Redis is unavailable."""
+        return self._redis_call(op, *args, **kwargs)
+
+    def get(self, key):
+        """Returns (value, tier) with tier in {"local", "redis"}, or (None, None) on a miss."""
+        value = self.lru.get(key)
+        if value is not None: return value, "local"
+        value = self._redis_call("get", key)
+        if value is not None:
+            self.lru.set(key, value)
+            return value, "redis"
+        return None, None
+
+    def set(self, key, value, ttl=None):
+        self.lru.set(key, value)
+        self._redis_call("set", key, value, ex=ttl or self.ttl)
+
+    def get_or_compute(self, key, compute, ttl=None):
+        """Cache lookup; on a miss exactly one concurrent caller per key runs compute().
+
+        Returns (value, source) with source in {"local", "redis", "coalesced", "computed"}.
+        Exceptions from compute() are not cached and propagate to every waiting caller.
+        """
+        value, tier = self.get(key)
+        if value is not None: return value, tier
+
+        def fill():
+            value, tier = self.get(key) # Another worker may have filled Redis while we queued
+            if value is not None: return value, tier
+            value = compute()
+            if value is not None: self.set(key, value, ttl)
+            return value, "computed"
+
+        (value, source), shared = self.flights.do(key, fill)
+        return value, ("coalesced" if shared else source)
+
+
+# --- Async Variants (async_app.py) ---
+def make_async_redis_client(host, port, max_connections=REDIS_MAX_CONNECTIONS, socket_timeout=REDIS_SOCKET_TIMEOUT):
+    """redis.asyncio client with the same bounded pool and timeouts as the sync client."""
+    import redis.asyncio as aioredis
+    pool = aioredis.BlockingConnectionPool(host=host, port=port, max_connections=max_connections,
+                                           socket_timeout=socket_timeout, socket_connect_timeout=socket_timeout,
+                                           timeout=socket_timeout, decode_responses=True)
+    return aioredis.Redis(connection_pool=pool)
+
+
+class AsyncSingleFlight:
+    """asyncio version of SingleFlight. The computation runs as its own task and every caller, the first
+    one included, awaits it through asyncio.shield: a caller that is cancelled (its client went away)
+    stops waiting without cancelling the result the others are waiting for."""
+
+    def __init__(self):
+        self._calls = {} # key -> in-flight task (also keeps it referenced until done)
+
+    async def do(self, key, coro_fn):
+        task = self._calls.get(key)
+        shared = task is not None
+        if not shared:
+            task = self._calls[key] = asyncio.get_running_loop().create_task(coro_fn())
+            task.add_done_callback(lambda done: self._finished(key, done))
+        return await asyncio.shield(task), shared
+
+    def _finished(self, key, task):
+        if self._calls.get(key) is task: self._calls.pop(key)
+        if not task.cancelled(): task.exception() # Mark retrieved: a failure nobody awaited any more isn't logged
+
+
+class AsyncTwoTierCache(TwoTierCache):
+    """TwoTierCache over redis.asyncio: same LRU, breaker and keys, awaitable Redis tier."""
+
+    def __init__(self, redis_client=None, ttl=3600, lru=None, breaker=None, namespace="context_cache"):
+        super().__init__(redis_client, ttl, lru, breaker, namespace)
+        self.flights = AsyncSingleFlight()
+
+    async def _redis_call(self, op, *args, **kwargs):
+        if self.redis is None or not self.breaker.allow(): return None
+        try:
+            with stage(f"redis_{op}"): result = await getattr(self.redis, op)(*args, **kwargs)
+            self.breaker.record_success()
+            return result
+        except redis.exceptions.RedisError as redis_err:
+            log.warning(f"Redis {op.upper()} error: {redis_err}. Proceeding without shared cache.")
+            ERRORS.inc(stage=f"redis_{op}")
+            self.breaker.record_failure()
+            return None
+
+    async def shared_call(self, op, *args, **kwargs):
+        return await self._redis_call(op, *args, **kwargs)
+
+    async def get(self, key):
+        value = self.lru.get(key)
+        if value is not None: return value, "local"
+        value = await self._redis_call("get", key)
+        if value is not None:
+            self.lru.set(key, value)
+            return value, "redis"
+        return None, None
+
+    async def set(self, key, value, ttl=None):
+        self.lru.set(key, value)
+        await self._redis_call("set", key, value, ex=ttl or self.ttl)
+
+    async def get_or_compute(self, key, compute, ttl=None):
+        """Async get_or_compute; `compute` is a coroutine function."""
+        value, tier = await self.get(key)
+        if value is not None: return value, tier
+
+        async def fill():
+            value, tier = await self.get(key)
+            if value is not None: return value, tier
+            value = await compute()
+            if value is not None: await self.set(key, value, ttl)
+            return value, "computed"
+
+        (value, source), shared = await self.flights.do(key, fill)
+        return value, ("coalesced" if shared else source)
@@ -0,0 +1,201 @@
+# backend/catalog.py
+# In-memory catalog snapshot behind /api/books, /api/genres and /api/books/<id>.
+# The whole catalog (id, title, author, genre) is loaded with one find() and served from memory
+# with a genre index, cursor pagination and ETags. MongoDB is only queried on refresh:
+#   - when CATALOG_TTL_SECONDS have passed, or
+#   - when ingestion has bumped the corpus generation (generations.py; checked at most
+#     every CATALOG_VERSION_CHECK_SECONDS), so new books show up without waiting for the TTL.
+# A version change is also passed on (on_change) so the servers can refresh their local search indexes.
+import os
+import json
+import time
+import bisect
+import asyncio
+import hashlib
+import threading
+from dotenv import load_dotenv
+from generations import CORPUS_GENERATION_KEY
+from retrievers import matches_filter
+from metrics import get_logger
+
+load_dotenv()
+log = get_logger("catalog")
+
+# --- Configuration ---
+CATALOG_TTL_SECONDS = float(os.getenv("CATALOG_TTL_SECONDS", 300))
+CATALOG_VERSION_CHECK_SECONDS = float(os.getenv("CATALOG_VERSION_CHECK_SECONDS", 1))
+CATALOG_VERSION_KEY = CORPUS_GENERATION_KEY # Every ingestion bumps it
+CATALOG_PAGE_MAX = int(os.getenv("CATALOG_PAGE_MAX", 500)) # Largest page a client may ask for
+CATALOG_PROJECTION = {'_id': 1, 'title': 1, 'author': 1, 'genre': 1}
+CATALOG_QUERY = {'pending': {'$exists': False}} # New books stay out until their ingestion finishes (process_book.BookWriter)
+
+
+# --- Snapshot ---
+class CatalogSnapshot:
+    """Immutable view of the catalog, sorted by _id so cursors stay stable across refreshes."""
+
+    def __init__(self, books, version=None):
+        self.books = sorted(books, key=lambda book: book['_id'])
+        self.by_id = {book['_id']: book for book in self.books}
+        self.by_title = {} # exact title -> books (chat filters match titles exactly, like $vectorSearch)
+        self.by_genre = {} # lowercased genre -> books (case-insensitive match, like the old anchored regex)
+        for book in self.books:
+            self.by_title.setdefault(book.get('title'), []).append(book)
+            if isinstance(book.get('genre'), str): self.by_genre.setdefault(book['genre'].lower(), []).append(book)
+        self._ids = {None: [book['_id'] for book in self.books]}
+        self._ids.update({genre: [book['_id'] for book in books] for genre, books in self.by_genre.items()})
+        self.genres = sorted({book['genre'] for book in self.books if isinstance(book.get('genre'), str) and book['genre']})
+        self.version = version
+        self.etag = hashlib.sha1(json.dumps(self.books, sort_keys=True, default=str).encode()).hexdigest()[:20]
+        self.loaded_at = time.monotonic()
+
+    def list_books(self, genre=None, cursor=None, limit=None):
+        """Returns (page, next_cursor). Without a limit every book after the cursor is returned."""
+        key = genre.lower() if genre else None
+        books = self.by_genre.get(key, []) if key else self.books
+        start = bisect.bisect_right(self._ids.get(key, []), cursor) if cursor else 0
+        if limit is None: return books[start:], None
+        end = start + limit
+        return books[start:end], (books[end - 1]['_id'] if end < len(books) else None)
+
+    def matching_ids(self, filter_criteria):
+        """Ids of the books a chat filter (title / genre / book_id) selects; None for no filter."""
+        if not filter_criteria: return None
+        candidates = self.books
+        title = filter_criteria.get('title')
+        if isinstance(title, str): candidates = self.by_title.get(title, [])
+        return [book['_id'] for book in candidates
+                if matches_filter({'title': book.get('title'), 'genre': book.get('genre'), 'book_id': book['_id']}, filter_criteria)]
+
+    def response_etag(self, *variant):
+        """Strong ETag for one response: snapshot content + the request parameters that shaped it."""
+        digest = hashlib.md5(f"{self.etag}|{json.dumps(variant)}".encode()).hexdigest()[:20]
+        return f'"{digest}"'
+
+
+def etag_matches(if_none_match, etag):
+    """True if an If-None-Match header value covers `etag` (weak comparison, '*' allowed)."""
+    if not if_none_match: return False
+    candidates = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in candidates or etag in [tag[2:] if tag.startswith("W/") else tag for tag in candidates]
+
+
+def parse_page_args(cursor, limit):
+    """Validates ?cursor=&limit=. Returns (cursor, limit) or raises ValueError."""
+    if limit is not None:
+        limit = int(limit)
+        if limit <= 0: raise ValueError("'limit' must be a positive integer.")
+        limit = min(limit, CATALOG_PAGE_MAX)
+    elif cursor:
+        limit = CATALOG_PAGE_MAX
+    return cursor or None, limit
+
+
+def serialize_book(doc):
+    return {**doc, '_id': str(doc['_id'])}
+
+
+# --- Refresh Policy ---
+class Catalog:
+    """Holds the current snapshot and refreshes it on TTL expiry or a version bump.
+
+    load_fn() returns the raw book documents; version_fn() returns the shared version (or None).
+    Only one caller refreshes at a time; everyone else keeps serving the previous snapshot.
+    on_change(version), if given, is called when a refresh finds the version changed since the last
+    snapshot (ingestion happened); it must return quickly (startup.IndexRefresher.request does).
+    """
+
+    def __init__(self, load_fn, version_fn=None, ttl=CATALOG_TTL_SECONDS, version_check_interval=CATALOG_VERSION_CHECK_SECONDS, on_change=None):
+        self.load_fn = load_fn
+        self.version_fn = version_fn
+        self.on_change = on_change
+        self.ttl = ttl
+        self.version_check_interval = version_check_interval
+        self.refreshes = 0
+        self._snapshot = None
+        self._version_checked_at = 0.0
+        self._lock = threading.Lock()
+
+    def _read_version(self):
+        if self.version_fn is None: return None
+        try:
+            return self.version_fn()
+        except Exception as e:
+            log.warning(f"Could not read catalog version: {e}")
+            return None
+
+    def _due(self, snapshot, version):
+        return time.monotonic() - snapshot.loaded_at >= self.ttl or (version is not None and version != snapshot.version)
+
+    def _version_check_due(self):
+        now = time.monotonic()
+        if self.version_fn is None or now - self._version_checked_at < self.version_check_interval: return False
+        self._version_checked_at = now
+        return True
+
+    def _install(self, docs, version):
+        snapshot, previous = CatalogSnapshot([serialize_book(doc) for doc in docs], version), self._snapshot
+        self._snapshot = snapshot
+        self.refreshes += 1
+        log.info(f"Catalog snapshot refreshed: {len(snapshot.books)} books, {len(snapshot.genres)} genres (version {version}).")
+        if self.on_change and previous is not None and version is not None and version != previous.version: self.on_change(version)
+        return snapshot
+
+    def refresh(self):
+        version = self._read_version()
+        return self._install(self.load_fn(), version)
+
+    def get(self):
+        snapshot = self._snapshot
+        if snapshot is None:
+            with self._lock:
+                return self._snapshot or self.refresh()
+        version = self._read_version() if self._version_check_due() else None
+        if self._due(snapshot, version) and self._lock.acquire(blocking=False):
+            try:
+                self._install(self.load_fn(), version if version is not None else self._read_version())
+            except Exception as e:
+                log.warning(f"Catalog refresh failed ({e}); serving the previous snapshot.")
+            finally:
+                self._lock.release()
+        return self._snapshot
+
+    def stats(self):
+        snapshot = self._snapshot
+        if snapshot is None: return {"loaded": False, "refreshes": self.refreshes}
+        return {"loaded": True, "refreshes": self.refreshes, "books": len(snapshot.books), "genres": len(snapshot.genres),
+                "version": snapshot.version, "age_seconds": round(time.monotonic() - snapshot.loaded_at, 1)}
+
+
+class AsyncCatalog(Catalog):
+    """Catalog for async_app.py: load_fn and version_fn are coroutine functions."""
+
+    def __init__(self, load_fn, version_fn=None, ttl=CATALOG_TTL_SECONDS, version_check_interval=CATALOG_VERSION_CHECK_SECONDS, on_change=None):
+        super().__init__(load_fn, version_fn, ttl, version_check_interval, on_change)
+        self._lock = asyncio.Lock()
+
+    async def _read_version(self):
+        if self.version_fn is None: return None
+        try:
+            return await self.version_fn()
+        except Exception as e:
+            log.warning(f"Could not read catalog version: {e}")
+            return None
+
+    async def refresh(self):
+        version = await self._read_version()
+        return self._install(await self.load_fn(), version)
+
+    async def get(self):
+        snapshot = self._snapshot
+        if snapshot is None:
+            async with self._lock:
+                return self._snapshot or await self.refresh()
+        version = await self._read_version() if self._version_check_due() else None
+        if self._due(snapshot, version) and not self._lock.locked():
+            async with self._lock:
+                try:
+                    self._install(await self.load_fn(), version if version is not None else await self._read_version())
+                except Exception as e:
+                    log.warning(f"Catalog refresh failed ({e}); serving the previous snapshot.")
+        return self._snapshot
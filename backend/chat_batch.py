@@ -0,0 +1,101 @@
+# backend/chat_batch.py
+# Shared bookkeeping for /api/chat/batch (app.py and async_app.py).
+# Many questions about the same book(s) share one request, so the expensive steps run once per batch:
+#   - one embed_documents call for every question that needs a vector,
+#   - one fetch of the filtered books' chunks, scored against all questions with one matrix product,
+#   - one chain.batch / abatch call for generation, bounded by CHAT_BATCH_CONCURRENCY.
+# The apps do the I/O; ChatBatch tracks per-question state and keeps results in input order.
+import os
+from dotenv import load_dotenv
+from rerank import rerank_batch
+from lexical import RRF_POOL_FACTOR, rrf_fuse
+from rag import CONTEXT_CANDIDATES, format_context
+from metrics import ERRORS, get_logger
+
+load_dotenv()
+log = get_logger("chat_batch")
+
+# --- Configuration ---
+CHAT_BATCH_MAX_QUESTIONS = int(os.getenv("CHAT_BATCH_MAX_QUESTIONS", 50))
+CHAT_BATCH_CONCURRENCY = int(os.getenv("CHAT_BATCH_CONCURRENCY", 4)) # Parallel LLM calls per batch
+
+
+class ChatBatch:
+    """Per-question state for one batch request.
+
+    Every question ends with exactly one result: {"answer", "cached"} or {"error"}.
+    """
+
+    def __init__(self, questions, book_filter):
+        self.questions = questions
+        self.book_filter = book_filter
+        self.results = [None] * len(questions)
+        self.contexts = {} # index -> retrieved context
+        self.embeddings = {} # index -> query embedding (only for questions that needed one)
+        self.lexical_hits = {} # index -> BM25 hits (hybrid / auto modes)
+        for index, question in enumerate(questions):
+            if not isinstance(question, str) or not question.strip(): self.fail(index, "Each question must be a non-empty string.")
+
+    @classmethod
+    def from_request(cls, data):
+        """Validates {"questions": [...], "book_filter": {...}}. Raises ValueError for request-level problems."""
+        if not isinstance(data, dict): raise ValueError("Request body must be a JSON object.")
+        questions, book_filter = data.get('questions'), data.get('book_filter')
+        if not isinstance(questions, list) or not questions: raise ValueError("'questions' must be a non-empty list.")
+        if len(questions) > CHAT_BATCH_MAX_QUESTIONS: raise ValueError(f"At most {CHAT_BATCH_MAX_QUESTIONS} questions per batch.")
+        if not isinstance(book_filter, dict) or not book_filter: raise ValueError("'book_filter' is required for batch requests.")
+        return cls(questions, book_filter)
+
+    # --- Per-question outcomes ---
+    def pending(self):
+        return [index for index, result in enumerate(self.results) if result is None]
+
+    def fail(self, index, message):
+        self.results[index] = {"error": message}
+
+    def answer(self, index, answer, cached=False):
+        self.results[index] = {"answer": answer, "cached": cached}
+
+    def needs_vectors(self):
+        """Pending questions without a context yet (i.e. not settled by a confident lexical match)."""
+        return [index for index in self.pending() if index not in self.contexts]
+
+    # --- Retrieval ---
+    def add_lexical(self, index, hits, confident, rerank_k=CONTEXT_CANDIDATES):
+        """Records BM25 hits; a lexical-only (or confident auto) match settles the context without an embedding."""
+        if confident: self.contexts[index] = format_context(hits[:rerank_k])
+        else: self.lexical_hits[index] = hits
+
+    def rank(self, indices, chunks, rerank_k=CONTEXT_CANDIDATES):
+        """Builds contexts for `indices` (all embedded) from one shared candidate set."""
+        pool_k = rerank_k * RRF_POOL_FACTOR if any(index in self.lexical_hits for index in indices) else rerank_k
+        ranked = rerank_batch([self.embeddings[index] for index in indices], chunks, pool_k)
+        for index, vector_ranked in zip(indices, ranked):
+            if index in self.lexical_hits: top_chunks = rrf_fuse([vector_ranked, self.lexical_hits[index]], rerank_k)
+            else: top_chunks = vector_ranked[:rerank_k]
+            self.contexts[index] = format_context(top_chunks)
+
+    # --- Generation ---
+    def generation_inputs(self, book_title):
+        """(indices, chain inputs) for every question that still needs an LLM answer."""
+        indices = [index for index in self.pending() if index in self.contexts]
+        return indices, [{"context": self.contexts[index], "question": self.questions[index], "book_title": book_title} for index in indices]
+
+    def add_answers(self, indices, outputs):
+        """Records chain.batch(..., return_exceptions=True) outputs. Returns the indices that succeeded."""
+        answered = []
+        for index, output in zip(indices, outputs):
+            if isinstance(output, Exception):
+                log.error(f"Batch question {index} failed during generation: {output}")
+                ERRORS.inc(stage="llm")
+                self.fail(index, "An error occurred generating the answer.")
+            else:
+                self.answer(index, output)
+                answered.append(index)
+        return answered
+
+    def response(self):
+        for index in self.pending(): self.fail(index, "No context could be retrieved for this question.")
+        return {"results": [{"index": index, "question": question, **result}
+                            for index, (question, result) in enumerate(zip(self.questions, self.results))],
+                "answered": sum(1 for result in self.results if "answer" in result)}
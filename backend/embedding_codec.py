@@ -0,0 +1,168 @@
+# backend/embedding_codec.py
+# Compact storage for chunk embeddings.
+#   "float64": plain BSON array of doubles (original format, ~8 bytes/dim + per-element overhead)
+#   "float32": BSON binary vector (subtype 9, dtype FLOAT32), 4 bytes/dim
+#   "int8":    BSON binary vector (subtype 9, dtype INT8), 1 byte/dim, scalar-quantized per vector
+# Binary vectors are indexable by Atlas Vector Search and decode zero-copy with np.frombuffer.
+import os
+import sys
+import time
+import numpy as np
+from bson.binary import Binary
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# --- Configuration ---
+EMBEDDING_CODEC = os.getenv("EMBEDDING_CODEC", "float64").lower() # Codec used for newly written embeddings
+CODECS = ("float64", "float32", "int8")
+VECTOR_SUBTYPE = 9 # BSON binary subtype for vectors
+DTYPE_FLOAT32 = 0x27 # BSON vector dtype bytes (see bson.binary.BinaryVectorDtype)
+DTYPE_INT8 = 0x03
+_NUMPY_DTYPES = { DTYPE_FLOAT32: np.dtype("<f4"), DTYPE_INT8: np.dtype("i1") }
+
+
+def check_codec(codec):
+    codec = (codec or EMBEDDING_CODEC).lower()
+    if codec not in CODECS: raise ValueError(f"Unknown embedding codec '{codec}' (expected one of {CODECS}).")
+    return codec
+
+
+# --- Encode ---
+def quantize_int8(vector):
+    """Scales a vector so its largest component maps to +/-127. Cosine similarity is scale-invariant,
+    so the per-vector scale does not need to be stored."""
+    vector = np.asarray(vector, dtype=np.float32)
+    peak = float(np.max(np.abs(vector))) if vector.size else 0.0
+    if peak == 0.0: return np.zeros(vector.shape, dtype=np.int8)
+    return np.clip(np.rint(vector * (127.0 / peak)), -127, 127).astype(np.int8)
+
+
+def encode_embedding(vector, codec=None):
+    """Encodes one embedding for storage with the given (or configured) codec."""
+    codec = check_codec(codec)
+    if vector is None: return None
+    if codec == "float64":
+        return [float(x) for x in vector] if isinstance(vector, np.ndarray) else list(vector)
+    if codec == "float32":
+        header, payload = bytes((DTYPE_FLOAT32, 0)), np.asarray(vector, dtype="<f4").tobytes()
+    else:
+        header, payload = bytes((DTYPE_INT8, 0)), quantize_int8(vector).tobytes()
+    return Binary(header + payload, subtype=VECTOR_SUBTYPE)
+
+
+# --- Decode ---
+def decode_embedding(value):
+    """Returns a numpy view of a stored embedding (any codec). Binary vectors are not copied."""
+    if isinstance(value, Binary) and value.subtype == VECTOR_SUBTYPE:
+        dtype = _NUMPY_DTYPES.get(value[0])
+        if dtype is None: raise ValueError(f"Unsupported BSON vector dtype: {value[0]:#x}")
+        return np.frombuffer(value, dtype=dtype, offset=2)
+    if isinstance(value, np.ndarray): return value
+    return np.asarray(value, dtype=np.float32)
+
+
+def stored_codec(value):
+    """Names the codec a stored embedding was written with."""
+    if isinstance(value, Binary) and value.subtype == VECTOR_SUBTYPE:
+        return "int8" if value[0] == DTYPE_INT8 else "float32"
+    return "float64"
+
+
+# --- Backfill ---
+def backfill(books_collection, chunk_collection=None, codec=None, layout=None, batch_size=500):
+    """Re-encodes every stored embedding with `codec` (in place, batched bulk writes)."""
+    from pymongo import UpdateOne
+    from storage import check_layout
+    codec, layout = check_codec(codec), check_layout(layout)
+    updated = 0
+    started = time.perf_counter()
+    if layout == "chunks":
+        ops = []
+        for doc in chunk_collection.find({}, {"_id": 1, "embedding": 1}):
+            if doc.get("embedding") is None or stored_codec(doc["embedding"]) == codec: continue
+            vector = decode_embedding(doc["embedding"])
+            ops.append(UpdateOne({"_id": doc["_id"]}, {"$set": {"embedding": encode_embedding(vector, codec)}}))
+            if len(ops) >= batch_size:
+                updated += chunk_collection.bulk_write(ops, ordered=False).modified_count; ops = []
+        if ops: updated += chunk_collection.bulk_write(ops, ordered=False).modified_count
+    else:
+        for book in books_collection.find({"chunks.0": {"$exists": True}}, {"_id": 1, "title": 1, "chunks": 1}):
+            chunks = book["chunks"]
+            if all(stored_codec(c.get("embedding")) == codec for c in chunks if c.get("embedding") is not None): continue
+            for chunk in chunks:
+                if chunk.get("embedding") is not None:
+                    chunk["embedding"] = encode_embedding(decode_embedding(chunk["embedding"]), codec)
+            books_collection.update_one({"_id": book["_id"]}, {"$set": {"chunks": chunks}})
+            updated += len(chunks)
+            print(f"  Re-encoded '{book.get('title')}' ({len(chunks)} chunks)")
+    print(f"✅ Backfilled {updated} embedding(s) to {codec} in {time.perf_counter() - started:.1f}s.")
+    return updated
+
+
+# --- Recall Impact ---
+def recall_report(vectors, k=10, num_queries=200, seed=0):
+    """Compares exact top-k cosine rankings over `vectors` (float64 baseline) against each codec.
+
+    Queries are perturbed copies of stored vectors, so no embedding API calls are needed.
+    """
+    base = np.asarray(vectors, dtype=np.float64)
+    rng = np.random.default_rng(seed)
+    picks = rng.choice(len(base), size=min(num_queries, len(base)), replace=False)
+    queries = base[picks] + rng.normal(scale=0.01, size=(len(picks), base.shape[1]))
+
+    def ranked(matrix):
+        normalized = matrix / (np.linalg.norm(matrix, axis=1, keepdims=True) + 1e-12)
+        scores = queries @ normalized.T.astype(np.float64)
+        return np.argsort(-scores, axis=1)[:, :k], scores
+
+    truth, truth_scores = ranked(base)
+    report = []
+    for codec in CODECS:
+        # decode_embedding reads plain lists as float32; the float64 row must keep them at full precision
+        decode = (lambda value: np.asarray(value, dtype=np.float64)) if codec == "float64" else decode_embedding
+        decoded = np.stack([decode(encode_embedding(v, codec)) for v in base]).astype(np.float64)
+        top, scores = ranked(decoded)
+        recall = np.mean([len(set(t) & set(p)) / k for t, p in zip(truth, top)])
+        score_error = float(np.mean(np.abs(scores - truth_scores)))
+        encoded = encode_embedding(base[0], codec)
+        size = len(encoded) if isinstance(encoded, Binary) else len(encoded) * 8
+        report.append({ "codec": codec, "recall_at_k": float(recall), "mean_abs_score_error": score_error, "bytes_per_vector": size })
+    return report
+
+
+# --- Run from CLI ---
+# python embedding_codec.py backfill [float32|int8]   -> re-encode stored embeddings
+# python embedding_codec.py recall [k] [sample_size]  -> recall@k of each codec vs the float64 lists
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] not in ("backfill", "recall"):
+        print("Usage: python embedding_codec.py backfill [float32|int8] | recall [k] [sample_size]")
+        sys.exit(1)
+
+    from pymongo import MongoClient
+    from storage import STORAGE_LAYOUT, CHUNK_COLLECTION_NAME
+    client = MongoClient(os.getenv("MONGO_URI", "mongodb://localhost:27017/"))
+    db = client["books"]
+    if sys.argv[1] == "backfill":
+        backfill(db["books"], db[CHUNK_COLLECTION_NAME], codec=sys.argv[2] if len(sys.argv) > 2 else None)
+    else:
+        k = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+        sample_size = int(sys.argv[3]) if len(sys.argv) > 3 else 5000
+        if STORAGE_LAYOUT == "chunks":
+            sample = [d["embedding"] for d in db[CHUNK_COLLECTION_NAME].aggregate([{"$sample": {"size": sample_size}}, {"$project": {"embedding": 1}}])]
+        else:
+            sample = []
+            for book in db["books"].find({}, {"chunks.embedding": 1}):
+                sample.extend(c["embedding"] for c in book.get("chunks", []) if c.get("embedding") is not None)
+                if len(sample) >= sample_size: break
+            sample = sample[:sample_size]
+        if not sample:
+            print("No stored embeddings found."); sys.exit(1)
+        if any(stored_codec(v) != "float64" for v in sample):
+            print("⚠ Sample contains already-compacted vectors; baseline is their decoded values.")
+        vectors = np.stack([decode_embedding(v) for v in sample])
+        print(f"Recall@{k} over {len(vectors)} vectors (baseline: float64 lists)")
+        print(f"{'codec':>8} {'recall':>8} {'score err':>10} {'bytes':>7}")
+        for row in recall_report(vectors, k=k):
+            print(f"{row['codec']:>8} {row['recall_at_k']:>8.4f} {row['mean_abs_score_error']:>10.6f} {row['bytes_per_vector']:>7}")
+    client.close()
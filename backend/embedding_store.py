@@ -0,0 +1,68 @@
+# backend/embedding_store.py
+# Content-addressed embedding store: chunk embeddings keyed by
+# sha256(embedding model + normalized chunk text), kept in MongoDB and reused across
+# books, editions and re-ingestions. Only chunks never seen before hit the embedding API.
+import os
+import hashlib
+import unicodedata
+from dotenv import load_dotenv
+from embedding_codec import encode_embedding, decode_embedding
+
+load_dotenv()
+
+# --- Configuration ---
+EMBEDDING_STORE_ENABLED = os.getenv("EMBEDDING_STORE_ENABLED", "true").lower() in ("1", "true", "yes")
+EMBEDDING_STORE_COLLECTION = os.getenv("EMBEDDING_STORE_COLLECTION", "embedding_store")
+EMBEDDING_STORE_CODEC = "float32" # ada-002 returns float32-precision values, so this is lossless in practice
+LOOKUP_BATCH_SIZE = 1000
+
+
+def normalize_text(text):
+    """Unicode-normalizes and collapses whitespace so cosmetic re-flows don't change the key."""
+    return " ".join(unicodedata.normalize("NFC", text).split())
+
+
+def content_key(text, model):
+    return hashlib.sha256(f"{model}\0{normalize_text(text)}".encode("utf-8")).hexdigest()
+
+
+class EmbeddingStore:
+    def __init__(self, collection, model):
+        self.collection = collection
+        self.model = model
+        self.hits = 0
+        self.misses = 0
+
+    def get_many(self, keys):
+        """Returns {key: vector} for the keys already stored."""
+        found = {}
+        for start in range(0, len(keys), LOOKUP_BATCH_SIZE):
+            batch = keys[start:start + LOOKUP_BATCH_SIZE]
+            for doc in self.collection.find({"_id": {"$in": batch}}, {"embedding": 1}):
+                found[doc["_id"]] = decode_embedding(doc["embedding"])
+        return found
+
+    def put_many(self, vectors_by_key):
+        from pymongo import UpdateOne
+        if not vectors_by_key: return
+        ops = [UpdateOne({"_id": key}, {"$setOnInsert": {"model": self.model, "embedding": encode_embedding(vector, EMBEDDING_STORE_CODEC)}}, upsert=True)
+               for key, vector in vectors_by_key.items()]
+        self.collection.bulk_write(ops, ordered=False)
+
+    def embed_documents(self, texts, embed_fn):
+        """Returns one vector per text, calling embed_fn(list_of_texts) only for unseen content."""
+        keys = [content_key(text, self.model) for text in texts]
+        found = self.get_many(list(dict.fromkeys(keys)))
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in found: missing.setdefault(key, text) # Duplicate chunks are embedded once
+        if missing:
+            vectors = embed_fn(list(missing.values()))
+            if len(vectors) != len(missing): raise ValueError("Mismatch between number of chunks and generated vectors.")
+            fresh = dict(zip(missing.keys(), vectors))
+            self.put_many(fresh)
+            found.update(fresh)
+        self.hits += len(texts) - len(missing)
+        self.misses += len(missing)
+        print(f"🗃 Embedding store: {len(texts) - len(missing)} reused, {len(missing)} embedded.")
+        return [found[key] for key in keys]
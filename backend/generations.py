@@ -0,0 +1,155 @@
+# backend/generations.py
+# Generation counters that version every cache key, so invalidation is one INCR (no key scans)
+# and cached context / answers can live for days:
+#   gen:book:<book_id>  bumped whenever that book is (re-)ingested
+#   gen:corpus          bumped on every ingestion; versions filters spanning many books and the catalog snapshot
+#   gen:model           bumped by hand when embeddings or the index change underneath the cache
+#   gen:prompt          bumped by hand when answers should be regenerated
+# Changing EMBEDDING_MODEL, LLM_MODEL or RAG_TEMPLATE changes the tags on its own.
+import os
+import time
+import hashlib
+import threading
+import redis
+from dotenv import load_dotenv
+from cache import make_redis_client
+from metrics import get_logger
+
+load_dotenv()
+log = get_logger("generations")
+
+# --- Configuration ---
+CORPUS_GENERATION_KEY = "gen:corpus"
+MODEL_GENERATION_KEY = "gen:model"
+PROMPT_GENERATION_KEY = "gen:prompt"
+GENERATION_SCOPES = ("book", "corpus", "model", "prompt")
+GENERATION_CHECK_SECONDS = float(os.getenv("GENERATION_CHECK_SECONDS", 1)) # How long a read counter is trusted locally
+GENERATION_MAX_BOOKS = int(os.getenv("GENERATION_MAX_BOOKS", 8)) # Filters matching more books use the corpus generation
+REDIS_HOST = os.getenv("REDIS_HOST", "localhost")
+REDIS_PORT = int(os.getenv("REDIS_PORT", 6379))
+
+
+def book_generation_key(book_id):
+    return f"gen:book:{book_id}"
+
+
+def fingerprint(*parts):
+    return hashlib.md5("\0".join(parts).encode()).hexdigest()[:8]
+
+
+# --- Reader ---
+class Generations:
+    """Builds cache-key tags from the counters, read through TwoTierCache.shared_call (breaker-guarded).
+
+    Counters are memoized for GENERATION_CHECK_SECONDS, so a burst of requests costs one MGET.
+    If Redis is unavailable the last known (or zero) generations are used.
+    """
+
+    def __init__(self, cache, embedding_model, prompt_fingerprint, check_interval=GENERATION_CHECK_SECONDS):
+        self.cache = cache
+        self.embedding_model = embedding_model
+        self.prompt_fingerprint = prompt_fingerprint
+        self.check_interval = check_interval
+        self._memo = {} # key -> (generation, read_at)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def scope_keys(book_ids):
+        """Counters that version a filter resolved to `book_ids` (None = unfiltered or unknown)."""
+        if book_ids is None or len(book_ids) > GENERATION_MAX_BOOKS: return [CORPUS_GENERATION_KEY]
+        return [book_generation_key(book_id) for book_id in sorted(book_ids)]
+
+    def _stale(self, keys):
+        now = time.monotonic()
+        with self._lock:
+            return [key for key in keys if key not in self._memo or now - self._memo[key][1] >= self.check_interval]
+
+    def _remember(self, keys, values):
+        now = time.monotonic()
+        with self._lock:
+            for key, value in zip(keys, values or [None] * len(keys)):
+                if values is not None: self._memo[key] = (int(value or 0), now)
+                elif key not in self._memo: self._memo[key] = (0, now) # Redis down: fall back to generation 0 for now
+            return dict(self._memo)
+
+    def _tags(self, memo, scope_keys):
+        scope = ",".join(f"{key.rsplit(':', 1)[-1]}={memo[key][0]}" for key in scope_keys)
+        context_tag = f"{self.embedding_model}.{memo[MODEL_GENERATION_KEY][0]}|{scope}"
+        return context_tag, f"{context_tag}|{self.prompt_fingerprint}.{memo[PROMPT_GENERATION_KEY][0]}"
+
+    def read(self, keys):
+        stale = self._stale(keys)
+        values = self.cache.shared_call("mget", stale) if stale else []
+        return self._remember(stale, values)
+
+    def tags(self, book_ids):
+        """(context_tag, answer_tag): the context tag covers the books + embedding model, the answer tag adds the prompt."""
+        scope_keys = self.scope_keys(book_ids)
+        return self._tags(self.read(scope_keys + [MODEL_GENERATION_KEY, PROMPT_GENERATION_KEY]), scope_keys)
+
+    def describe(self, book_ids):
+        """Current counters for the admin endpoint."""
+        keys = [CORPUS_GENERATION_KEY, MODEL_GENERATION_KEY, PROMPT_GENERATION_KEY] + [book_generation_key(b) for b in book_ids]
+        memo = self.read(keys)
+        return {"corpus": memo[CORPUS_GENERATION_KEY][0], "model": memo[MODEL_GENERATION_KEY][0], "prompt": memo[PROMPT_GENERATION_KEY][0],
+                "embedding_model": self.embedding_model, "prompt_fingerprint": self.prompt_fingerprint,
+                "books": {book_id: memo[book_generation_key(book_id)][0] for book_id in book_ids}}
+
+    def bump(self, scope, book_id=None):
+        """Increments one counter (a book bump also bumps the corpus). Returns the new value, or None if Redis is down."""
+        keys = bump_keys(scope, book_id)
+        values = [self.cache.shared_call("incr", key) for key in keys]
+        with self._lock:
+            for key in keys: self._memo.pop(key, None) # Re-read on next use, even if the INCR failed
+        return values[0]
+
+
+class AsyncGenerations(Generations):
+    """Generations over AsyncTwoTierCache."""
+
+    async def read(self, keys):
+        stale = self._stale(keys)
+        values = await self.cache.shared_call("mget", stale) if stale else []
+        return self._remember(stale, values)
+
+    async def tags(self, book_ids):
+        scope_keys = self.scope_keys(book_ids)
+        return self._tags(await self.read(scope_keys + [MODEL_GENERATION_KEY, PROMPT_GENERATION_KEY]), scope_keys)
+
+    async def describe(self, book_ids):
+        keys = [CORPUS_GENERATION_KEY, MODEL_GENERATION_KEY, PROMPT_GENERATION_KEY] + [book_generation_key(b) for b in book_ids]
+        memo = await self.read(keys)
+        return {"corpus": memo[CORPUS_GENERATION_KEY][0], "model": memo[MODEL_GENERATION_KEY][0], "prompt": memo[PROMPT_GENERATION_KEY][0],
+                "embedding_model": self.embedding_model, "prompt_fingerprint": self.prompt_fingerprint,
+                "books": {book_id: memo[book_generation_key(book_id)][0] for book_id in book_ids}}
+
+    async def bump(self, scope, book_id=None):
+        keys = bump_keys(scope, book_id)
+        values = [await self.cache.shared_call("incr", key) for key in keys]
+        with self._lock:
+            for key in keys: self._memo.pop(key, None)
+        return values[0]
+
+
+def bump_keys(scope, book_id=None):
+    if scope not in GENERATION_SCOPES: raise ValueError(f"Unknown generation scope '{scope}'. Use one of {GENERATION_SCOPES}.")
+    if scope == "book":
+        if not book_id: raise ValueError("'book_id' is required to bump a book generation.")
+        return [book_generation_key(book_id), CORPUS_GENERATION_KEY]
+    return [{"corpus": CORPUS_GENERATION_KEY, "model": MODEL_GENERATION_KEY, "prompt": PROMPT_GENERATION_KEY}[scope]]
+
+
+# --- Ingestion Hook ---
+_ingest_redis = None
+
+def bump_book_generation(book_id):
+    """Called after ingestion writes a book: retires its cached context/answers and refreshes catalog snapshots."""
+    global _ingest_redis
+    try:
+        if _ingest_redis is None: _ingest_redis = make_redis_client(REDIS_HOST, REDIS_PORT)
+        pipe = _ingest_redis.pipeline(transaction=False)
+        for key in bump_keys("book", str(book_id)): pipe.incr(key)
+        return pipe.execute()[0]
+    except redis.exceptions.RedisError as e:
+        log.warning(f"Could not bump generation for book {book_id} ({e}); cached answers for it may be stale until they expire.")
+        return None
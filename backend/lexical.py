@@ -0,0 +1,266 @@
+# backend/lexical.py
+# In-process BM25 inverted index over chunk text, for retrieval without an embedding call.
+#   - ingestion writes one segment per book (BM25_INDEX_DIR/segments/<book_id>.jsonl) with
+#     each chunk's text and term counts; re-ingesting a book replaces its segment
+#   - app.py / async_app.py load every segment into one compressed-sparse-row index with
+#     precomputed BM25 impact weights, so a query is a few array gathers and one top-k
+#   - RETRIEVAL_MODE picks how it is used: "vector" (default, unchanged), "lexical",
+#     "hybrid" (reciprocal rank fusion with the vector results) or "auto" (lexical fast path
+#     when the lexical match is confident, hybrid otherwise)
+import os
+import re
+import sys
+import json
+import time
+import threading
+from collections import Counter, deque
+import numpy as np
+from dotenv import load_dotenv
+from retrievers import build_field_index, filter_labels
+from metrics import get_logger
+
+load_dotenv()
+log = get_logger("lexical")
+
+# --- Configuration ---
+RETRIEVAL_MODE = os.getenv("RETRIEVAL_MODE", "vector").lower() # "vector", "lexical", "hybrid" or "auto"
+RETRIEVAL_MODES = ("vector", "lexical", "hybrid", "auto")
+BM25_INDEX_DIR = os.getenv("BM25_INDEX_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "bm25_index"))
+BM25_INGEST_ENABLED = os.getenv("BM25_INGEST_ENABLED", "true").lower() in ("1", "true", "yes") # Write segments at ingestion
+BM25_K1 = float(os.getenv("BM25_K1", 1.2))
+BM25_B = float(os.getenv("BM25_B", 0.75))
+BM25_FASTPATH_COVERAGE = float(os.getenv("BM25_FASTPATH_COVERAGE", 0.85)) # Share of the query's IDF mass the top chunk must contain
+BM25_FASTPATH_MIN_TERMS = int(os.getenv("BM25_FASTPATH_MIN_TERMS", 2)) # ...and at least this many distinct query terms
+RRF_K = 60 # Standard reciprocal rank fusion constant
+RRF_POOL_FACTOR = 4 # Each ranking contributes rerank_k * RRF_POOL_FACTOR results to the fusion
+SEGMENT_DIR = "segments"
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+STOPWORDS = frozenset("""
+a about above after again all am an and any are as at be because been before being below between both but by
+can could did do does doing down during each few for from further had has have having he her here hers him his
+how i if in into is it its itself just me more most my no nor not of off on once only or other our out over own
+same she should so some such than that the their them then there these they this those through to too under
+until up very was we were what when where which while who whom why will with would you your
+""".split())
+
+
+def check_mode(mode):
+    mode = (mode or RETRIEVAL_MODE).lower()
+    if mode not in RETRIEVAL_MODES: raise ValueError(f"Unknown RETRIEVAL_MODE '{mode}'. Use one of {RETRIEVAL_MODES}.")
+    return mode
+
+
+def tokenize(text):
+    return [token for token in TOKEN_PATTERN.findall(text.lower()) if token not in STOPWORDS]
+
+
+def chunk_key(chunk):
+    return (str(chunk.get("book_id")), chunk.get("ordinal"))
+
+
+def rrf_fuse(rankings, limit, k=RRF_K):
+    """Reciprocal rank fusion of several [(score, chunk)] rankings. Returns [(rrf_score, chunk)]."""
+    fused, chunks = {}, {}
+    for ranking in rankings:
+        for rank, (_, chunk) in enumerate(ranking):
+            key = chunk_key(chunk)
+            fused[key] = fused.get(key, 0.0) + 1.0 / (k + rank + 1)
+            chunks.setdefault(key, chunk)
+    best = sorted(fused.items(), key=lambda item: -item[1])[:limit]
+    return [(score, chunks[key]) for key, score in best]
+
+
+# --- Ingestion: Per-Book Segments ---
+class SegmentWriter:
+    """Streams one book's chunks into its segment file; commit() atomically replaces the previous segment."""
+
+    def __init__(self, book_id, title, genre, index_dir=BM25_INDEX_DIR):
+        directory = os.path.join(index_dir, SEGMENT_DIR)
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, f"{book_id}.jsonl")
+        self.tmp_path = self.path + ".tmp"
+        self.file = open(self.tmp_path, "w", encoding="utf-8")
+        self.file.write(json.dumps({"book_id": str(book_id), "title": title, "genre": genre}) + "\n")
+        self.count = 0
+
+    def add(self, ordinal, text):
+        self.file.write(json.dumps({"ordinal": ordinal, "text": text, "tf": Counter(tokenize(text))}) + "\n")
+        self.count += 1
+
+    def commit(self):
+        self.file.close()
+        os.replace(self.tmp_path, self.path)
+        print(f"🔤 Wrote BM25 segment with {self.count} chunks to {self.path}")
+
+    def abort(self):
+        if not self.file.closed: self.file.close()
+        if os.path.exists(self.tmp_path): os.remove(self.tmp_path)
+
+
+# --- In-Memory Index ---
+class BM25Index:
+    """BM25 over every chunk in BM25_INDEX_DIR, stored as CSR postings with precomputed impact weights.
+
+    Postings of term t are doc_ids[indptr[t]:indptr[t+1]] (ascending) with matching weights;
+    a query's scores are the sum of its terms' weights, so no per-query BM25 math is needed.
+    """
+
+    def __init__(self, index_dir=BM25_INDEX_DIR, k1=BM25_K1, b=BM25_B):
+        self.index_dir = index_dir
+        self.k1 = k1
+        self.b = b
+        self.items = [] # label -> {"text", "title", "genre", "book_id", "ordinal"}
+        self.vocab = {} # term -> term id
+        self.indptr = np.zeros(1, dtype=np.int64)
+        self.doc_ids = np.empty(0, dtype=np.int32)
+        self.weights = np.empty(0, dtype=np.float32)
+        self.idf = np.empty(0, dtype=np.float32)
+        self._labels_by_field = {}
+
+    def __len__(self):
+        return len(self.items)
+
+    def load(self, index_dir=None):
+        """Merges every book segment into one index."""
+        index_dir = index_dir or self.index_dir
+        directory = os.path.join(index_dir, SEGMENT_DIR)
+        if not os.path.isdir(directory):
+            raise FileNotFoundError(f"No BM25 segments in {directory}. Ingest books or run: python lexical.py build")
+        started = time.perf_counter()
+        items, vocab, lengths = [], {}, []
+        term_ids, doc_ids, tfs = [], [], []
+        for name in sorted(os.listdir(directory)):
+            if not name.endswith(".jsonl"): continue
+            with open(os.path.join(directory, name), encoding="utf-8") as f:
+                header = json.loads(f.readline())
+                for line in f:
+                    chunk = json.loads(line)
+                    label = len(items)
+                    items.append({"text": chunk["text"], "title": header.get("title"), "genre": header.get("genre"),
+                                  "book_id": header["book_id"], "ordinal": chunk.get("ordinal")})
+                    lengths.append(sum(chunk["tf"].values()))
+                    for term, count in chunk["tf"].items():
+                        term_ids.append(vocab.setdefault(term, len(vocab))); doc_ids.append(label); tfs.append(count)
+        self._finalize(items, vocab, np.asarray(term_ids, dtype=np.int64), np.asarray(doc_ids, dtype=np.int32),
+                       np.asarray(tfs, dtype=np.float32), np.asarray(lengths, dtype=np.float32))
+        log.info(f"Loaded BM25 index with {len(self.items)} chunks, {len(self.vocab)} terms, "
+                 f"{len(self.doc_ids)} postings from {index_dir} in {time.perf_counter() - started:.2f}s.")
+        return self
+
+    def _finalize(self, items, vocab, term_ids, doc_ids, tfs, lengths):
+        order = np.argsort(term_ids, kind="stable") # Stable: doc ids stay ascending within each term
+        term_ids, self.doc_ids, tfs = term_ids[order], doc_ids[order], tfs[order]
+        df = np.bincount(term_ids, minlength=len(vocab)).astype(np.float32)
+        self.indptr = np.concatenate([[0], np.cumsum(df, dtype=np.int64)])
+        n = max(len(items), 1)
+        self.idf = np.log(1.0 + (n - df + 0.5) / (df + 0.5)).astype(np.float32)
+        norm = self.k1 * (1 - self.b + self.b * lengths / (lengths.mean() if len(lengths) else 1.0))
+        self.weights = (self.idf[term_ids] * tfs * (self.k1 + 1) / (tfs + norm[self.doc_ids])).astype(np.float32)
+        self.items, self.vocab = items, vocab
+        self._labels_by_field = build_field_index(items)
+
+    def search(self, query, limit, filter_criteria=None):
+        """Returns ([(bm25_score, chunk)], confidence) honoring the filter.
+
+        confidence is the share of the query's IDF mass present in the top chunk (unknown terms
+        count as maximally rare), or 0.0 when fewer than BM25_FASTPATH_MIN_TERMS terms matched.
+        """
+        terms = list(dict.fromkeys(tokenize(query)))
+        known = [self.vocab[t] for t in terms if t in self.vocab]
+        if not known or not self.items: return [], 0.0
+        scores = np.zeros(len(self.items), dtype=np.float32)
+        for term_id in known:
+            start, end = self.indptr[term_id], self.indptr[term_id + 1]
+            scores[self.doc_ids[start:end]] += self.weights[start:end] # Doc ids are unique within a term
+        allowed = filter_labels(self._labels_by_field, filter_criteria)
+        labels = np.flatnonzero(scores) if allowed is None else allowed[scores[allowed] > 0]
+        if len(labels) == 0: return [], 0.0
+        k = min(limit, len(labels))
+        top = labels[np.argpartition(-scores[labels], k - 1)[:k]] if k < len(labels) else labels
+        top = top[np.argsort(-scores[top])]
+        hits = [(float(scores[label]), self.items[label]) for label in top.tolist()]
+        return hits, self._confidence(int(top[0]), known, len(terms))
+
+    def _confidence(self, label, known, n_terms):
+        max_idf = float(self.idf.max())
+        total = max_idf * (n_terms - len(known)) + float(self.idf[known].sum())
+        matched, matched_idf = 0, 0.0
+        for term_id in known:
+            postings = self.doc_ids[self.indptr[term_id]:self.indptr[term_id + 1]]
+            position = np.searchsorted(postings, label)
+            if position < len(postings) and postings[position] == label:
+                matched += 1; matched_idf += float(self.idf[term_id])
+        if matched < min(BM25_FASTPATH_MIN_TERMS, n_terms): return 0.0
+        return min(1.0, matched_idf / total) if total else 0.0
+
+    def is_confident(self, confidence):
+        return confidence >= BM25_FASTPATH_COVERAGE
+
+
+def load_index(mode=None):
+    """Loads the BM25 index when `mode` needs it; returns None (vector-only) if it doesn't or none exists.
+    The servers call it again after ingestion (app.refresh_indexes) to pick up new segments."""
+    if check_mode(mode) == "vector": return None
+    try:
+        return BM25Index().load()
+    except FileNotFoundError as e:
+        log.warning(f"{e}. Falling back to RETRIEVAL_MODE=vector.")
+        return None
+
+
+# --- Per-Mode Latency ---
+class LatencyStats:
+    """Rolling per-mode retrieval latency (count, mean, p50, p95 over the last `window` calls)."""
+
+    def __init__(self, window=1000):
+        self.window = window
+        self._samples = {}
+        self._counts = Counter()
+        self._lock = threading.Lock()
+
+    def record(self, mode, seconds):
+        with self._lock:
+            self._samples.setdefault(mode, deque(maxlen=self.window)).append(seconds * 1000)
+            self._counts[mode] += 1
+
+    def snapshot(self):
+        with self._lock:
+            report = {}
+            for mode, samples in self._samples.items():
+                values = np.asarray(samples)
+                report[mode] = {"count": self._counts[mode], "mean_ms": round(float(values.mean()), 3),
+                                "p50_ms": round(float(np.percentile(values, 50)), 3), "p95_ms": round(float(np.percentile(values, 95)), 3)}
+            return report
+
+
+# --- Run from CLI ---
+# python lexical.py build          -> (re)write every book's segment from MongoDB
+# python lexical.py query "<text>" -> top hits, confidence and latency for one query
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] not in ("build", "query"):
+        print('Usage: python lexical.py build | query "<text>"')
+        sys.exit(1)
+
+    if sys.argv[1] == "build":
+        from pymongo import MongoClient
+        from storage import CHUNK_COLLECTION_NAME
+        client = MongoClient(os.getenv("MONGO_URI", "mongodb://localhost:27017/"))
+        db = client["books"]
+        for book in db["books"].find({}, {"_id": 1, "title": 1, "genre": 1, "storage_layout": 1, "chunks.text": 1}):
+            segment = SegmentWriter(book["_id"], book.get("title"), book.get("genre"))
+            if book.get("storage_layout") == "chunks":
+                for chunk in db[CHUNK_COLLECTION_NAME].find({"book_id": book["_id"]}, {"_id": 0, "ordinal": 1, "text": 1}).sort("ordinal", 1):
+                    segment.add(chunk["ordinal"], chunk["text"])
+            else:
+                for ordinal, chunk in enumerate(book.get("chunks", [])):
+                    if "text" in chunk: segment.add(ordinal, chunk["text"])
+            segment.commit()
+        client.close()
+    else:
+        index = BM25Index().load()
+        started = time.perf_counter()
+        hits, confidence = index.search(sys.argv[2], 5)
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        print(f"confidence={confidence:.3f} (fast path: {index.is_confident(confidence)}) in {elapsed_ms:.3f} ms")
+        for score, chunk in hits:
+            print(f"{score:8.3f}  {chunk['title']} #{chunk['ordinal']}: {chunk['text'][:100]!r}")
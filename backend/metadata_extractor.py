@@ -0,0 +1,155 @@
+# backend/metadata_extractor.py
+# Tiered book metadata extraction, cheapest source first:
+#   1. free: PDF document info, Project Gutenberg "Title:"/"Author:" headers, filename conventions
+#   2. a cheap chat model (METADATA_CHEAP_MODEL)
+#   3. METADATA_FALLBACK_MODEL (GPT-4), only when the cheap model couldn't identify the book
+# Resolved metadata is cached in MongoDB by file content hash, so re-ingesting a file costs nothing.
+import os
+import re
+import time
+import threading
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# --- Configuration ---
+METADATA_CACHE_ENABLED = os.getenv("METADATA_CACHE_ENABLED", "true").lower() in ("1", "true", "yes")
+METADATA_CACHE_COLLECTION = os.getenv("METADATA_CACHE_COLLECTION", "metadata_cache")
+METADATA_CHEAP_MODEL = os.getenv("METADATA_CHEAP_MODEL", "gpt-4o-mini")
+METADATA_FALLBACK_MODEL = os.getenv("METADATA_FALLBACK_MODEL", "gpt-4")
+FIELDS = ("title", "author", "genre")
+UNKNOWN = {"title": "Unknown Title", "author": "Unknown Author", "genre": "Unknown"}
+TIERS = ("cache", "manifest", "free", "cheap_model", "fallback_model")
+JUNK_TITLES = re.compile(r"^(untitled|unknown|document\d*|microsoft word.*|.*\.(docx?|pdf|txt|indd|qxd))$", re.IGNORECASE)
+
+
+def is_known(metadata, field):
+    value = metadata.get(field)
+    return isinstance(value, str) and bool(value.strip()) and value != UNKNOWN[field]
+
+
+def is_identified(metadata):
+    """Title and author are what the book upsert matches on; genre alone never triggers escalation."""
+    return is_known(metadata, "title") and is_known(metadata, "author")
+
+
+def _clean(value):
+    value = " ".join(str(value or "").split()).strip(" ,;:-")
+    return value if value and not JUNK_TITLES.match(value) else None
+
+
+# --- Free Sources ---
+def gutenberg_header(text):
+    """Reads "Title:" / "Author:" header lines (with indented continuation lines) from a Project Gutenberg text."""
+    found = {}
+    for field in ("title", "author"):
+        match = re.search(rf"^{field.capitalize()}:[ \t]*(.+(?:\n[ \t]+\S.*)*)", text, re.MULTILINE)
+        value = _clean(match.group(1)) if match else None
+        if value: found[field] = value
+    return found
+
+
+def pdf_info(file_path):
+    """Title/author/subject from the PDF document information dictionary, when pypdf is available."""
+    if not file_path.lower().endswith(".pdf"): return {}
+    try:
+        from pypdf import PdfReader
+    except ImportError:
+        return {}
+    try:
+        info = PdfReader(file_path).metadata or {}
+    except Exception as e:
+        print(f"⚠ Could not read PDF document info from {file_path}: {e}")
+        return {}
+    found = {"title": _clean(info.get("/Title")), "author": _clean(info.get("/Author")), "genre": _clean(info.get("/Subject"))}
+    return {field: value for field, value in found.items() if value}
+
+
+def filename_metadata(file_path):
+    """Parses "Title - Author [Genre].ext" (underscores read as spaces; the genre part is optional)."""
+    stem = os.path.splitext(os.path.basename(file_path))[0].replace("_", " ")
+    match = re.match(r"^(?P<title>.+?)\s+-\s+(?P<author>[^\[\]]+?)\s*(?:\[(?P<genre>[^\]]+)\])?$", stem)
+    if not match: return {}
+    found = {field: _clean(match.group(field)) for field in FIELDS}
+    return {field: value for field, value in found.items() if value}
+
+
+def free_metadata(file_path, preview_text):
+    """Merges the free sources field by field. Returns (metadata, sources) with sources[field] = source name."""
+    metadata, sources = {}, {}
+    for source, found in (("pdf_info", pdf_info(file_path)),
+                          ("gutenberg_header", gutenberg_header(preview_text)),
+                          ("filename", filename_metadata(file_path))):
+        for field, value in found.items():
+            if field not in metadata: metadata[field], sources[field] = value, source
+    return metadata, sources
+
+
+# --- Tiered Extractor ---
+class MetadataExtractor:
+    """Resolves title/author/genre for one book at a time, recording which tier resolved it.
+
+    llm_fn(preview_text, model) must return a {"title", "author", "genre"} dict
+    (process_book.extract_metadata). Pass a MongoDB collection to cache results by file hash.
+    """
+
+    def __init__(self, llm_fn, collection=None, cheap_model=METADATA_CHEAP_MODEL, fallback_model=METADATA_FALLBACK_MODEL):
+        self.llm_fn = llm_fn
+        self.collection = collection
+        self.cheap_model = cheap_model
+        self.fallback_model = fallback_model
+        self.counts = {tier: 0 for tier in TIERS}
+        self._lock = threading.Lock()
+
+    def extract(self, file_path, preview_text, file_hash=None, known=None):
+        """Returns (metadata, resolution) with resolution = {"tier": ..., "sources": {field: source}}.
+
+        `known` holds fields that are already authoritative (e.g. from a manifest); they are never overridden.
+        """
+        known = {field: known[field] for field in FIELDS if known and known.get(field)}
+        if len(known) == len(FIELDS):
+            return self._done(known, "manifest", {field: "manifest" for field in FIELDS})
+
+        cached = self._cache_get(file_hash)
+        if cached is not None:
+            metadata = {**cached["metadata"], **known}
+            return self._done(metadata, "cache", {**cached.get("sources", {}), **{field: "manifest" for field in known}})
+
+        found, sources = free_metadata(file_path, preview_text)
+        metadata = {**found, **known}
+        sources.update({field: "manifest" for field in known})
+        tier = "free"
+        if not all(is_known(metadata, field) for field in FIELDS):
+            # A model is still needed (at least for the genre); free and manifest fields take precedence over its guesses
+            for tier, model in (("cheap_model", self.cheap_model), ("fallback_model", self.fallback_model)):
+                print(f"🧠 Metadata tier '{tier}' ({model}) for {os.path.basename(file_path)}; free sources gave: {sorted(metadata)}")
+                guessed = self.llm_fn(preview_text, model)
+                merged = {**guessed, **metadata}
+                if is_identified(merged):
+                    for field in FIELDS:
+                        if field not in metadata and is_known(guessed, field): sources[field] = model
+                    metadata = merged
+                    break
+            else:
+                metadata = merged # Even the fallback model couldn't identify the book; keep its defaults
+        metadata = {field: metadata.get(field) or UNKNOWN[field] for field in FIELDS}
+        if is_identified(metadata): self._cache_put(file_hash, metadata, tier, sources) # Unidentified books get another try next time
+        return self._done(metadata, tier, sources)
+
+    def stats(self):
+        with self._lock: return dict(self.counts)
+
+    def _done(self, metadata, tier, sources):
+        with self._lock: self.counts[tier] += 1
+        print(f"🏷 Metadata resolved by tier '{tier}': {metadata}")
+        return metadata, {"tier": tier, "sources": sources}
+
+    def _cache_get(self, file_hash):
+        if self.collection is None or not file_hash: return None
+        return self.collection.find_one({"_id": file_hash})
+
+    def _cache_put(self, file_hash, metadata, tier, sources):
+        if self.collection is None or not file_hash: return
+        self.collection.replace_one({"_id": file_hash},
+                                    {"metadata": metadata, "tier": tier, "sources": sources, "created_at": time.time()},
+                                    upsert=True)
@@ -0,0 +1,185 @@
+# backend/metrics.py
+# Observability for the serving path (app.py / async_app.py):
+#   - level-gated logging (LOG_LEVEL, LOG_FORMAT=text|json) that stamps every line with the request's trace id,
+#   - in-process counters and latency histograms rendered in the Prometheus text format for GET /metrics,
+#   - per-request trace ids, echoed back in TRACE_HEADER.
+# No client library needed: metrics are a few locked dicts, cheap enough to update on every request.
+import os
+import sys
+import json
+import time
+import uuid
+import logging
+import threading
+import contextvars
+from contextlib import contextmanager
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# --- Configuration ---
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text").lower() # "text" or "json"
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() in ("1", "true", "yes")
+TRACE_IDS_ENABLED = os.getenv("TRACE_IDS_ENABLED", "true").lower() in ("1", "true", "yes")
+TRACE_HEADER = os.getenv("TRACE_HEADER", "X-Trace-Id")
+METRICS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+TOKEN_BUCKETS = (64, 128, 256, 512, 768, 1024, 1536, 2048, 3072, 4096)
+
+
+# --- Trace IDs ---
+_trace_id = contextvars.ContextVar("trace_id", default="-")
+
+def start_trace(incoming=None):
+    """Sets the trace id for the current request (the client's, if it sent a sane one). Returns it, or None if disabled."""
+    if not TRACE_IDS_ENABLED: return None
+    trace_id = incoming if incoming and len(incoming) <= 64 and incoming.replace("-", "").isalnum() else uuid.uuid4().hex[:16]
+    _trace_id.set(trace_id)
+    return trace_id
+
+
+# --- Logging ---
+class _TraceFilter(logging.Filter):
+    def filter(self, record):
+        record.trace_id = _trace_id.get()
+        return True
+
+
+class _JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {"ts": round(record.created, 3), "level": record.levelname, "logger": record.name, "trace_id": record.trace_id, "msg": record.getMessage()}
+        if record.exc_info: entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+
+_configured = False
+_configure_lock = threading.Lock()
+
+def get_logger(name):
+    """Logger under the "pagepal" namespace; the handler is installed once, on first use."""
+    global _configured
+    with _configure_lock:
+        if not _configured:
+            handler = logging.StreamHandler(sys.stdout)
+            handler.addFilter(_TraceFilter())
+            handler.setFormatter(_JsonFormatter() if LOG_FORMAT == "json" else
+                                 logging.Formatter("%(asctime)s %(levelname)s %(name)s [%(trace_id)s] %(message)s"))
+            root = logging.getLogger("pagepal")
+            root.addHandler(handler)
+            root.setLevel(getattr(logging, LOG_LEVEL, logging.INFO))
+            root.propagate = False
+            _configured = True
+    return logging.getLogger(f"pagepal.{name}")
+
+
+# --- Metric Types ---
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _label_text(labelnames, values):
+    if not labelnames: return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in zip(labelnames, values)) + "}"
+
+
+class Counter:
+    def __init__(self, name, help_text, labelnames=()):
+        self.name, self.help, self.labelnames = name, help_text, tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def inc(self, amount=1, **labels):
+        if not METRICS_ENABLED: return
+        key = tuple(labels.get(name, "") for name in self.labelnames)
+        with self._lock: self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock: items = sorted(self._values.items())
+        lines += [f"{self.name}{_label_text(self.labelnames, key)} {value}" for key, value in items]
+        return lines
+
+
+class Gauge:
+    def __init__(self, name, help_text, labelnames=()):
+        self.name, self.help, self.labelnames = name, help_text, tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def set(self, value, **labels):
+        key = tuple(labels.get(name, "") for name in self.labelnames)
+        with self._lock: self._values[key] = value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge"]
+        with self._lock: items = sorted(self._values.items())
+        lines += [f"{self.name}{_label_text(self.labelnames, key)} {value}" for key, value in items]
+        return lines
+
+
+class Histogram:
+    """Per-bucket counts plus sum and count; buckets are made cumulative when rendered."""
+
+    def __init__(self, name, help_text, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name, self.help, self.labelnames = name, help_text, tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._series = {} # label values -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def observe(self, value, **labels):
+        if not METRICS_ENABLED: return
+        key = tuple(labels.get(name, "") for name in self.labelnames)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None: series = self._series[key] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound: series[i] += 1; break
+            series[-2] += value; series[-1] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """Times the block; failures are observed too (and counted in pagepal_errors_total by the caller)."""
+        started = time.perf_counter()
+        try: yield
+        finally: self.observe(time.perf_counter() - started, **labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock: items = sorted((key, list(series)) for key, series in self._series.items())
+        for key, series in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_label_text(self.labelnames + ('le',), key + (bound,))} {cumulative}")
+            lines.append(f"{self.name}_bucket{_label_text(self.labelnames + ('le',), key + ('+Inf',))} {series[-1]}")
+            lines.append(f"{self.name}_sum{_label_text(self.labelnames, key)} {series[-2]}")
+            lines.append(f"{self.name}_count{_label_text(self.labelnames, key)} {series[-1]}")
+        return lines
+
+
+REGISTRY = []
+
+def render_metrics():
+    """Every registered metric in the Prometheus text exposition format."""
+    return "\n".join(line for metric in REGISTRY for line in metric.render()) + "\n"
+
+
+# --- Pipeline Metrics ---
+# Stages: redis_<op>, embed_query, embed_documents, lexical_search, vector_search, extract_candidates,
+# fetch_chunks, rerank, format_context, llm, llm_first_token, llm_batch
+STAGE_SECONDS = Histogram("pagepal_stage_seconds", "Latency of each RAG pipeline stage.", ("stage",))
+PROMPT_CONTEXT_TOKENS = Histogram("pagepal_prompt_context_tokens", "Context tokens placed in the prompt (the template and question add a fixed few).", buckets=TOKEN_BUCKETS)
+CACHE_EVENTS = Counter("pagepal_cache_events_total", "Cache lookups by cache and result.", ("cache", "result"))
+ERRORS = Counter("pagepal_errors_total", "Errors by pipeline stage.", ("stage",))
+REQUESTS = Counter("pagepal_requests_total", "HTTP requests by endpoint and status.", ("endpoint", "status"))
+STARTUP_SECONDS = Gauge("pagepal_startup_seconds", "Startup phases: import, init, warmup, import_to_ready.", ("phase",))
+REQUEST_SECONDS = Histogram("pagepal_request_seconds", "HTTP request latency by endpoint (streams: until the response starts).", ("endpoint",))
+
+
+def stage(name):
+    """with stage("rerank"): ... records the block's latency."""
+    return STAGE_SECONDS.time(stage=name)
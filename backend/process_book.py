@@ -2,14 +2,24 @@
 import os
 import sys
 import json
+import hashlib
+import itertools
+import weakref
 from dotenv import load_dotenv
 from pymongo import MongoClient
+from bson import ObjectId
 # Assuming these are installed: pip install pymongo pypdf2 langchain-openai langchain langchain-community python-dotenv
 from langchain_community.document_loaders import TextLoader, PyPDFLoader
 from langchain_openai import ChatOpenAI
 from langchain.prompts import ChatPromptTemplate
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain_openai import OpenAIEmbeddings
+from embedding_codec import EMBEDDING_CODEC, encode_embedding
+from embedding_store import EmbeddingStore, EMBEDDING_STORE_ENABLED, EMBEDDING_STORE_COLLECTION
+from metadata_extractor import MetadataExtractor, METADATA_CACHE_ENABLED, METADATA_CACHE_COLLECTION, METADATA_FALLBACK_MODEL
+from storage import CHUNK_COLLECTION_NAME, check_layout, chunk_documents, ensure_chunk_indexes
+from lexical import SegmentWriter, BM25_INGEST_ENABLED
+from generations import bump_book_generation
 
 load_dotenv()
 
@@ -22,10 +32,21 @@ CHUNK_SIZE = 1000 # Target size for text chunks
 CHUNK_OVERLAP = 200 # Overlap between chunks
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 EMBEDDING_MODEL = "text-embedding-ada-002"  # Example model name for embeddings
+TEXT_BLOCK_CHARS = 64 * 1024 # .txt files are streamed in blocks of this many characters
+EMBED_WINDOW_SIZE = int(os.getenv("EMBED_WINDOW_SIZE", 256)) # Chunks embedded and stored per round trip
+EMBEDDED_MAX_BOOK_BYTES = 15 * 1024 * 1024 # "embedded" books must fit one 16 MB BSON document (metadata included)
 
 # --- Define Known Genres (use lowercase for case-insensitive check) ---
 KNOWN_GENRES = {"self-help", "devotional", "sci-fi", "biography"}
 
+# --- File Identity ---
+def file_sha256(file_path):
+    """Content hash used to recognise a re-ingested file regardless of its path."""
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""): digest.update(block)
+    return digest.hexdigest()
+
 # --- Load Book ---
 def load_book(file_path):
     """Loads text content from .txt or .pdf files."""
@@ -49,15 +70,46 @@ def load_book(file_path):
     print(f"Total characters loaded: {len(full_text)}")
     return docs, full_text
 
+# --- Streaming Load ---
+def iter_pages(file_path):
+    """Lazily yields (text, continues_previous) segments of a .txt or .pdf file.
+    PDF pages come one at a time from lazy_load(); .txt files are read in TEXT_BLOCK_CHARS
+    blocks, each flagged as continuing the previous one so the splitter can rejoin them."""
+    ext = os.path.splitext(file_path)[1].lower()
+    if ext == ".txt":
+        with open(file_path, encoding="utf-8") as f:
+            for block in iter(lambda: f.read(TEXT_BLOCK_CHARS), ""):
+                yield block, True
+    elif ext == ".pdf":
+        for page in PyPDFLoader(file_path).lazy_load(): # Requires pypdf2
+            if page.page_content: yield page.page_content, False
+    else:
+        raise ValueError(f"Unsupported file type: {ext}")
+
+def read_preview(segments, size=CHUNK_PREVIEW_SIZE):
+    """Consumes just enough leading segments for the metadata preview.
+    Returns (preview_text, segments) where the returned iterator replays the consumed
+    segments before continuing with the rest, so nothing is read twice."""
+    segments = iter(segments)
+    head, length = [], 0
+    for segment in segments:
+        head.append(segment)
+        length += len(segment[0]) + 1
+        if length >= size: break
+    preview = "\n".join(text for text, _ in head)[:size]
+    if not preview.strip():
+         raise ValueError("Loaded content is empty or whitespace.")
+    return preview, itertools.chain(head, segments)
+
 # --- Extract Metadata from AI ---
-def extract_metadata(text):
-    """Uses GPT-4 to extract title, author, and genre from book text."""
+def extract_metadata(text, model=METADATA_FALLBACK_MODEL):
+    """Uses an LLM (GPT-4 by default) to extract title, author, and genre from book text."""
     if not OPENAI_API_KEY:
         raise ValueError("OPENAI_API_KEY not found in environment variables.")
 
-    print("🧠 Extracting metadata using LLM (gpt-4)...")
+    print(f"🧠 Extracting metadata using LLM ({model})...")
     # Use gpt-4 for potentially better extraction, ensure you have access/budget
-    llm = ChatOpenAI(model="gpt-4", temperature=0, api_key=OPENAI_API_KEY)
+    llm = ChatOpenAI(model=model, temperature=0, api_key=OPENAI_API_KEY)
     prompt = ChatPromptTemplate.from_messages([
         ("system", "You are a helpful assistant that extracts book metadata."),
         ("user", "Given the following content from a book, extract:\n"
@@ -119,40 +171,85 @@ def extract_metadata(text):
 
 
 # --- Chunk and Embed ---
-def chunk_and_embed(docs):
-    """Splits documents into chunks and generates embeddings."""
-    if not OPENAI_API_KEY:
-        raise ValueError("OPENAI_API_KEY not found in environment variables.")
-
-    print("Chunking documents...")
-    splitter = RecursiveCharacterTextSplitter(
+def make_splitter():
+    return RecursiveCharacterTextSplitter(
         chunk_size=CHUNK_SIZE,
         chunk_overlap=CHUNK_OVERLAP
     )
-    chunks = splitter.split_documents(docs)
+
+def split_documents(docs):
+    """Splits loaded documents into overlapping text chunks."""
+    print("Chunking documents...")
+    chunks = make_splitter().split_documents(docs)
     if not chunks:
         raise ValueError("No chunks generated after splitting.")
     print(f"📄 Generated {len(chunks)} chunks.")
+    return [chunk.page_content for chunk in chunks]
+
+def iter_chunks(segments, splitter=None):
+    """Lazily splits (text, continues_previous) segments into chunk texts.
+    PDF pages are split on their own, exactly like split_documents. For continuous
+    text the last piece of each block is held back and re-split together with the
+    next block, so chunk boundaries don't depend on where a block happened to end."""
+    splitter = splitter or make_splitter()
+    carry = ""
+    for text, continues in segments:
+        if carry and not continues:
+            yield carry
+            carry = ""
+        pieces = splitter.split_text(carry + text if continues else text)
+        carry = pieces.pop() if continues and pieces else ""
+        yield from pieces
+    if carry: yield carry
+
+def iter_windows(chunks, size=EMBED_WINDOW_SIZE):
+    """Groups a chunk stream into lists of at most `size` chunks."""
+    chunks = iter(chunks)
+    while True:
+        window = list(itertools.islice(chunks, size))
+        if not window: return
+        yield window
+
+def embedding_store_for(client):
+    """Content-addressed embedding store on `client`, or None when disabled."""
+    if not EMBEDDING_STORE_ENABLED: return None
+    return EmbeddingStore(client[DB_NAME][EMBEDDING_STORE_COLLECTION], EMBEDDING_MODEL)
+
+def metadata_extractor_for(client, llm_fn=None):
+    """Tiered metadata extractor, caching results by file hash on `client` unless disabled."""
+    collection = client[DB_NAME][METADATA_CACHE_COLLECTION] if client is not None and METADATA_CACHE_ENABLED else None
+    return MetadataExtractor(llm_fn or extract_metadata, collection)
+
+def embed_texts(texts, embeddings, store=None):
+    """Embeds one batch of chunk texts, going through the embedding store when there is one."""
+    vectors = store.embed_documents(texts, embeddings.embed_documents) if store else embeddings.embed_documents(texts)
+    if len(vectors) != len(texts):
+         raise ValueError("Mismatch between number of chunks and generated vectors.")
+    return vectors
 
-    texts = [chunk.page_content for chunk in chunks]
+def chunk_and_embed(docs, client=None):
+    """Splits documents into chunks and generates embeddings (reusing stored ones for unchanged chunks)."""
+    if not OPENAI_API_KEY:
+        raise ValueError("OPENAI_API_KEY not found in environment variables.")
+
+    texts = split_documents(docs)
 
     print("🤖 Generating embeddings...")
     embeddings = OpenAIEmbeddings(model=EMBEDDING_MODEL, api_key=OPENAI_API_KEY)
-    vectors = embeddings.embed_documents(texts)
-    if len(vectors) != len(texts):
-         raise ValueError("Mismatch between number of chunks and generated vectors.")
+    owns_client = client is None and EMBEDDING_STORE_ENABLED
+    if owns_client: client = MongoClient(MONGO_URI)
+    store = embedding_store_for(client) if client is not None else None
+    try:
+        vectors = embed_texts(texts, embeddings, store)
+    finally:
+        if owns_client: client.close()
     print(f"🔢 Generated {len(vectors)} vectors.")
 
     return texts, vectors
 
 # --- Store Everything in MongoDB ---
-def store_in_mongo(metadata, texts, vectors, file_path):
-    """Stores book metadata, text chunks, and embeddings in MongoDB."""
-    print(f"📦 Connecting to MongoDB at {MONGO_URI}...")
-    client = MongoClient(MONGO_URI)
-    db = client[DB_NAME]
-    collection = db[COLLECTION_NAME]
-
+def resolve_genre(metadata):
+    """Maps the extracted genre onto KNOWN_GENRES, defaulting to 'Unknown'."""
     # --- Genre Handling Logic ---
     extracted_genre = metadata.get("genre", "") # Get extracted genre, default to empty string
     final_genre = "Unknown" # Default to Unknown
@@ -173,52 +270,201 @@ def store_in_mongo(metadata, texts, vectors, file_path):
          print(f"⚠ No valid genre extracted or found. Assigning 'Unknown'.")
          final_genre = "Unknown"
     # --- End Genre Handling ---
+    return final_genre
 
+_indexed_clients = weakref.WeakSet() # Clients whose book/chunk indexes exist; create_index is a round trip, so once per client
 
-    # Structure for the MongoDB document
-    doc = {
-        "file_path": file_path,
-        "title": metadata.get("title", "Unknown Title"),
-        "author": metadata.get("author", "Unknown Author"),
-        "genre": final_genre, # Use the determined final genre
-        "chunks": [
-            {"text": text, "embedding": vector}
-            for text, vector in zip(texts, vectors)
-            # Ensure embedding is not empty/null if vector generation failed for some reason
-            if vector is not None
-        ]
-    }
-    # Optional: Check if book with same title/author already exists to prevent duplicates
-    # existing = collection.find_one({"title": doc["title"], "author": doc["author"]})
-    # if existing:
-    #     print(f"⚠ Book '{doc['title']}' by '{doc['author']}' already exists. Skipping insertion.")
-    #     client.close()
-    #     return existing['_id']
-
-    print(f"💾 Inserting document for '{doc['title']}' (Genre: {doc['genre']}) into MongoDB...")
-    result = collection.insert_one(doc)
-    print(f"✅ Book stored in MongoDB with _id: {result.inserted_id}")
-    client.close()
-    return result.inserted_id
+def ensure_book_indexes(client):
+    """Regular indexes BookWriter relies on (duplicate lookup by file hash, per-book chunk reads/deletes)."""
+    if client in _indexed_clients: return
+    db = client[DB_NAME]
+    db[COLLECTION_NAME].create_index("file_sha256")
+    ensure_chunk_indexes(db[CHUNK_COLLECTION_NAME])
+    _indexed_clients.add(client)
+
+class BookWriter:
+    """Stores one book incrementally so chunk windows can be written as soon as they are embedded.
+    begin() finds an earlier ingestion of the same file or title/author (keeping its _id), write()
+    stages a window of chunks, finish() swaps the staged chunks in for the old ones and bumps the
+    book's generation. Until finish(), readers keep seeing the previous content; an unfinished
+    ingestion is discarded by close() (or by the next begin() for the book, if close() never ran).
+    Staging (either layout) writes chunk documents to the chunk collection under a temporary book_id
+    without title/genre, so filtered searches skip them. "chunks" re-points them in finish() after
+    deleting the old ones; "embedded" reads them back into the book's chunks array in one update, so
+    the book document never holds the old and new chunks at once. write() rejects an "embedded" book
+    that would outgrow EMBEDDED_MAX_BOOK_BYTES (use the chunks layout for those).
+    A new book's document carries pending: True until finish(), which keeps it out of the catalog;
+    finish() records the staging id as ingestion_id, so servers can tell which books changed."""
+
+    def __init__(self, metadata, file_path, layout=None, client=None, file_hash=None):
+        self.layout = check_layout(layout)
+        self.owns_client = client is None
+        if self.owns_client:
+            print(f"📦 Connecting to MongoDB at {MONGO_URI}...")
+            client = MongoClient(MONGO_URI)
+        self.client = client
+        db = client[DB_NAME]
+        self.collection = db[COLLECTION_NAME]
+        self.chunk_collection = db[CHUNK_COLLECTION_NAME]
+        final_genre = resolve_genre(metadata)
+
+        # Structure for the MongoDB document
+        self.doc = {
+            "file_path": file_path,
+            "file_sha256": file_hash or (file_sha256(file_path) if os.path.exists(file_path) else None),
+            "title": metadata.get("title", "Unknown Title"),
+            "author": metadata.get("author", "Unknown Author"),
+            "genre": final_genre, # Use the determined final genre
+        }
+        self.existing = None
+        self.staging_id = None # Temporary book_id of the staged chunk documents; set while an ingestion is open
+        self.chunk_count = 0
+        self.next_ordinal = 0
+        self.staged_bytes = 0 # Estimated BSON size of the staged chunks ("embedded" limit)
+        self.segment = None # BM25 segment for this book (lexical.py), written alongside the chunks
+
+    @property
+    def book_id(self):
+        return self.doc.get("_id")
+
+    def begin(self):
+        doc = self.doc
+        ensure_book_indexes(self.client)
+        # Same file (by content hash) or same title/author: replace that book in place, keeping its _id
+        duplicate_query = []
+        if doc["file_sha256"]: duplicate_query.append({"file_sha256": doc["file_sha256"]})
+        if doc["title"] != "Unknown Title" and doc["author"] != "Unknown Author": # Never merge unidentified books
+            duplicate_query.append({"title": doc["title"], "author": doc["author"]})
+        self.existing = self.collection.find_one({"$or": duplicate_query}, {"_id": 1, "staging_id": 1}) if duplicate_query else None
+        doc["_id"] = self.existing["_id"] if self.existing else ObjectId()
+        self.staging_id = ObjectId()
+
+        if self.existing:
+            # The old content stays live until finish(); only drop what an abandoned earlier attempt staged
+            if self.existing.get("staging_id"): self.chunk_collection.delete_many({"book_id": self.existing["staging_id"]})
+            self.collection.update_one({"_id": doc["_id"]}, {"$set": {"staging_id": self.staging_id}})
+        else:
+            layout_fields = {"storage_layout": "chunks", "chunk_count": 0} if self.layout == "chunks" else {"chunks": []}
+            self.collection.insert_one({**doc, **layout_fields, "staging_id": self.staging_id, "pending": True}) # Hidden from the catalog until finish()
+        if BM25_INGEST_ENABLED: self.segment = SegmentWriter(doc["_id"], doc["title"], doc["genre"])
+        return doc["_id"]
+
+    def write(self, texts, vectors):
+        """Stages one window of (text, vector) pairs."""
+        vectors = [encode_embedding(vector, EMBEDDING_CODEC) if vector is not None else None for vector in vectors] # Compact binary unless EMBEDDING_CODEC=float64
+        if self.layout == "chunks":
+            chunk_docs = chunk_documents(self.staging_id, None, None, texts, vectors, start_ordinal=self.next_ordinal)
+        else:
+            # Ensure embedding is not empty/null if vector generation failed for some reason; array position is the ordinal
+            pairs = [(text, vector) for text, vector in zip(texts, vectors) if vector is not None]
+            chunk_docs = chunk_documents(self.staging_id, None, None, [text for text, _ in pairs], [vector for _, vector in pairs], start_ordinal=self.chunk_count)
+            self.staged_bytes += sum(len(chunk["text"].encode()) + (16 * len(chunk["embedding"]) if isinstance(chunk["embedding"], list) else len(chunk["embedding"])) + 48
+                                     for chunk in chunk_docs)
+            if self.staged_bytes > EMBEDDED_MAX_BOOK_BYTES:
+                raise ValueError(f"'{self.doc['title']}' is too large for the embedded storage layout "
+                                 f"(over {EMBEDDED_MAX_BOOK_BYTES // (1024 * 1024)} MB); ingest it with STORAGE_LAYOUT=chunks.")
+        if chunk_docs: self.chunk_collection.insert_many(chunk_docs, ordered=False)
+        stored = [(chunk["ordinal"], chunk["text"]) for chunk in chunk_docs]
+        if self.segment is not None:
+            for ordinal, text in stored: self.segment.add(ordinal, text)
+        self.next_ordinal += len(texts)
+        self.chunk_count += len(stored)
+        return len(stored)
+
+    def finish(self):
+        """Switches the book over to the staged chunks, retiring the previous ones (either layout)."""
+        doc = self.doc
+        metadata = {key: value for key, value in doc.items() if key != "_id"}
+        if self.layout == "chunks":
+            self.chunk_collection.delete_many({"book_id": doc["_id"]}) # The book has no chunks only between these two writes
+            self.chunk_collection.update_many({"book_id": self.staging_id}, {"$set": {"book_id": doc["_id"], "title": doc["title"], "genre": doc["genre"]}})
+            self.collection.update_one({"_id": doc["_id"]}, {"$set": {**metadata, "storage_layout": "chunks", "chunk_count": self.chunk_count, "ingestion_id": self.staging_id},
+                                                             "$unset": {"staging_id": "", "pending": "", "chunks": "", "staged_chunks": ""}})
+            print(f"🧩 Stored {self.chunk_count} chunk documents in '{CHUNK_COLLECTION_NAME}'.")
+        else:
+            staged = self.chunk_collection.find({"book_id": self.staging_id}, {"_id": 0, "text": 1, "embedding": 1}).sort("ordinal", 1)
+            chunks = [{"text": chunk["text"], "embedding": chunk["embedding"]} for chunk in staged]
+            self.collection.update_one({"_id": doc["_id"]}, {"$set": {**metadata, "chunks": chunks, "ingestion_id": self.staging_id}, # One atomic document update
+                                                             "$unset": {"staging_id": "", "pending": "", "staged_chunks": "", "storage_layout": "", "chunk_count": ""}})
+            # The staged copies, and chunk documents left over if the book was stored with the chunks layout
+            self.chunk_collection.delete_many({"book_id": {"$in": [self.staging_id, doc["_id"]]}})
+        self.staging_id = None
+        if self.segment is not None: self.segment.commit()
+        self.segment = None
+        bump_book_generation(doc["_id"]) # Retires this book's cached context/answers; servers refresh their catalog
+        if self.existing:
+            print(f"♻ Updated existing book '{doc['title']}' (Genre: {doc['genre']}) in place, _id: {doc['_id']}")
+        else:
+            print(f"✅ Book '{doc['title']}' (Genre: {doc['genre']}) stored in MongoDB with _id: {doc['_id']}")
+        self.close()
+        return doc["_id"]
+
+    def discard(self):
+        """Drops an unfinished ingestion's staged chunks (and the book itself, if it was new). Best effort:
+        whatever survives a failure here is cleaned up by the next begin() for the book."""
+        staging_id, self.staging_id = self.staging_id, None
+        if staging_id is None: return
+        try:
+            self.chunk_collection.delete_many({"book_id": staging_id})
+            if not self.existing: self.collection.delete_one({"_id": self.book_id, "staging_id": staging_id})
+            else: self.collection.update_one({"_id": self.book_id, "staging_id": staging_id}, {"$unset": {"staging_id": "", "staged_chunks": ""}})
+            print(f"⚠ Discarded the unfinished ingestion of '{self.doc['title']}'" + ("; its previous content is unchanged." if self.existing else "."))
+        except Exception as e:
+            print(f"⚠ Could not discard the staged chunks of '{self.doc['title']}' ({e}); the next ingestion of it will.")
+
+    def close(self):
+        self.discard()
+        if self.segment is not None: self.segment.abort() # Unfinished book: keep the previous segment, if any
+        self.segment = None
+        if self.owns_client: self.client.close()
+
+def store_in_mongo(metadata, texts, vectors, file_path, layout=None, client=None, file_hash=None):
+    """Stores book metadata, text chunks, and embeddings in MongoDB (embedded or chunk-per-document layout).
+    A book with the same file hash or title/author is updated in place instead of duplicated.
+    Pass an open MongoClient to reuse it across books (it is then left open)."""
+    writer = BookWriter(metadata, file_path, layout=layout, client=client, file_hash=file_hash)
+    try:
+        writer.begin()
+        writer.write(texts, vectors)
+        return writer.finish()
+    finally:
+        writer.close()
 
 # --- Main Pipeline ---
-def process_book(file_path):
-    """Orchestrates the loading, metadata extraction, chunking, embedding, and storage."""
+def process_book(file_path, layout=None):
+    """Orchestrates loading, metadata extraction, chunking, embedding, and storage as one stream.
+    Pages are read lazily and chunks are embedded and stored EMBED_WINDOW_SIZE at a time,
+    so peak memory depends on the window size rather than on the size of the book."""
     print(f"📘 Processing book: {file_path}")
 
     try:
-        # 1. Load
-        docs, full_text = load_book(file_path)
-
-        # 2. Extract Metadata
-        metadata = extract_metadata(full_text)
-        print("🧠 Metadata extracted:", metadata)
-
-        # 3. Chunk and Embed
-        texts, vectors = chunk_and_embed(docs)
-
-        # 4. Store in MongoDB (includes genre check)
-        mongo_id = store_in_mongo(metadata, texts, vectors, file_path)
+        if not OPENAI_API_KEY:
+            raise ValueError("OPENAI_API_KEY not found in environment variables.")
+
+        # 1. Load (lazily) just enough for the metadata preview
+        preview_text, segments = read_preview(iter_pages(file_path))
+        file_hash = file_sha256(file_path)
+
+        client = MongoClient(MONGO_URI)
+        try:
+            # 2. Extract Metadata (free sources and cache first, GPT-4 last)
+            metadata, resolution = metadata_extractor_for(client).extract(file_path, preview_text, file_hash)
+            print(f"🧠 Metadata extracted (tier: {resolution['tier']}):", metadata)
+
+            # 3-4. Chunk, embed and store window by window
+            embeddings = OpenAIEmbeddings(model=EMBEDDING_MODEL, api_key=OPENAI_API_KEY)
+            store = embedding_store_for(client)
+            writer = BookWriter(metadata, file_path, layout=layout, client=client, file_hash=file_hash)
+            try:
+                writer.begin()
+                for window in iter_windows(iter_chunks(segments)):
+                    writer.write(window, embed_texts(window, embeddings, store))
+                    print(f"🔢 Embedded and stored {writer.chunk_count} chunks so far...")
+                mongo_id = writer.finish()
+            finally:
+                writer.close() # Discards the staged chunks (and a new book's placeholder) unless finish() ran
+        finally:
+            client.close()
 
         print(f"🎉 Successfully processed and stored book with ID: {mongo_id}")
         return mongo_id
@@ -230,9 +476,10 @@ def process_book(file_path):
         # Consider more specific error handling or logging
 
 # --- Run from CLI ---
-if __name__ == "_main_":
+if __name__ == "__main__":
     if len(sys.argv) < 2:
         print("Usage: python process_book.py <path_to_book>")
+        print("       (for whole directories or manifests use: python bulk_ingest.py <dir|manifest>)")
         sys.exit(1)
 
     book_path = sys.argv[1]
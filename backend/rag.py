@@ -0,0 +1,137 @@
+# backend/rag.py
+# Prompt, models and context formatting shared by the Flask app (app.py)
+# and the async serving mode (async_app.py).
+import os
+import json
+import logging
+import hashlib
+from dotenv import load_dotenv
+from metrics import PROMPT_CONTEXT_TOKENS, get_logger, stage
+
+load_dotenv()
+log = get_logger("rag")
+
+# --- Configuration ---
+EMBEDDING_MODEL = "text-embedding-ada-002"
+LLM_MODEL = "gpt-3.5-turbo"
+CONTEXT_ERROR_PREFIX = "Error retrieving context"
+NO_DOCUMENTS_CONTEXT = "Could not find any potentially relevant documents in the specified book(s)."
+NO_CONTEXT_FALLBACK = "Could not find relevant context in the specified book(s) after re-ranking."
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", 1500)) # Max prompt tokens spent on context
+CONTEXT_CANDIDATES = int(os.getenv("CONTEXT_CANDIDATES", 12)) # Re-ranked chunks offered to the budget (was a fixed 5)
+MAX_OVERLAP_CHARS = 400 # Longest chunk overlap searched for when joining adjacent chunks (splitter overlap is 200)
+MIN_OVERLAP_CHARS = 8 # Shorter suffix/prefix matches are treated as coincidence
+CONTEXT_SEPARATOR = "\n\n---\n\n"
+
+RAG_TEMPLATE = """You are PagePal, You have to act as you're the book talking to user. You are a helpful assistant discussing the book "{book_title}".
+Strictly base your answer ONLY on the following context extracted from the book.
+Analyze the context provided. If it directly answers the user's question, provide that answer.
+If the context is relevant to the question but doesn't answer it fully, synthesize the information found and state what is available in the text you have access to.
+If the context provided is empty or only contains messages like 'Could not find relevant context...', politely inform the user that you couldn't find specific details on that topic within the text for "{book_title}" and suggest they ask about something else covered in the book.
+use just little of your general knowledge of the book. **Do not** mention the words 'context', 'documents', or 'database' in your final response.
+
+Context:
+{context}
+
+Question: {question}
+Answer:"""
+
+
+def book_title_for(book_filter):
+    return book_filter.get("title", "this book") if book_filter else "this book"
+
+
+def context_cache_digest(query, filter_criteria, mode="vector", generation=None):
+    """Hash of query + filter (+ retrieval mode, when not the default, + generation tag) used as the context cache key."""
+    cache_key_input = f"{query}::{json.dumps(filter_criteria, sort_keys=True)}"
+    if mode != "vector": cache_key_input += f"::{mode}"
+    if generation is not None: cache_key_input += f"::{generation}"
+    return hashlib.md5(cache_key_input.encode()).hexdigest()
+
+
+# --- Token Counting ---
+_encoder = None
+
+def count_tokens(text):
+    """Tokens for LLM_MODEL via tiktoken; falls back to ~4 chars/token if the encoding can't be loaded."""
+    global _encoder
+    if _encoder is None:
+        try:
+            import tiktoken
+            _encoder = tiktoken.encoding_for_model(LLM_MODEL)
+        except Exception as e:
+            log.warning(f"tiktoken encoding unavailable ({e}); estimating tokens from length.")
+            _encoder = False
+    if _encoder is False: return len(text) // 4 + 1
+    return len(_encoder.encode(text, disallowed_special=()))
+
+
+# --- Context Assembly ---
+def join_overlapping(left, right):
+    """Appends right to left, dropping the prefix of right that left already ends with (the splitter overlap)."""
+    for size in range(min(len(left), len(right), MAX_OVERLAP_CHARS), MIN_OVERLAP_CHARS - 1, -1):
+        if left.endswith(right[:size]): return left + right[size:]
+    return f"{left}\n{right}"
+
+
+def merge_spans(chunks):
+    """Merges ranked (score, chunk) pairs into spans: chunks of one book with consecutive ordinals become
+    one passage with the overlap removed. Spans keep the rank of their best chunk."""
+    spans = []
+    by_book = {}
+    for rank, (score, chunk) in enumerate(chunks):
+        by_book.setdefault(str(chunk.get('book_id')), []).append((rank, score, chunk))
+    for members in by_book.values():
+        members.sort(key=lambda m: (m[2].get('ordinal') is None, m[2].get('ordinal') or 0))
+        current = None
+        for rank, score, chunk in members:
+            ordinal = chunk.get('ordinal')
+            if current is not None and ordinal is not None and current['last'] is not None and ordinal - current['last'] <= 1:
+                if ordinal != current['last']: current['text'] = join_overlapping(current['text'], chunk['text'])
+                current.update(last=ordinal, rank=min(current['rank'], rank), score=max(current['score'], score))
+                current['ordinals'].append(ordinal)
+                continue
+            current = { 'title': chunk.get('title', 'Unknown'), 'text': chunk['text'], 'rank': rank, 'score': score, 'last': ordinal, 'ordinals': [ordinal] }
+            spans.append(current)
+    spans.sort(key=lambda span: span['rank'])
+    return spans
+
+
+def render_context(spans):
+    return CONTEXT_SEPARATOR.join(f"Context from '{span['title']}':\n{span['text']}" for span in spans)
+
+
+def format_context(top_chunks, token_budget=CONTEXT_TOKEN_BUDGET):
+    """Builds the context string sent to the LLM from re-ranked (score, chunk) pairs, best first.
+
+    Chunks are taken in rank order while the merged context still fits `token_budget`
+    (the best chunk is always kept); adjacent/overlapping chunks of a book are merged into
+    one span and duplicate texts are dropped. At DEBUG level, logs the spans and the tokens saved versus joining verbatim.
+    """
+    with stage("format_context"): return _format_context(top_chunks, token_budget)
+
+
+def _format_context(top_chunks, token_budget):
+    if not top_chunks: return NO_DOCUMENTS_CONTEXT
+    selected, seen_texts = [], set()
+    context, context_tokens = "", 0
+    for score, chunk in top_chunks:
+        if chunk['text'] in seen_texts: continue # Same passage reached via another book/edition or ordinal
+        trial = render_context(merge_spans(selected + [(score, chunk)]))
+        trial_tokens = count_tokens(trial)
+        if trial_tokens > token_budget and selected: continue # A later, adjacent chunk may still fit
+        selected.append((score, chunk)); seen_texts.add(chunk['text'])
+        context, context_tokens = trial, trial_tokens
+    if not context:
+        log.warning("No context constructed after re-ranking.")
+        return NO_CONTEXT_FALLBACK # Ensure fallback
+    PROMPT_CONTEXT_TOKENS.observe(context_tokens)
+    if log.isEnabledFor(logging.DEBUG): # Per-span scores, the savings (one more tokenization) and the snippet cost real time per request
+        spans = merge_spans(selected)
+        for span in spans:
+            log.debug(f"  - Score: {span['score']:.4f}, Title: {span['title']}, Chunks: {span['ordinals']}")
+        verbatim_tokens = count_tokens(CONTEXT_SEPARATOR.join(f"Context from '{chunk['title']}':\n{chunk['text']}" for _, chunk in selected))
+        log.debug(f"Context: {len(selected)} of {len(top_chunks)} chunks in {len(spans)} span(s), {context_tokens}/{token_budget} tokens "
+                  f"(saved {verbatim_tokens - context_tokens} tokens vs. verbatim chunks).")
+        log.debug(f"Context Snippet Sent to LLM: {context[:500]}...")
+    return context
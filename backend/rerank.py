@@ -0,0 +1,93 @@
+# backend/rerank.py
+# Vectorized re-ranking for retrieve_context.
+# Candidates are stacked into one float32 matrix and scored with a single
+# matrix-vector product; optional Maximal Marginal Relevance (MMR) keeps the
+# overlapping neighbours of one passage (CHUNK_OVERLAP) from filling every slot.
+import os
+import numpy as np
+from dotenv import load_dotenv
+from embedding_codec import decode_embedding
+
+load_dotenv()
+
+# --- Configuration ---
+RERANK_MMR = os.getenv("RERANK_MMR", "false").lower() in ("1", "true", "yes")
+MMR_LAMBDA = float(os.getenv("MMR_LAMBDA", 0.7)) # 1.0 = pure relevance, 0.0 = pure diversity
+MMR_POOL_FACTOR = 4 # MMR only considers the top rerank_k * MMR_POOL_FACTOR by relevance
+
+
+def stack_embeddings(embeddings):
+    """Stacks stored embeddings (lists, arrays or binary vectors) into one contiguous float32 matrix."""
+    if len(embeddings) == 0: return np.empty((0, 0), dtype=np.float32)
+    matrix = np.empty((len(embeddings), len(decode_embedding(embeddings[0]))), dtype=np.float32)
+    for row, embedding in enumerate(embeddings): matrix[row] = decode_embedding(embedding)
+    return matrix
+
+
+def normalize_rows(matrix):
+    """Returns a copy of `matrix` with L2-normalized rows (zero rows stay zero)."""
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+def cosine_scores(query_embedding, normalized):
+    """Cosine similarity of the query against every row of an already row-normalized matrix."""
+    query = np.asarray(query_embedding, dtype=np.float32)
+    return normalized @ (query / (np.linalg.norm(query) or 1.0))
+
+
+def top_k_indices(scores, k):
+    """Indices of the k highest scores, best first (argpartition + sort of k items)."""
+    if k <= 0 or len(scores) == 0: return np.empty(0, dtype=np.int64)
+    if k < len(scores):
+        top = np.argpartition(-scores, k - 1)[:k]
+    else:
+        top = np.arange(len(scores))
+    return top[np.argsort(-scores[top], kind="stable")]
+
+
+def mmr_indices(scores, normalized, k, mmr_lambda=MMR_LAMBDA, pool_size=None):
+    """Greedy MMR selection: argmax of lambda * relevance - (1 - lambda) * max similarity to picks."""
+    pool = top_k_indices(scores, pool_size or k * MMR_POOL_FACTOR)
+    if len(pool) <= 1: return pool
+    pool_vectors = normalized[pool]
+    pairwise = pool_vectors @ pool_vectors.T
+    relevance = scores[pool]
+
+    selected = [0] # Most relevant candidate always goes first
+    max_similarity = pairwise[0].copy()
+    remaining = np.ones(len(pool), dtype=bool); remaining[0] = False
+    while len(selected) < min(k, len(pool)):
+        mmr = mmr_lambda * relevance - (1 - mmr_lambda) * max_similarity
+        mmr[~remaining] = -np.inf
+        best = int(np.argmax(mmr))
+        selected.append(best); remaining[best] = False
+        np.maximum(max_similarity, pairwise[best], out=max_similarity)
+    return pool[selected]
+
+
+def rerank(query_embedding, candidates, top_k, use_mmr=RERANK_MMR, mmr_lambda=MMR_LAMBDA):
+    """Scores candidate chunk dicts against the query and returns [(score, candidate), ...] best first."""
+    if not candidates: return []
+    matrix = stack_embeddings([c['embedding'] for c in candidates])
+    normalized = normalize_rows(matrix)
+    scores = cosine_scores(query_embedding, normalized)
+    if use_mmr:
+        order = mmr_indices(scores, normalized, top_k, mmr_lambda)
+    else:
+        order = top_k_indices(scores, top_k)
+    return [(float(scores[i]), candidates[i]) for i in order]
+
+
+def rerank_batch(query_embeddings, candidates, top_k, use_mmr=RERANK_MMR, mmr_lambda=MMR_LAMBDA):
+    """rerank() for many queries over one shared candidate set: the candidates are decoded and normalized
+    once and scored with a single (queries x candidates) matrix product. Returns one ranked list per query."""
+    if not candidates or len(query_embeddings) == 0: return [[] for _ in query_embeddings]
+    normalized = normalize_rows(stack_embeddings([c['embedding'] for c in candidates]))
+    scores = normalize_rows(np.asarray(query_embeddings, dtype=np.float32)) @ normalized.T
+    ranked = []
+    for row in scores:
+        order = mmr_indices(row, normalized, top_k, mmr_lambda) if use_mmr else top_k_indices(row, top_k)
+        ranked.append([(float(row[i]), candidates[i]) for i in order])
+    return ranked
@@ -0,0 +1,515 @@
+# backend/retrievers.py
+# Retriever backends for app.py's retrieve_context.
+# Each backend turns a query embedding (+ optional book filter) into a list of
+# candidate chunks: {"text", "embedding", "title", "book_id", "ordinal"}.
+import os
+import sys
+import json
+import time
+import threading
+from contextlib import contextmanager
+import numpy as np
+from dotenv import load_dotenv
+from storage import STORAGE_LAYOUT, check_layout, vector_search_path
+from embedding_codec import decode_embedding
+from metrics import get_logger, stage
+
+load_dotenv()
+log = get_logger("retrievers")
+
+# --- Configuration ---
+RETRIEVER_BACKEND = os.getenv("RETRIEVER_BACKEND", "atlas").lower() # "atlas" or "hnsw"
+HNSW_INDEX_DIR = os.getenv("HNSW_INDEX_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "hnsw_index"))
+HNSW_SPACE = "cosine"
+HNSW_M = int(os.getenv("HNSW_M", 16)) # Graph degree: higher = better recall, more memory
+HNSW_EF_CONSTRUCTION = int(os.getenv("HNSW_EF_CONSTRUCTION", 200)) # Build-time beam width
+HNSW_EF_SEARCH = int(os.getenv("HNSW_EF_SEARCH", 64)) # Query-time beam width: the recall/latency knob
+HNSW_INDEX_FILE = "index.bin"
+HNSW_META_FILE = "meta.json"
+HNSW_EXACT_FILTER_MAX = int(os.getenv("HNSW_EXACT_FILTER_MAX", 4096)) # Filtered sets this small are scanned exactly
+FILTER_FIELDS = ("title", "genre", "book_id") # Fields usable in a book filter
+FETCH_CHUNKS_MAX = int(os.getenv("FETCH_CHUNKS_MAX", 20000)) # Largest candidate set fetch_chunks() will return
+
+
+def _filter_values(condition):
+    """Normalizes one filter condition ({'$eq': x}, {'$in': [...]}, or a plain value) to a set."""
+    if isinstance(condition, dict):
+        if "$eq" in condition: return {condition["$eq"]}
+        if "$in" in condition: return set(condition["$in"])
+        raise ValueError(f"Unsupported filter operator: {condition}")
+    return {condition}
+
+
+def matches_filter(item, filter_criteria):
+    """True if an item's metadata satisfies a simple equality/$in filter (same shape as the Atlas filter)."""
+    if not filter_criteria: return True
+    for field, condition in filter_criteria.items():
+        if field not in FILTER_FIELDS: raise ValueError(f"Cannot filter on field '{field}'.")
+        if item.get(field) not in _filter_values(condition): return False
+    return True
+
+
+def build_field_index(items):
+    """(field, value) -> sorted label array for every FILTER_FIELDS value; labels are positions in `items`."""
+    grouped = {}
+    for label, item in enumerate(items):
+        if item is None: continue # Marked deleted (HNSWRetriever.update_from_mongo)
+        for field in FILTER_FIELDS:
+            grouped.setdefault((field, item.get(field)), []).append(label)
+    return { key: np.asarray(labels, dtype=np.int64) for key, labels in grouped.items() }
+
+
+class _ReadWriteLock:
+    """Many readers or one writer; a waiting writer holds off new readers so it is not starved."""
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._readers = 0
+        self._writing = False
+        self._writers_waiting = 0
+
+    @contextmanager
+    def read(self):
+        with self._cond:
+            while self._writing or self._writers_waiting: self._cond.wait()
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._readers -= 1
+                if not self._readers: self._cond.notify_all()
+
+    @contextmanager
+    def write(self):
+        with self._cond:
+            self._writers_waiting += 1
+            while self._writing or self._readers: self._cond.wait()
+            self._writers_waiting -= 1
+            self._writing = True
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._writing = False
+                self._cond.notify_all()
+
+
+def read_ingestions(collection):
+    """book_id -> id of the ingestion that produced its current chunks (None for books stored before those
+    were recorded), for every finished book. A changed value means the book was re-ingested."""
+    return {str(doc['_id']): str(doc['ingestion_id']) if doc.get('ingestion_id') is not None else None
+            for doc in collection.find({'pending': {'$exists': False}}, {'_id': 1, 'ingestion_id': 1})}
+
+
+def iter_mongo_chunks(collection, chunk_collection=None, layout=None, book_ids=None):
+    """Chunk dicts (text, embedding, filter fields, ordinal) from MongoDB in either layout; only
+    `book_ids` (as stored, usually ObjectIds) when given."""
+    layout = check_layout(layout)
+    if layout == "chunks":
+        # Chunks without a title are staged by an ingestion still in progress (process_book.BookWriter)
+        query = {'title': {'$ne': None}}
+        if book_ids is not None: query['book_id'] = {'$in': list(book_ids)}
+        for doc in chunk_collection.find(query, {'_id': 0, 'text': 1, 'embedding': 1, 'title': 1, 'genre': 1, 'book_id': 1, 'ordinal': 1}):
+            if 'text' in doc and doc.get('embedding') is not None:
+                yield { **doc, 'book_id': str(doc.get('book_id')) }
+        return
+    query = {} if book_ids is None else {'_id': {'$in': list(book_ids)}}
+    for doc in collection.find(query, {'_id': 1, 'title': 1, 'genre': 1, 'chunks': 1}):
+        for ordinal, chunk in enumerate(doc.get('chunks', [])):
+            if 'text' in chunk and chunk.get('embedding') is not None:
+                yield { 'text': chunk['text'], 'embedding': chunk['embedding'], 'title': doc.get('title'), 'genre': doc.get('genre'), 'book_id': str(doc['_id']), 'ordinal': ordinal }
+
+
+def filter_labels(labels_by_field, filter_criteria):
+    """Resolves a filter to the sorted array of matching labels (None = no filter)."""
+    if not filter_criteria: return None
+    allowed = None
+    for field, condition in filter_criteria.items():
+        if field not in FILTER_FIELDS: raise ValueError(f"Cannot filter on field '{field}'.")
+        parts = [labels_by_field.get((field, value)) for value in _filter_values(condition)]
+        labels = np.unique(np.concatenate([p for p in parts if p is not None] or [np.empty(0, dtype=np.int64)]))
+        allowed = labels if allowed is None else np.intersect1d(allowed, labels, assume_unique=True)
+    return allowed
+
+
+def _as_object_ids(condition):
+    """Book ids arrive as strings; stored book_id / _id values are ObjectIds."""
+    from bson import ObjectId
+    from bson.errors import InvalidId
+
+    def convert(value):
+        try: return ObjectId(value) if isinstance(value, str) else value
+        except InvalidId: return value
+    return {"$in": [convert(value) for value in _filter_values(condition)]}
+
+
+# --- Base Interface ---
+class BaseRetriever:
+    """Interface: search() returns candidate chunk dicts for re-ranking;
+    fetch_chunks() returns every chunk a (required) filter selects, for scoring many queries against one set."""
+    name = "base"
+
+    def search(self, query_embedding, limit, filter_criteria=None):
+        raise NotImplementedError
+
+    def fetch_chunks(self, filter_criteria, max_chunks=FETCH_CHUNKS_MAX):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+# --- MongoDB Atlas $vectorSearch ---
+class AtlasVectorRetriever(BaseRetriever):
+    """Runs $vectorSearch against MongoDB (network round trip per query).
+
+    "embedded" layout: searches the books collection and returns every chunk of each hit book.
+    "chunks" layout: searches the chunk collection and returns only the matching chunks.
+    """
+    name = "atlas"
+
+    def __init__(self, collection, index_name, layout=None):
+        self.collection = collection
+        self.index_name = index_name
+        self.layout = check_layout(layout)
+        self.path = vector_search_path(self.layout)
+
+    def projection(self):
+        if self.layout == "chunks":
+            return { '_id': 0, 'text': 1, 'embedding': 1, 'title': 1, 'book_id': 1, 'ordinal': 1 }
+        return { '_id': 1, 'title': 1, 'chunks': 1 }
+
+    def build_pipeline(self, query_embedding, limit, filter_criteria=None):
+        search_stage = { '$vectorSearch': { 'index': self.index_name, 'path': self.path, 'queryVector': list(query_embedding), 'numCandidates': limit * 10, 'limit': limit } }
+        if filter_criteria:
+            search_stage['$vectorSearch']['filter'] = filter_criteria
+            log.debug(f"Applying vector search filter: {filter_criteria}")
+        return [ search_stage, { '$project': self.projection() } ]
+
+    def find_query(self, filter_criteria):
+        """The book filter as a plain find() query (book_id is the books' _id in the embedded layout)."""
+        if not filter_criteria: raise ValueError("fetch_chunks requires a book filter.")
+        query = {}
+        for field, condition in filter_criteria.items():
+            if field not in FILTER_FIELDS: raise ValueError(f"Cannot filter on field '{field}'.")
+            if field == "book_id": query['_id' if self.layout == "embedded" else 'book_id'] = _as_object_ids(condition)
+            else: query[field] = condition
+        return query
+
+    def extract_candidates(self, results):
+        candidate_chunks = []
+        if self.layout == "chunks":
+            for doc in results:
+                if 'text' in doc and 'embedding' in doc and doc.get('title') is not None: # No title: staged by an ingestion still in progress
+                    candidate_chunks.append({ 'text': doc['text'], 'embedding': doc['embedding'], 'title': doc.get('title', 'Unknown'), 'book_id': str(doc.get('book_id')), 'ordinal': doc.get('ordinal') })
+            return candidate_chunks
+        for doc in results:
+            doc_title = doc.get('title', 'Unknown')
+            for ordinal, chunk_data in enumerate(doc.get('chunks', [])):
+                if 'text' in chunk_data and 'embedding' in chunk_data:
+                    candidate_chunks.append({ 'text': chunk_data['text'], 'embedding': chunk_data['embedding'], 'title': doc_title, 'book_id': str(doc.get('_id')), 'ordinal': ordinal })
+        return candidate_chunks
+
+    def search(self, query_embedding, limit, filter_criteria=None):
+        with stage("vector_search"): results = list(self.collection.aggregate(self.build_pipeline(query_embedding, limit, filter_criteria)))
+        log.debug(f"MongoDB $vectorSearch returned {len(results)} candidate {'chunk' if self.layout == 'chunks' else 'document'}(s).")
+        with stage("extract_candidates"): return self.extract_candidates(results)
+
+    def fetch_chunks(self, filter_criteria, max_chunks=FETCH_CHUNKS_MAX):
+        """One find() for every chunk of the filtered book(s); no vector search."""
+        cursor = self.collection.find(self.find_query(filter_criteria), self.projection())
+        if self.layout == "chunks": cursor = cursor.limit(max_chunks + 1)
+        with stage("fetch_chunks"): results = list(cursor)
+        with stage("extract_candidates"): return check_fetched(self.extract_candidates(results), max_chunks)
+
+
+# --- Local HNSW Index ---
+class HNSWRetriever(BaseRetriever):
+    """In-process HNSW index (hnswlib, shipped as chroma-hnswlib) over every stored chunk.
+
+    The graph lives in HNSW_INDEX_DIR/index.bin; chunk text and filter fields live in
+    meta.json, keyed by hnswlib label (= position in the items list). Servers keep it current
+    after ingestion with update_from_mongo (only re-ingested books are read; their old labels are
+    marked deleted and left as None in items until the next full build).
+    """
+    name = "hnsw"
+
+    def __init__(self, index_dir=HNSW_INDEX_DIR, ef_search=HNSW_EF_SEARCH):
+        self.index_dir = index_dir
+        self.ef_search = ef_search
+        self.index = None
+        self.items = [] # label -> {"text", "title", "genre", "book_id", "ordinal"}, or None once deleted
+        self.deleted = 0 # Labels marked deleted
+        self.ingestions = {} # book_id -> ingestion id the indexed chunks came from (read_ingestions)
+        self._labels_by_field = {} # (field, value) -> np.ndarray of labels
+        self._rwlock = _ReadWriteLock() # Searches read; update_from_mongo writes
+
+    # --- Build / Persist ---
+    def build(self, chunks, dim, m=HNSW_M, ef_construction=HNSW_EF_CONSTRUCTION, batch_size=10000):
+        """Builds a fresh index from an iterable of chunk dicts that carry an 'embedding'."""
+        import hnswlib
+        capacity = 1024
+        self.index = hnswlib.Index(space=HNSW_SPACE, dim=dim)
+        self.index.init_index(max_elements=capacity, M=m, ef_construction=ef_construction)
+        self.items, self.deleted = [], 0
+        batch_vectors, batch_labels = [], []
+
+        def flush():
+            nonlocal capacity
+            if not batch_vectors: return
+            needed = len(self.items)
+            if needed > capacity:
+                while capacity < needed: capacity *= 2
+                self.index.resize_index(capacity)
+            self.index.add_items(np.asarray(batch_vectors, dtype=np.float32), np.asarray(batch_labels))
+            batch_vectors.clear(); batch_labels.clear()
+
+        for chunk in chunks:
+            label = len(self.items)
+            self.items.append({ 'text': chunk['text'], 'title': chunk.get('title'), 'genre': chunk.get('genre'), 'book_id': chunk.get('book_id'), 'ordinal': chunk.get('ordinal') })
+            batch_vectors.append(decode_embedding(chunk['embedding'])); batch_labels.append(label)
+            if len(batch_vectors) >= batch_size: flush()
+        flush()
+        self.index.set_ef(self.ef_search)
+        self._build_field_index()
+        log.info(f"Built HNSW index with {len(self.items)} chunks (dim={dim}, M={m}, ef_construction={ef_construction}).")
+        return self
+
+    def build_from_mongo(self, collection, m=HNSW_M, ef_construction=HNSW_EF_CONSTRUCTION, chunk_collection=None, layout=None):
+        """Builds the index from MongoDB: embedded book chunks, or the chunk collection for the "chunks" layout."""
+        ingestions = read_ingestions(collection) # Read first: a book finishing mid-build is picked up by the next update
+        chunks = iter_mongo_chunks(collection, chunk_collection, layout)
+        first = next(chunks, None)
+        if first is None: raise ValueError("No chunks with embeddings found in MongoDB.")
+
+        def with_first():
+            yield first
+            yield from chunks
+        self.build(with_first(), dim=len(decode_embedding(first['embedding'])), m=m, ef_construction=ef_construction)
+        self.ingestions = ingestions
+        return self
+
+    def update_from_mongo(self, collection, chunk_collection=None, layout=None):
+        """Incrementally applies ingestions finished since the index was built or last updated: the chunks of
+        new and re-ingested books are added, and the previous labels of re-ingested or removed books are
+        marked deleted. Only the changed books are read from MongoDB; searches wait only while the new
+        labels are linked in."""
+        from bson import ObjectId
+        current = read_ingestions(collection)
+        changed = [book_id for book_id, ingestion in current.items() if book_id not in self.ingestions or self.ingestions[book_id] != ingestion]
+        removed = [book_id for book_id in self.ingestions if book_id not in current]
+        if not changed and not removed: return self
+        book_ids = [ObjectId(book_id) if ObjectId.is_valid(book_id) else book_id for book_id in changed]
+        chunks = list(iter_mongo_chunks(collection, chunk_collection, layout, book_ids)) if changed else []
+        vectors = np.asarray([decode_embedding(chunk['embedding']) for chunk in chunks], dtype=np.float32)
+        items = [{ 'text': chunk['text'], 'title': chunk.get('title'), 'genre': chunk.get('genre'), 'book_id': chunk.get('book_id'), 'ordinal': chunk.get('ordinal') } for chunk in chunks]
+        stale = np.concatenate([self._labels_by_field[('book_id', book_id)] for book_id in changed + removed
+                                if ('book_id', book_id) in self._labels_by_field] or [np.empty(0, dtype=np.int64)])
+
+        # The field index only changes for the affected keys; it is swapped in with the graph update
+        start = len(self.items)
+        by_field = dict(self._labels_by_field)
+        for key in {(field, self.items[label].get(field)) for label in stale.tolist() for field in FILTER_FIELDS}:
+            kept = by_field[key][~np.isin(by_field[key], stale)]
+            if len(kept): by_field[key] = kept
+            else: del by_field[key]
+        for key, labels in build_field_index(items).items():
+            labels = labels + start
+            by_field[key] = np.concatenate([by_field[key], labels]) if key in by_field else labels
+
+        with self._rwlock.write():
+            for label in stale.tolist():
+                self.index.mark_deleted(label)
+                self.items[label] = None
+            if items:
+                needed = start + len(items)
+                if needed > self.index.get_max_elements(): self.index.resize_index(max(needed, 2 * self.index.get_max_elements()))
+                self.index.add_items(vectors, np.arange(start, needed))
+                self.items.extend(items)
+            self.deleted += len(stale)
+            self._labels_by_field = by_field
+        self.ingestions = current
+        log.info(f"HNSW index updated: {len(changed)} book(s) indexed ({len(items)} chunks), {len(removed)} removed, "
+                 f"{len(stale)} stale chunk(s) marked deleted ({self.deleted} in total).")
+        return self
+
+    def save(self, index_dir=None):
+        index_dir = index_dir or self.index_dir
+        os.makedirs(index_dir, exist_ok=True)
+        self.index.save_index(os.path.join(index_dir, HNSW_INDEX_FILE))
+        meta = { 'space': HNSW_SPACE, 'dim': self.index.dim, 'M': self.index.M, 'ef_construction': self.index.ef_construction, 'items': self.items, 'ingestions': self.ingestions }
+        tmp_path = os.path.join(index_dir, HNSW_META_FILE + ".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f: json.dump(meta, f)
+        os.replace(tmp_path, os.path.join(index_dir, HNSW_META_FILE))
+        log.info(f"Saved HNSW index ({len(self.items)} chunks) to {index_dir}")
+
+    def load(self, index_dir=None):
+        import hnswlib
+        index_dir = index_dir or self.index_dir
+        meta_path = os.path.join(index_dir, HNSW_META_FILE)
+        if not os.path.exists(meta_path):
+            raise FileNotFoundError(f"No HNSW index at {index_dir}. Build it with: python retrievers.py build")
+        with open(meta_path, encoding="utf-8") as f: meta = json.load(f)
+        self.items = meta['items']
+        self.deleted = sum(item is None for item in self.items)
+        # Indexes saved before ingestion ids were recorded: treat every indexed book as unchanged
+        self.ingestions = meta.get('ingestions') or {item['book_id']: None for item in self.items if item is not None}
+        self.index = hnswlib.Index(space=meta['space'], dim=meta['dim'])
+        self.index.load_index(os.path.join(index_dir, HNSW_INDEX_FILE), max_elements=len(self.items))
+        self.index.set_ef(self.ef_search)
+        self._build_field_index()
+        log.info(f"Loaded HNSW index with {len(self.items)} chunks from {index_dir} (ef={self.ef_search}).")
+        return self
+
+    def _build_field_index(self):
+        self._labels_by_field = build_field_index(self.items)
+
+    def set_ef(self, ef):
+        self.ef_search = ef
+        if self.index is not None: self.index.set_ef(ef)
+
+    # --- Query ---
+    def allowed_labels(self, filter_criteria):
+        """Resolves a filter to the sorted array of matching labels (None = no filter)."""
+        return filter_labels(self._labels_by_field, filter_criteria)
+
+    def knn_labels(self, query_embedding, limit, filter_criteria=None):
+        """Returns (labels, distances) of the nearest chunks honoring the filter."""
+        if self.index is None: raise ValueError("HNSW index not loaded.")
+        query = np.asarray(query_embedding, dtype=np.float32).reshape(1, -1)
+        allowed = self.allowed_labels(filter_criteria)
+        if allowed is None:
+            k = min(limit, len(self.items) - self.deleted)
+            if k == 0: return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+            labels, distances = self.index.knn_query(query, k=k)
+            return labels[0], distances[0]
+        if len(allowed) == 0: return allowed, np.empty(0, dtype=np.float32)
+        k = min(limit, len(allowed))
+        if len(allowed) <= HNSW_EXACT_FILTER_MAX: return self._exact_labels(query[0], allowed, k)
+        allowed_set = set(allowed.tolist())
+        try:
+            labels, distances = self.index.knn_query(query, k=k, filter=allowed_set.__contains__)
+        except RuntimeError: # Graph walk found fewer than k filtered neighbours at this ef
+            return self._exact_labels(query[0], allowed, k)
+        return labels[0], distances[0]
+
+    def _exact_labels(self, query, allowed, k):
+        """Brute-force cosine search restricted to `allowed` (used for single-book filters)."""
+        vectors = np.asarray(self.index.get_items(allowed), dtype=np.float32)
+        scores = (vectors @ query) / ((np.linalg.norm(vectors, axis=1) * np.linalg.norm(query)) + 1e-12)
+        top = np.argpartition(-scores, k - 1)[:k] if k < len(scores) else np.arange(len(scores))
+        top = top[np.argsort(-scores[top])]
+        return allowed[top], 1.0 - scores[top]
+
+    def candidates(self, labels):
+        """Candidate chunk dicts (with vectors read back from the index) for an array of labels."""
+        if len(labels) == 0: return []
+        vectors = np.asarray(self.index.get_items(labels), dtype=np.float32)
+        candidates = []
+        for label, vector in zip(labels.tolist(), vectors):
+            item = self.items[label]
+            candidates.append({ 'text': item['text'], 'embedding': vector, 'title': item.get('title') or 'Unknown', 'book_id': item.get('book_id'), 'ordinal': item.get('ordinal') })
+        return candidates
+
+    def search(self, query_embedding, limit, filter_criteria=None):
+        with self._rwlock.read():
+            with stage("vector_search"): labels, _ = self.knn_labels(query_embedding, limit, filter_criteria)
+            with stage("extract_candidates"): candidates = self.candidates(labels)
+        log.debug(f"HNSW search returned {len(candidates)} candidate chunk(s).")
+        return candidates
+
+    def fetch_chunks(self, filter_criteria, max_chunks=FETCH_CHUNKS_MAX):
+        if self.index is None: raise ValueError("HNSW index not loaded.")
+        if not filter_criteria: raise ValueError("fetch_chunks requires a book filter.")
+        with self._rwlock.read():
+            allowed = self.allowed_labels(filter_criteria)
+            check_fetched(allowed, max_chunks)
+            with stage("fetch_chunks"): return self.candidates(allowed)
+
+    # --- Recall vs Latency ---
+    def evaluate(self, queries, k=20, ef_values=(16, 32, 64, 128, 256), filter_criteria=None):
+        """Measures recall@k against exact search and per-query latency for each ef."""
+        vectors = np.asarray(self.index.get_items(np.arange(len(self.items))), dtype=np.float32)
+        vectors /= np.linalg.norm(vectors, axis=1, keepdims=True) + 1e-12
+        queries = np.asarray(queries, dtype=np.float32)
+        allowed = self.allowed_labels(filter_criteria)
+        truth = []
+        for query in queries:
+            scores = vectors @ (query / (np.linalg.norm(query) + 1e-12))
+            if allowed is not None:
+                masked = np.full_like(scores, -np.inf); masked[allowed] = scores[allowed]; scores = masked
+            top = np.argpartition(-scores, min(k, len(scores) - 1))[:k]
+            truth.append(set(top[np.isfinite(scores[top])].tolist()))
+
+        report = []
+        original_ef = self.ef_search
+        for ef in ef_values:
+            self.set_ef(max(ef, k))
+            latencies, recalls = [], []
+            for query, expected in zip(queries, truth):
+                start = time.perf_counter()
+                labels, _ = self.knn_labels(query, k, filter_criteria)
+                latencies.append((time.perf_counter() - start) * 1000)
+                if expected: recalls.append(len(expected & set(labels.tolist())) / len(expected))
+            report.append({ 'ef': ef, 'recall': float(np.mean(recalls)) if recalls else 0.0, 'p50_ms': float(np.percentile(latencies, 50)), 'p95_ms': float(np.percentile(latencies, 95)) })
+        self.set_ef(original_ef)
+        return report
+
+
+def check_fetched(candidates, max_chunks):
+    if len(candidates) > max_chunks:
+        raise ValueError(f"Book filter selects more than {max_chunks} chunks; narrow it to fewer books.")
+    return candidates
+
+
+# --- Factory ---
+def build_retriever(backend, collection=None, index_name=None, layout=None, chunk_collection=None):
+    """Creates the configured retriever; 'hnsw' loads its index from disk."""
+    backend = (backend or RETRIEVER_BACKEND).lower()
+    if backend == "atlas":
+        layout = check_layout(layout)
+        target = chunk_collection if layout == "chunks" else collection
+        if target is None: raise ValueError("Atlas retriever requires a MongoDB collection.")
+        return AtlasVectorRetriever(target, index_name, layout)
+    if backend == "hnsw":
+        return HNSWRetriever().load()
+    raise ValueError(f"Unknown retriever backend: {backend}")
+
+
+def refresh_retriever(retriever, collection=None, layout=None, chunk_collection=None):
+    """A retriever that sees books ingested since `retriever` was built. Atlas queries MongoDB live and is
+    returned as is; an HNSW index is updated in place with just the changed books (the saved index on
+    disk is left alone: run `python retrievers.py build` so restarts start from the current corpus)."""
+    if retriever.name != "hnsw": return retriever
+    return retriever.update_from_mongo(collection, chunk_collection=chunk_collection, layout=layout)
+
+
+# --- Run from CLI ---
+# python retrievers.py build                 -> build HNSW index from MongoDB and save it
+# python retrievers.py bench [k] [ef,ef,...] -> recall@k vs latency for the saved index
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] not in ("build", "bench"):
+        print("Usage: python retrievers.py build | bench [k] [ef1,ef2,...]")
+        sys.exit(1)
+
+    if sys.argv[1] == "build":
+        from pymongo import MongoClient
+        from storage import CHUNK_COLLECTION_NAME
+        client = MongoClient(os.getenv("MONGO_URI", "mongodb://localhost:27017/"))
+        db = client["books"]
+        retriever = HNSWRetriever().build_from_mongo(db["books"], chunk_collection=db[CHUNK_COLLECTION_NAME], layout=STORAGE_LAYOUT)
+        retriever.save()
+        client.close()
+    else:
+        k = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+        ef_values = [int(ef) for ef in sys.argv[3].split(",")] if len(sys.argv) > 3 else [16, 32, 64, 128, 256]
+        retriever = HNSWRetriever().load()
+        # Query with perturbed copies of stored chunks so no embedding API calls are needed
+        rng = np.random.default_rng(0)
+        sample = rng.choice(len(retriever.items), size=min(200, len(retriever.items)), replace=False)
+        queries = np.asarray(retriever.index.get_items(sample), dtype=np.float32)
+        queries += rng.normal(scale=0.02, size=queries.shape).astype(np.float32)
+        print(f"{'ef':>6} {'recall@' + str(k):>10} {'p50 ms':>8} {'p95 ms':>8}")
+        for row in retriever.evaluate(queries, k=k, ef_values=ef_values):
+            print(f"{row['ef']:>6} {row['recall']:>10.4f} {row['p50_ms']:>8.3f} {row['p95_ms']:>8.3f}")
@@ -0,0 +1,199 @@
+# backend/semantic_cache.py
+# Semantic answer cache for /api/chat.
+# Stores full rag_chain answers per book filter and returns one when a new query's
+# embedding is within SEMANTIC_CACHE_THRESHOLD cosine similarity of a cached query
+# ("who is the main character?" ~ "who's the protagonist").
+import os
+import json
+import time
+import threading
+from collections import OrderedDict
+import numpy as np
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# --- Configuration ---
+SEMANTIC_CACHE_ENABLED = os.getenv("SEMANTIC_CACHE_ENABLED", "true").lower() in ("1", "true", "yes")
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", 0.95)) # Min cosine similarity for a hit
+SEMANTIC_CACHE_MAX_ENTRIES = int(os.getenv("SEMANTIC_CACHE_MAX_ENTRIES", 2000)) # Per book filter; oldest evicted first
+SEMANTIC_CACHE_MAX_SCOPES = int(os.getenv("SEMANTIC_CACHE_MAX_SCOPES", 1000)) # Book filters held; least recently used dropped first
+SEMANTIC_CACHE_MAX_TOTAL_ENTRIES = int(os.getenv("SEMANTIC_CACHE_MAX_TOTAL_ENTRIES", 20000)) # Across all filters, same eviction
+SCOPE_INITIAL_SLOTS = 16 # A scope's embedding buffer starts this small and doubles up to SEMANTIC_CACHE_MAX_ENTRIES
+SEMANTIC_CACHE_TTL_SECONDS = int(os.getenv("SEMANTIC_CACHE_TTL_SECONDS", 86400))
+HISTOGRAM_FLOOR = 0.80 # Best-match similarities below this share one bucket
+HISTOGRAM_STEP = 0.01
+
+
+def normalize_query(query):
+    return " ".join(query.lower().split())
+
+
+def scope_key(filter_criteria):
+    """Answers are only reused within the same book filter."""
+    return json.dumps(filter_criteria or {}, sort_keys=True)
+
+
+# --- Per-Scope Flat Index ---
+class _ScopeIndex:
+    """Ring buffer (up to `capacity`) of normalized query embeddings searched with one matrix-vector product,
+    plus the scope's exact-text entries. The buffer grows geometrically, so a scope holding a few answers
+    costs a few rows rather than capacity x dim floats."""
+
+    def __init__(self, capacity, generation=None):
+        self.capacity = capacity
+        self.generation = generation # Cache-key tag (generations.py) the entries were stored under
+        self.vectors = None # (allocated slots, dim) float32, allocated on first insert
+        self.entries = [] # slot -> {"query", "answer", "expires_at"}
+        self.exact = {} # normalized query -> entry, oldest first
+        self.next_slot = 0
+        self.size = 0
+
+    def add(self, unit_vector, entry):
+        slot = self.next_slot
+        if self.vectors is None:
+            self.vectors = np.zeros((min(SCOPE_INITIAL_SLOTS, self.capacity), len(unit_vector)), dtype=np.float32)
+        elif slot == len(self.vectors): # Only reached while filling: slots are allocated in order
+            grown = np.zeros((min(self.capacity, 2 * len(self.vectors)), self.vectors.shape[1]), dtype=np.float32)
+            grown[:slot] = self.vectors
+            self.vectors = grown
+        evicted = self.entries[slot] if slot < len(self.entries) else None
+        if evicted is None: self.entries.append(entry)
+        else: self.entries[slot] = entry
+        self.vectors[slot] = unit_vector
+        self.next_slot = (slot + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+        return evicted
+
+    def add_exact(self, key, entry):
+        """Indexes `entry` under its normalized text, dropping the oldest exact entry beyond capacity."""
+        self.exact.pop(key, None) # Re-inserted at the end: a repeat store makes the key the newest
+        self.exact[key] = entry
+        if len(self.exact) > self.capacity: self.exact.pop(next(iter(self.exact)))
+
+    def best_match(self, unit_vector):
+        """Returns (slot, similarity) of the closest live entry, or (None, -1.0)."""
+        if self.size == 0: return None, -1.0
+        scores = self.vectors[:self.size] @ unit_vector
+        now = time.time()
+        for slot in np.argsort(-scores)[:8]: # Skip a few expired entries before giving up
+            entry = self.entries[slot]
+            if entry is not None and entry["expires_at"] > now: return int(slot), float(scores[slot])
+        return None, -1.0
+
+
+# --- Semantic Cache ---
+class SemanticCache:
+    """Answer cache keyed by exact normalized text first, then by query-embedding similarity."""
+
+    def __init__(self, threshold=SEMANTIC_CACHE_THRESHOLD, max_entries=SEMANTIC_CACHE_MAX_ENTRIES, ttl=SEMANTIC_CACHE_TTL_SECONDS,
+                 max_scopes=SEMANTIC_CACHE_MAX_SCOPES, max_total_entries=SEMANTIC_CACHE_MAX_TOTAL_ENTRIES):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_scopes = max_scopes
+        self.max_total_entries = max_total_entries
+        self._scopes = OrderedDict() # scope -> _ScopeIndex, least recently used first
+        self._total_entries = 0 # Sum of len(index.exact) over every scope
+        self._lock = threading.Lock()
+        self._stats = { "exact_lookups": 0, "exact_hits": 0, "lookups": 0, "semantic_hits": 0, "misses": 0, "near_misses": 0, "stores": 0, "scope_evictions": 0 }
+        self._histogram = {} # best-match similarity bucket -> count
+
+    def lookup_exact(self, query, filter_criteria, generation=None):
+        """Embedding-free lookup for a repeated query string. Returns the cached answer or None."""
+        with self._lock:
+            self._stats["exact_lookups"] += 1
+            index = self._touch(scope_key(filter_criteria))
+            entry = index.exact.get(normalize_query(query)) if index else None
+            if entry is None or entry["expires_at"] <= time.time() or entry["generation"] != generation: return None
+            self._stats["exact_hits"] += 1
+            return entry["answer"]
+
+    def lookup(self, query_embedding, filter_criteria, generation=None):
+        """Returns (answer, similarity, matched_query) for the closest cached query above threshold, else None.
+        Entries stored under a different generation (the book was re-ingested since) never match."""
+        unit = self._unit(query_embedding)
+        with self._lock:
+            self._stats["lookups"] += 1
+            index = self._touch(scope_key(filter_criteria))
+            if index is not None and index.generation != generation: index = None
+            slot, similarity = index.best_match(unit) if index else (None, -1.0)
+            if slot is not None: self._record_similarity(similarity)
+            if slot is not None and similarity >= self.threshold:
+                self._stats["semantic_hits"] += 1
+                entry = index.entries[slot]
+                return entry["answer"], similarity, entry["query"]
+            self._stats["misses"] += 1
+            if slot is not None and similarity >= self.threshold - 0.02: self._stats["near_misses"] += 1
+            return None
+
+    def store(self, query, query_embedding, filter_criteria, answer, generation=None):
+        """Caches an answer. With query_embedding=None (no embedding was computed) it is exact-only: found by
+        lookup_exact, never by lookup."""
+        scope = scope_key(filter_criteria)
+        entry = { "query": query, "answer": answer, "expires_at": time.time() + self.ttl, "generation": generation }
+        with self._lock:
+            index = self._touch(scope)
+            if index is not None and index.generation != generation: # Newer generation: drop the scope's old answers
+                self._drop_scope(scope)
+                index = None
+            if index is None: index = self._scopes[scope] = _ScopeIndex(self.max_entries, generation)
+            held = len(index.exact)
+            evicted = index.add(self._unit(query_embedding), entry) if query_embedding is not None else None
+            if evicted is not None:
+                evicted_key = normalize_query(evicted["query"])
+                if index.exact.get(evicted_key) is evicted: index.exact.pop(evicted_key) # A later store of the same query owns the key now
+            index.add_exact(normalize_query(query), entry)
+            self._total_entries += len(index.exact) - held
+            self._stats["stores"] += 1
+            self._evict_scopes()
+
+    def invalidate(self, filter_criteria=None):
+        """Drops one book filter's answers (or everything when no filter is given)."""
+        with self._lock:
+            if filter_criteria is None:
+                self._scopes.clear(); self._total_entries = 0; return
+            self._drop_scope(scope_key(filter_criteria))
+
+    def _touch(self, scope):
+        """The scope's index (marked most recently used), or None."""
+        index = self._scopes.get(scope)
+        if index is not None: self._scopes.move_to_end(scope)
+        return index
+
+    def _drop_scope(self, scope):
+        index = self._scopes.pop(scope, None)
+        if index is not None: self._total_entries -= len(index.exact)
+
+    def _evict_scopes(self):
+        """Drops least recently used scopes beyond max_scopes / max_total_entries (never the one just stored to)."""
+        while len(self._scopes) > 1 and (len(self._scopes) > self.max_scopes or self._total_entries > self.max_total_entries):
+            self._drop_scope(next(iter(self._scopes)))
+            self._stats["scope_evictions"] += 1
+
+    def stats(self):
+        """Hit rates and best-match similarity distribution, for tuning SEMANTIC_CACHE_THRESHOLD.
+        `lookups` counts embedding lookups only; a query reaches one after an exact miss, so
+        hit_rate = (exact + semantic hits) / (exact hits + embedding lookups)."""
+        with self._lock:
+            stats = dict(self._stats)
+            hits = stats["exact_hits"] + stats["semantic_hits"]
+            decided = stats["exact_hits"] + stats["lookups"]
+            stats["hit_rate"] = hits / decided if decided else 0.0
+            stats["exact_hit_rate"] = stats["exact_hits"] / stats["exact_lookups"] if stats["exact_lookups"] else 0.0
+            stats["semantic_hit_rate"] = stats["semantic_hits"] / stats["lookups"] if stats["lookups"] else 0.0
+            stats["threshold"] = self.threshold
+            stats["scopes"] = len(self._scopes)
+            stats["entries"] = self._total_entries
+            stats["similarity_histogram"] = { f"{bucket:.2f}": count for bucket, count in sorted(self._histogram.items()) }
+            return stats
+
+    def _record_similarity(self, similarity):
+        bucket = max(HISTOGRAM_FLOOR, np.floor(similarity / HISTOGRAM_STEP) * HISTOGRAM_STEP)
+        bucket = round(float(bucket), 2)
+        self._histogram[bucket] = self._histogram.get(bucket, 0) + 1
+
+    @staticmethod
+    def _unit(vector):
+        vector = np.asarray(vector, dtype=np.float32)
+        return vector / (np.linalg.norm(vector) or 1.0)
@@ -0,0 +1,228 @@
+# backend/startup.py
+# Lazy, retrying component initialization for app.py / async_app.py.
+# The web app comes up immediately (liveness); Redis/Mongo/OpenAI clients, the retriever and the BM25 index
+# are built by init_fn on a background thread (or on first request), retried with exponential backoff
+# on failure, optionally warmed up, and only then does readiness turn true.
+# Forking servers (gunicorn --preload) import the app in the parent: every forked child drops whatever the
+# parent built or was building and initializes its own clients (see Startup._after_fork). STARTUP_MODE=lazy
+# keeps the parent from initializing at all.
+import os
+import time
+import asyncio
+import threading
+from dotenv import load_dotenv
+from metrics import STARTUP_SECONDS, get_logger
+
+load_dotenv()
+log = get_logger("startup")
+
+# --- Configuration ---
+STARTUP_MODE = os.getenv("STARTUP_MODE", "background").lower() # "background", "lazy" (first request) or "eager" (block create_app)
+STARTUP_WARMUP = os.getenv("STARTUP_WARMUP", "true").lower() in ("1", "true", "yes") # Preload indexes/pools before ready
+INIT_RETRY_BASE_SECONDS = float(os.getenv("INIT_RETRY_BASE_SECONDS", 1))
+INIT_RETRY_MAX_SECONDS = float(os.getenv("INIT_RETRY_MAX_SECONDS", 30))
+INIT_WAIT_SECONDS = float(os.getenv("INIT_WAIT_SECONDS", 10)) # How long a request waits for an in-progress init
+STARTUP_MODES = ("background", "lazy", "eager")
+INDEX_REFRESH_ENABLED = os.getenv("INDEX_REFRESH_ENABLED", "true").lower() in ("1", "true", "yes") # Refresh local indexes after ingestion
+INDEX_REFRESH_MIN_SECONDS = float(os.getenv("INDEX_REFRESH_MIN_SECONDS", 60)) # At most one refresh per this many seconds
+
+
+def check_startup_mode(mode):
+    mode = (mode or STARTUP_MODE).lower()
+    if mode not in STARTUP_MODES: raise ValueError(f"Unknown STARTUP_MODE '{mode}' (expected one of {STARTUP_MODES}).")
+    return mode
+
+
+class Startup:
+    """Runs init_fn (then warmup_fn) until it succeeds; safe to call from many request threads.
+
+    `imported_at` is time.perf_counter() taken when the app module started importing, so
+    import_to_ready_seconds covers imports, connections and warm-up.
+    """
+
+    def __init__(self, init_fn, warmup_fn=None, imported_at=None, warmup=STARTUP_WARMUP):
+        self.init_fn = init_fn
+        self.warmup_fn = warmup_fn if warmup else None
+        self.imported_at = imported_at if imported_at is not None else time.perf_counter()
+        self.ready = False
+        self.attempts = 0
+        self.last_error = None
+        self.next_attempt_at = 0.0
+        self.timings = {}
+        self._lock = threading.Lock()
+        self._thread = None
+        self.mode = None # Set by start()
+
+    # --- Bookkeeping shared with AsyncStartup ---
+    def _due(self):
+        return not self.ready and time.monotonic() >= self.next_attempt_at
+
+    def _failed(self, e):
+        self.attempts += 1
+        self.last_error = f"{type(e).__name__}: {e}"
+        delay = min(INIT_RETRY_MAX_SECONDS, INIT_RETRY_BASE_SECONDS * 2 ** (self.attempts - 1))
+        self.next_attempt_at = time.monotonic() + delay
+        log.error(f"Initialization attempt {self.attempts} failed ({self.last_error}); retrying in {delay:.1f}s.")
+
+    def _succeeded(self, init_seconds, warmup_seconds):
+        self.attempts += 1
+        self.timings.update(init_seconds=round(init_seconds, 3), warmup_seconds=round(warmup_seconds, 3),
+                            import_to_ready_seconds=round(time.perf_counter() - self.imported_at, 3))
+        for phase, seconds in self.timings.items(): STARTUP_SECONDS.set(seconds, phase=phase.removesuffix("_seconds"))
+        self.ready, self.last_error = True, None
+        log.info(f"Ready after {self.attempts} attempt(s): import-to-ready {self.timings['import_to_ready_seconds']:.2f}s "
+                 f"(init {init_seconds:.2f}s, warm-up {warmup_seconds:.2f}s).")
+
+    def mark_imported(self):
+        """Call once the app module has finished importing (before any component is built)."""
+        self.timings["import_seconds"] = round(time.perf_counter() - self.imported_at, 3)
+        STARTUP_SECONDS.set(self.timings["import_seconds"], phase="import")
+
+    def status(self):
+        return {"ready": self.ready, "attempts": self.attempts, "last_error": self.last_error,
+                "retry_in_seconds": None if self.ready else round(max(0.0, self.next_attempt_at - time.monotonic()), 1),
+                **self.timings}
+
+    # --- Initialization ---
+    def ensure_ready(self, wait=True):
+        """True once initialized. Otherwise runs one attempt if the backoff allows; with wait=False it never
+        blocks on an attempt already running in another thread."""
+        if self.ready: return True
+        acquired = self._lock.acquire(timeout=INIT_WAIT_SECONDS) if wait else self._lock.acquire(blocking=False)
+        if not acquired: return self.ready
+        try:
+            if self._due(): self._attempt()
+            return self.ready
+        finally:
+            self._lock.release()
+
+    def _attempt(self):
+        try:
+            started = time.perf_counter()
+            self.init_fn()
+            initialized = time.perf_counter()
+            if self.warmup_fn: self.warmup_fn()
+            self._succeeded(initialized - started, time.perf_counter() - initialized)
+        except Exception as e:
+            self._failed(e)
+
+    def start(self, mode=None):
+        """Applies STARTUP_MODE: "eager" initializes now, "background" on a daemon thread, "lazy" on first request."""
+        mode = check_startup_mode(mode)
+        if self.mode is None and hasattr(os, "register_at_fork"): os.register_at_fork(after_in_child=self._after_fork)
+        self.mode = mode
+        if mode == "eager": return self.ensure_ready()
+        if mode == "background" and self._thread is None:
+            self._thread = threading.Thread(target=self._run_until_ready, name="component-init", daemon=True)
+            self._thread.start()
+        return self.ready
+
+    def _run_until_ready(self):
+        while not self.ensure_ready():
+            time.sleep(max(0.05, self.next_attempt_at - time.monotonic()))
+
+    def _after_fork(self):
+        """Runs in a forked child. The init thread didn't survive fork(), its lock may have been held, and
+        clients built in the parent (MongoClient is not fork-safe) must not be used here: start over."""
+        self._lock = threading.Lock()
+        self._thread = None
+        self.ready, self.attempts, self.last_error, self.next_attempt_at = False, 0, None, 0.0
+        self.timings = {"import_seconds": self.timings["import_seconds"]} if "import_seconds" in self.timings else {}
+        if self.mode != "lazy": self.start("background") # Never block the fork: "eager" initializes in the background too
+
+
+class AsyncStartup(Startup):
+    """Startup for async_app.py: init_fn and warmup_fn are coroutine functions."""
+
+    def __init__(self, init_fn, warmup_fn=None, imported_at=None, warmup=STARTUP_WARMUP):
+        super().__init__(init_fn, warmup_fn, imported_at, warmup)
+        self._lock = asyncio.Lock()
+        self._task = None
+
+    async def ensure_ready(self, wait=True):
+        if self.ready: return True
+        if self._lock.locked() and not wait: return False
+        try:
+            await asyncio.wait_for(self._lock.acquire(), INIT_WAIT_SECONDS)
+        except asyncio.TimeoutError:
+            return self.ready
+        try:
+            if self._due(): await self._attempt()
+            return self.ready
+        finally:
+            self._lock.release()
+
+    async def _attempt(self):
+        try:
+            started = time.perf_counter()
+            await self.init_fn()
+            initialized = time.perf_counter()
+            if self.warmup_fn: await self.warmup_fn()
+            self._succeeded(initialized - started, time.perf_counter() - initialized)
+        except Exception as e:
+            self._failed(e)
+
+    async def start(self, mode=None):
+        mode = check_startup_mode(mode)
+        if mode == "eager": return await self.ensure_ready()
+        if mode == "background" and self._task is None: self._task = asyncio.create_task(self._run_until_ready())
+        return self.ready
+
+    async def _run_until_ready(self):
+        while not await self.ensure_ready():
+            await asyncio.sleep(max(0.05, self.next_attempt_at - time.monotonic()))
+
+    async def stop(self):
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+            try: await self._task
+            except asyncio.CancelledError: pass
+
+
+# --- Index Refresh ---
+class IndexRefresher:
+    """Runs refresh_fn on a daemon thread whenever request() is called (the catalog calls it when ingestion
+    bumps the corpus generation). Requests made while a refresh is waiting or running coalesce into one more
+    run, and runs start at most every min_interval seconds, so a bulk ingestion costs a few refreshes, not one per book.
+    refresh_fn does its work off the request path; searches only wait while it swaps the new state in."""
+
+    def __init__(self, refresh_fn, min_interval=INDEX_REFRESH_MIN_SECONDS):
+        self.refresh_fn = refresh_fn
+        self.min_interval = min_interval
+        self.refreshes = 0
+        self.last_error = None
+        self.last_seconds = None
+        self._pending = False
+        self._started_at = None
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def request(self, *_):
+        with self._lock:
+            self._pending = True
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="index-refresh", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            if self._started_at is not None: time.sleep(max(0.0, self._started_at + self.min_interval - time.monotonic()))
+            with self._lock:
+                if not self._pending:
+                    self._thread = None
+                    return
+                self._pending = False
+            self._started_at = time.monotonic()
+            try:
+                started = time.perf_counter()
+                self.refresh_fn()
+                self.refreshes += 1
+                self.last_seconds, self.last_error = round(time.perf_counter() - started, 3), None
+                log.info(f"Indexes refreshed after ingestion in {self.last_seconds:.2f}s.")
+            except Exception as e:
+                self.last_error = f"{type(e).__name__}: {e}"
+                log.error(f"Index refresh failed ({self.last_error}); serving the previous indexes.")
+
+    def stats(self):
+        return {"refreshes": self.refreshes, "running": self._thread is not None, "pending": self._pending,
+                "last_seconds": self.last_seconds, "last_error": self.last_error}
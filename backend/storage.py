@@ -0,0 +1,117 @@
+# backend/storage.py
+# MongoDB storage layouts shared by process_book.py and app.py.
+#   "embedded": one document per book with an embedded chunks: [{text, embedding}] array (original layout)
+#   "chunks":   book documents hold metadata only; every chunk is its own document in
+#               CHUNK_COLLECTION_NAME carrying book_id, ordinal, title and genre, so
+#               $vectorSearch returns individual chunks and books never hit the 16 MB BSON limit.
+import os
+import sys
+import json
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# --- Configuration ---
+STORAGE_LAYOUT = os.getenv("STORAGE_LAYOUT", "embedded").lower() # "embedded" or "chunks"
+CHUNK_COLLECTION_NAME = os.getenv("CHUNK_COLLECTION_NAME", "chunks")
+EMBEDDING_DIMENSIONS = int(os.getenv("EMBEDDING_DIMENSIONS", 1536)) # text-embedding-ada-002
+LAYOUTS = ("embedded", "chunks")
+
+
+def check_layout(layout):
+    layout = (layout or STORAGE_LAYOUT).lower()
+    if layout not in LAYOUTS: raise ValueError(f"Unknown storage layout '{layout}' (expected one of {LAYOUTS}).")
+    return layout
+
+
+# --- Document Builders ---
+def chunk_documents(book_id, title, genre, texts, vectors, start_ordinal=0):
+    """Builds one chunk document per (text, vector) pair for the chunk-level layout."""
+    return [
+        {"book_id": book_id, "ordinal": start_ordinal + i, "title": title, "genre": genre, "text": text, "embedding": vector}
+        for i, (text, vector) in enumerate(zip(texts, vectors))
+        if vector is not None
+    ]
+
+
+def ensure_chunk_indexes(chunk_collection):
+    """Regular (non-search) index used for per-book lookups, deletes and ordered reads."""
+    chunk_collection.create_index([("book_id", 1), ("ordinal", 1)], unique=True, name="book_id_ordinal")
+
+
+# --- Atlas Vector Search Index ---
+def vector_index_definition(layout=None, dimensions=EMBEDDING_DIMENSIONS):
+    """Atlas vectorSearch index definition for the given layout (filter fields included)."""
+    layout = check_layout(layout)
+    if layout == "embedded":
+        return {"fields": [
+            {"type": "vector", "path": "chunks.embedding", "numDimensions": dimensions, "similarity": "cosine"},
+            {"type": "filter", "path": "title"},
+            {"type": "filter", "path": "genre"},
+        ]}
+    return {"fields": [
+        {"type": "vector", "path": "embedding", "numDimensions": dimensions, "similarity": "cosine"},
+        {"type": "filter", "path": "title"},
+        {"type": "filter", "path": "genre"},
+        {"type": "filter", "path": "book_id"},
+    ]}
+
+
+def vector_search_path(layout=None):
+    return "chunks.embedding" if check_layout(layout) == "embedded" else "embedding"
+
+
+def create_vector_index(collection, index_name, layout=None):
+    """Creates the Atlas vectorSearch index on `collection` (books or chunks, depending on layout)."""
+    from pymongo.operations import SearchIndexModel
+    model = SearchIndexModel(definition=vector_index_definition(layout), name=index_name, type="vectorSearch")
+    return collection.create_search_index(model=model)
+
+
+# --- Migration: embedded -> chunks ---
+def migrate_embedded_to_chunks(books_collection, chunk_collection, drop_embedded=False, batch_size=1000):
+    """Copies every book's embedded chunks into the chunk collection (idempotent per book)."""
+    ensure_chunk_indexes(chunk_collection)
+    migrated_books = migrated_chunks = 0
+    cursor = books_collection.find({"chunks.0": {"$exists": True}}, {"_id": 1, "title": 1, "genre": 1, "chunks": 1})
+    for book in cursor:
+        chunks = book.get("chunks", [])
+        docs = chunk_documents(book["_id"], book.get("title"), book.get("genre"),
+                               [c.get("text") for c in chunks], [c.get("embedding") for c in chunks])
+        chunk_collection.delete_many({"book_id": book["_id"]}) # Re-running replaces a partial earlier copy
+        for start in range(0, len(docs), batch_size):
+            chunk_collection.insert_many(docs[start:start + batch_size], ordered=False)
+        update = {"$set": {"chunk_count": len(docs), "storage_layout": "chunks"}}
+        if drop_embedded: update["$unset"] = {"chunks": ""}
+        books_collection.update_one({"_id": book["_id"]}, update)
+        migrated_books += 1; migrated_chunks += len(docs)
+        print(f"  Migrated '{book.get('title')}' ({len(docs)} chunks)")
+    print(f"✅ Migrated {migrated_books} book(s), {migrated_chunks} chunk(s) into '{chunk_collection.name}'.")
+    return migrated_books, migrated_chunks
+
+
+# --- Run from CLI ---
+# python storage.py index-definition [embedded|chunks]  -> print the Atlas index JSON
+# python storage.py create-index [embedded|chunks]      -> create it via the driver
+# python storage.py migrate [--drop-embedded]           -> copy embedded chunks to the chunk collection
+if __name__ == "__main__":
+    commands = ("index-definition", "create-index", "migrate")
+    if len(sys.argv) < 2 or sys.argv[1] not in commands:
+        print("Usage: python storage.py index-definition [layout] | create-index [layout] | migrate [--drop-embedded]")
+        sys.exit(1)
+
+    command = sys.argv[1]
+    if command == "index-definition":
+        print(json.dumps(vector_index_definition(sys.argv[2] if len(sys.argv) > 2 else None), indent=2))
+        sys.exit(0)
+
+    from pymongo import MongoClient
+    client = MongoClient(os.getenv("MONGO_URI", "mongodb://localhost:27017/"))
+    db = client["books"]
+    if command == "create-index":
+        layout = check_layout(sys.argv[2] if len(sys.argv) > 2 else None)
+        target = db["books"] if layout == "embedded" else db[CHUNK_COLLECTION_NAME]
+        print(f"Created search index: {create_vector_index(target, 'vector_index', layout)}")
+    else:
+        migrate_embedded_to_chunks(db["books"], db[CHUNK_COLLECTION_NAME], drop_embedded="--drop-embedded" in sys.argv)
+    client.close()
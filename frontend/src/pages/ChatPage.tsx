@@ -23,6 +23,7 @@ const ChatPage: React.FC = () => {
   const [isLoading, setIsLoading] = useState(false);
   const [isLoadingBook, setIsLoadingBook] = useState(true);
   const [error, setError] = useState<string | null>(null);
+  const [statusText, setStatusText] = useState<string | null>(null);
 
   const messagesEndRef = useRef<HTMLDivElement>(null);
 
@@ -65,6 +66,18 @@ const ChatPage: React.FC = () => {
     fetchBookDetails();
   }, [bookId]);
 
+  // Parses one Server-Sent Event frame ("event: x\ndata: {...}") from /api/chat/stream
+  const parseSseFrame = (frame: string): { event: string; data: any } | null => {
+    let event = 'message';
+    const dataLines: string[] = [];
+    for (const line of frame.split('\n')) {
+      if (line.startsWith('event:')) event = line.slice(6).trim();
+      else if (line.startsWith('data:')) dataLines.push(line.slice(5).trim());
+    }
+    if (dataLines.length === 0) return null;
+    return { event, data: JSON.parse(dataLines.join('\n')) };
+  };
+
   const handleSend = async () => {
     const userMessageText = input.trim();
     if (!userMessageText || isLoading || !bookDetails) return;
@@ -73,9 +86,27 @@ const ChatPage: React.FC = () => {
     setMessages(prev => [...prev, newUserMessage]);
     setInput('');
     setIsLoading(true);
+    setStatusText('PagePal is searching the book...');
+
+    // Appends streamed text to the AI message that belongs to this request
+    let aiMessageStarted = false;
+    const appendToAiMessage = (text: string) => {
+      if (!aiMessageStarted) {
+        aiMessageStarted = true;
+        setStatusText(null); // The answer bubble itself now shows progress
+        setMessages(prev => [...prev, { sender: 'ai', text }]);
+        return;
+      }
+      setMessages(prev => {
+        const updated = [...prev];
+        const last = updated[updated.length - 1];
+        updated[updated.length - 1] = { ...last, text: last.text + text };
+        return updated;
+      });
+    };
 
     try {
-      const response = await fetch('http://localhost:5000/api/chat', {
+      const response = await fetch('http://localhost:5000/api/chat/stream', {
         method: 'POST',
         headers: { 'Content-Type': 'application/json' },
         body: JSON.stringify({
@@ -84,7 +115,7 @@ const ChatPage: React.FC = () => {
         }),
       });
 
-      if (!response.ok) {
+      if (!response.ok || !response.body) {
         let errorMsg = `HTTP error! status: ${response.status}`;
         try {
           const errorData = await response.json();
@@ -95,15 +126,34 @@ const ChatPage: React.FC = () => {
         throw new Error(errorMsg);
       }
 
-      const data = await response.json();
-      const aiMessage: Message = { sender: 'ai', text: data.answer };
-      setMessages(prev => [...prev, aiMessage]);
+      const reader = response.body.getReader();
+      const decoder = new TextDecoder();
+      let buffer = '';
+      while (true) {
+        const { value, done } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+        const frames = buffer.split('\n\n');
+        buffer = frames.pop() ?? '';
+        for (const frame of frames) {
+          const parsed = parseSseFrame(frame);
+          if (!parsed) continue;
+          if (parsed.event === 'status') {
+            setStatusText(parsed.data.stage === 'generating' ? 'PagePal is thinking...' : 'PagePal is searching the book...');
+          } else if (parsed.event === 'token') {
+            appendToAiMessage(parsed.data.text);
+          } else if (parsed.event === 'error') {
+            throw new Error(parsed.data.error);
+          }
+        }
+      }
 
     } catch (err: any) {
       const errorMessage: Message = { sender: 'ai', text: `Sorry, an error occurred: ${err.message}` };
       setMessages(prev => [...prev, errorMessage]);
     } finally {
       setIsLoading(false);
+      setStatusText(null);
     }
   };
 
@@ -157,9 +207,9 @@ const ChatPage: React.FC = () => {
               <p style={{ fontSize: '14px', lineHeight: '1.4', margin: '0' }}>{msg.text}</p>
             </div>
           ))}
-          {isLoading && (
+          {isLoading && statusText && (
             <div style={{ maxWidth: '85%', padding: '10px', borderRadius: '8px', marginBottom: '12px', backgroundColor: '#f1f1f1', marginRight: 'auto' }}>
-              <p style={{ fontSize: '14px', fontStyle: 'italic' }}>PagePal is thinking...</p>
+              <p style={{ fontSize: '14px', fontStyle: 'italic' }}>{statusText}</p>
             </div>
           )}
           <div ref={messagesEndRef} />